@@ -7,15 +7,16 @@ import logging
 import os
 import sys
 
-from cPickle import load
+import numpy as np
 from pyfann import libfann
 
 from .base import Common
+from .codebook import CodebookIndex
 from .data import Phenotyper
 from .exceptions import *
-from .functions import (combined_hash, get_childs_from_hierarchy,
-    get_classification, get_codewords, get_config_hashables,
-                        get_bowcode_from_surf_features)
+from .functions import (get_childs_from_hierarchy, get_classification,
+    get_codewords, get_config_hashables, stable_hash, get_bow_feature,
+    get_codebook_index_settings)
 
 class ImageClassifier(Common):
 
@@ -26,6 +27,13 @@ class ImageClassifier(Common):
         self.error = 0.0001
         self.cache = {}
         self.roi = None
+        self.phenotyper = Phenotyper()
+
+        # The codebook indexes that were loaded, by codebook file.
+        self._codebooks = {}
+
+        # The MD5 hash and ROI of the image loaded by the phenotyper.
+        self._loaded_image = None
 
         try:
             self.class_hr = self.config.classification.hierarchy
@@ -59,6 +67,75 @@ class ImageClassifier(Common):
         """Return the list of level names from the classification hierarchy."""
         return [l.name for l in self.class_hr]
 
+    def get_md5sum(self, im_path):
+        """Return the MD5 hash for the image file `im_path`."""
+        hasher = hashlib.md5()
+        with open(im_path, 'rb') as fh:
+            buf = fh.read()
+            hasher.update(buf)
+        return hasher.hexdigest()
+
+    def get_cache_key(self, md5sum, config):
+        """Return the key for a phenotype in the phenotype cache.
+
+        The key is unique for the combination of the image with MD5 hash
+        `md5sum`, the region of interest, and the preprocessing and features
+        settings in the configurations `config`.
+        """
+        hashables = get_config_hashables(config)
+        return stable_hash(md5sum, self.roi, config.features, *hashables)
+
+    def make_phenotypes(self, image_paths, workers=1):
+        """Extract the phenotypes for a batch of images.
+
+        Features are extracted from each image in `image_paths` for each of
+        the different preprocessing and features settings in the
+        classification hierarchy, in `workers` threads (see
+        :meth:`~nbclassify.data.Phenotyper.make_batch`). The phenotypes are
+        cached, so that :meth:`classify_image` and
+        :meth:`classify_with_hierarchy` do not need to extract them again.
+        Images for which feature extraction fails are logged and skipped.
+        """
+        # Get the different configurations in the classification hierarchy.
+        configs = []
+        seen = set()
+        for level in self.class_hr:
+            if 'preprocess' not in level or 'features' not in level:
+                continue
+            hash_ = self.get_cache_key(None, level)
+            if hash_ not in seen:
+                seen.add(hash_)
+                configs.append(level)
+        if not configs:
+            return
+
+        paths = [p for p in image_paths if os.path.isfile(p)]
+        results = self.phenotyper.make_batch(paths, [self.roi] * len(paths),
+            workers, [configs] * len(paths))
+        for im_path, phenotypes in results:
+            md5sum = self.get_md5sum(im_path)
+            for config, phenotype in zip(configs, phenotypes):
+                if isinstance(phenotype, Exception):
+                    logging.error("Failed to extract features from `%s`: " \
+                        "%s: %s", im_path, type(phenotype).__name__,
+                        phenotype)
+                    continue
+                self.cache[self.get_cache_key(md5sum, config)] = phenotype
+
+    def get_codebook_index(self, codebookfile, args):
+        """Return the codebook index for a codebook file.
+
+        The index is loaded once for each codebook file `codebookfile`, with
+        the index settings of the BagOfWords feature settings `args` (see
+        :meth:`~nbclassify.functions.get_codebook_index_settings`).
+        """
+        method, eps = get_codebook_index_settings(args)
+        key = (codebookfile, method, eps)
+        if key not in self._codebooks:
+            self._codebooks[key] = CodebookIndex.from_codebook_file(
+                codebookfile, method, eps)
+        return self._codebooks[key]
+
     def classify_image(self, im_path, ann_path, config, codebookfile=None):
         """Classify an image file and return the codeword.
 
@@ -81,40 +158,36 @@ class ImageClassifier(Common):
         ann = libfann.neural_net()
         ann.create_from_file(str(ann_path))
 
-        # Get the MD5 hash for the image.
-        hasher = hashlib.md5()
-        with open(im_path, 'rb') as fh:
-            buf = fh.read()
-            hasher.update(buf)
-
-        # Get a hash that that is unique for this image/preprocess/features
-        # combination.
-        hashables = get_config_hashables(config)
-        hash_ = combined_hash(hasher.hexdigest(),
-            config.features, *hashables)
+        md5sum = self.get_md5sum(im_path)
+        hash_ = self.get_cache_key(md5sum, config)
 
         if hash_ in self.cache:
             phenotype = self.cache[hash_]
         else:
-            phenotyper = Phenotyper()
-            phenotyper.set_image(im_path)
-            if self.roi:
-                phenotyper.set_roi(self.roi)
-            phenotyper.set_config(config)
-            phenotype = phenotyper.make()
+            # Only load the image if it was not loaded already, so that the
+            # levels of the classification hierarchy share the preprocessing
+            # results.
+            if self._loaded_image != (md5sum, self.roi):
+                self.phenotyper.set_image(im_path)
+                self.phenotyper.set_roi(self.roi)
+                self._loaded_image = (md5sum, self.roi)
+            self.phenotyper.set_config(config)
+            phenotype = self.phenotyper.make()
 
             # Cache the phenotypes, in case they are needed again.
             self.cache[hash_] = phenotype
 
-            # Convert phenotype to BagOfWords-code if necessary.
-            use_bow = getattr(config.features['surf'], 'bow_clusters', False)
-            if use_bow:
-                with open(codebookfile, "rb") as cb:
-                    codebook = load(cb)
-                phenotype = get_bowcode_from_surf_features(phenotype, codebook)
+        # Convert phenotype to BagOfWords-code if necessary.
+        bow_feature = get_bow_feature(config.features)
+        if bow_feature:
+            index = self.get_codebook_index(codebookfile,
+                config.features[bow_feature])
+            phenotype = index.encode(phenotype, [len(phenotype)])[0]
 
         logging.debug("Using ANN `%s`" % ann_path)
-        codeword = ann.run(phenotype)
+
+        # The ANN expects a list of Python floats.
+        codeword = ann.run(np.asarray(phenotype, dtype=float).tolist())
 
         return codeword
 
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+
+"""Codebooks for the BagOfWords model.
+
+A codebook is a set of cluster centers, the visual words of the BagOfWords
+model. The local descriptors of an image are assigned to their nearest
+cluster center, and the histogram of the assignments is used as the phenotype
+of the image.
+
+Codebooks for real valued descriptors, such as those of SURF, are created
+with mini-batch k-means (see :meth:`kmeans_minibatch`), which only needs a
+small batch of descriptors in memory at a time.
+
+Binary descriptors, such as those of ORB, are rows of bytes that are compared
+by their Hamming distance, the number of bits in which they differ. These
+routines create and use codebooks for binary descriptors, which are themselves
+binary descriptors.
+
+Descriptors are assigned to the codes of a codebook with a
+:class:`CodebookIndex`, which can encode the descriptors of many images at
+once. Codebooks are kept in a :class:`CodebookRegistry`, so that a codebook
+is only created once for the same descriptors and settings.
+"""
+
+from cPickle import dump, load, HIGHEST_PROTOCOL
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import scipy.cluster.vq as vq
+from scipy.spatial import cKDTree
+import yaml
+
+def unpack_bits(descriptors):
+    """Return binary descriptors as an array of bits.
+
+    Expects an array of ``n`` binary descriptors of ``m`` bytes each, and
+    returns a float32 array of shape ``(n, 8 * m)`` with the value 0 or 1 for
+    each bit.
+    """
+    descriptors = np.asarray(descriptors, dtype=np.uint8)
+    return np.unpackbits(descriptors, axis=1).astype(np.float32)
+
+def hamming_distances(a, b):
+    """Return the Hamming distances between two sets of binary descriptors.
+
+    Returns an integer array of shape ``(len(a), len(b))`` with the number of
+    bits in which each descriptor in `a` differs from each descriptor in `b`.
+    The distances are computed as ``|a| + |b| - 2 * a.b`` on the bits, which
+    is a single matrix product.
+    """
+    a_bits = unpack_bits(a)
+    b_bits = unpack_bits(b)
+    dist = a_bits.sum(axis=1)[:,None] + b_bits.sum(axis=1)[None,:] - \
+        2 * a_bits.dot(b_bits.T)
+    return np.rint(dist).astype(np.int32)
+
+def hamming_vq(descriptors, codebook, chunk_size=4096):
+    """Assign binary descriptors to the nearest codes of a codebook.
+
+    This is the Hamming distance equivalent of :meth:`scipy.cluster.vq.vq`.
+    Returns a 2-tuple ``(codes, distances)`` with for each descriptor the
+    index of the nearest code in `codebook` and the Hamming distance to it.
+    Descriptors are processed in chunks of `chunk_size` to limit memory use.
+    """
+    descriptors = np.asarray(descriptors, dtype=np.uint8)
+    codes = np.empty(len(descriptors), dtype=np.int64)
+    distances = np.empty(len(descriptors), dtype=np.int32)
+    for start in range(0, len(descriptors), chunk_size):
+        dist = hamming_distances(descriptors[start:start+chunk_size], codebook)
+        codes[start:start+chunk_size] = dist.argmin(axis=1)
+        distances[start:start+chunk_size] = dist.min(axis=1)
+    return (codes, distances)
+
+def hamming_kmajority(descriptors, k, iters=10, seed=None):
+    """Create a codebook for binary descriptors with k-majority clustering.
+
+    This is the binary equivalent of k-means clustering. The `k` cluster
+    centers are initialized with randomly chosen descriptors. Each iteration
+    assigns the descriptors to the nearest center by Hamming distance, and
+    sets each bit of a center to the value of the majority of its
+    descriptors. Empty clusters get the descriptors that are farthest from
+    their centers. Stops after `iters` iterations, or earlier when the
+    centers no longer change. The random number generator is seeded with
+    `seed`.
+
+    Returns the codebook as an array of `k` binary descriptors.
+    """
+    descriptors = np.asarray(descriptors, dtype=np.uint8)
+    n = len(descriptors)
+    if k < 1:
+        raise ValueError("The number of clusters must be at least 1")
+    if n < k:
+        raise ValueError("Cannot create %d clusters from %d descriptors" % \
+            (k, n))
+
+    rng = np.random.RandomState(seed)
+    codebook = descriptors[rng.choice(n, k, replace=False)]
+    bits = np.unpackbits(descriptors, axis=1)
+
+    for i in range(iters):
+        codes, distances = hamming_vq(descriptors, codebook)
+
+        # Count the set bits in each cluster.
+        counts = np.bincount(codes, minlength=k)
+        order = np.argsort(codes, kind='mergesort')
+        starts = np.searchsorted(codes[order], np.arange(k))
+        sums = np.zeros((k, bits.shape[1]), dtype=np.int64)
+        filled = counts > 0
+        sums[filled] = np.add.reduceat(bits[order], starts[filled], axis=0)
+
+        # Set each bit to the majority vote. Ties are resolved as 0.
+        majority = (2 * sums > counts[:,None]).astype(np.uint8)
+        new = np.packbits(majority, axis=1)
+
+        # Move empty clusters to the descriptors farthest from their centers.
+        empty = np.nonzero(~filled)[0]
+        if len(empty) > 0:
+            farthest = np.argsort(-distances, kind='mergesort')[:len(empty)]
+            new[empty] = descriptors[farthest]
+
+        if np.array_equal(new, codebook):
+            break
+        codebook = new
+
+    return codebook
+
+def sample_rows(n, max_samples, rng):
+    """Return the indices of a random sample of rows.
+
+    Returns the sorted indices of `max_samples` rows drawn without
+    replacement from `n` rows, using random number generator `rng`. Returns
+    None if `max_samples` is not set or not smaller than `n`, meaning that
+    all rows are used.
+    """
+    if not max_samples or max_samples >= n:
+        return None
+    return np.sort(rng.choice(n, int(max_samples), replace=False))
+
+def squared_distances(a, b):
+    """Return the squared Euclidean distances between two sets of vectors.
+
+    Returns an array of shape ``(len(a), len(b))``.
+    """
+    dist = (a ** 2).sum(axis=1)[:,None] + (b ** 2).sum(axis=1)[None,:] - \
+        2 * a.dot(b.T)
+    return np.maximum(dist, 0)
+
+def kmeans_plusplus(data, k, rng):
+    """Return `k` initial cluster centers chosen with k-means++.
+
+    The first center is a random row of `data`. Each next center is a row
+    chosen with a probability proportional to its squared distance to the
+    nearest center chosen so far, which spreads the centers over the data.
+    Of several such candidates, the one that most reduces the sum of the
+    squared distances is chosen (greedy k-means++).
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)
+    n_trials = 2 + int(np.log(k))
+    centers = np.empty((k, data.shape[1]), dtype=np.float64)
+    centers[0] = data[rng.randint(n)]
+    closest = squared_distances(data, centers[:1]).ravel()
+    for i in range(1, k):
+        total = closest.sum()
+        if total > 0:
+            candidates = np.searchsorted(np.cumsum(closest),
+                rng.rand(n_trials) * total)
+            candidates = np.minimum(candidates, n - 1)
+        else:
+            candidates = rng.randint(n, size=n_trials)
+        dist = np.minimum(closest,
+            squared_distances(data[candidates], data))
+        best = dist.sum(axis=1).argmin()
+        centers[i] = data[candidates[best]]
+        closest = dist[best]
+    return centers
+
+def _read_rows(descriptors, rows, index):
+    """Return rows `index` of the descriptors as a float64 array."""
+    index = np.sort(index)
+    if rows is not None:
+        index = rows[index]
+    return np.asarray(descriptors[index], dtype=np.float64)
+
+def _save_checkpoint(path, **state):
+    """Save the state of :meth:`kmeans_minibatch` to `path`.
+
+    The state is written to a temporary file which then replaces the
+    checkpoint, so that a crash never leaves an incomplete checkpoint.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        np.savez(fh, **state)
+    os.rename(tmp_path, path)
+
+def _data_digest(n, rows, fingerprint):
+    """Return a digest of the data that :meth:`kmeans_minibatch` clusters.
+
+    The data are the rows with indices `rows` of `n` rows, or all `n` rows
+    if `rows` is None, of the descriptors identified by `fingerprint`.
+    """
+    digest = hashlib.sha1("%d\n" % n)
+    if rows is not None:
+        digest.update(np.ascontiguousarray(rows, dtype=np.int64).tostring())
+    if fingerprint is not None:
+        digest.update("\n%s" % fingerprint)
+    return digest.hexdigest()
+
+def kmeans_minibatch(descriptors, k, batch_size=1000, iters=100,
+        max_samples=None, seed=None, tol=1e-4, reassign_interval=10,
+        checkpoint=None, checkpoint_interval=10, rows=None, fingerprint=None):
+    """Create a codebook with mini-batch k-means clustering.
+
+    Clusters the rows of `descriptors` into `k` clusters. The rows are only
+    read in batches of `batch_size` random rows, so `descriptors` can be a
+    memory-mapped matrix that does not fit in memory. If `rows` is set, only
+    the rows with these indices are clustered. If `max_samples` is set, the
+    rows are first limited to a random sample of at most `max_samples` rows.
+
+    The centers are initialized with k-means++ on a sample of the rows. Each
+    of at most `iters` iterations assigns a batch to the nearest centers,
+    and moves each center towards the mean of its rows with a learning rate
+    that decreases with the number of rows it has been assigned so far.
+    Centers that were not assigned any rows for `reassign_interval`
+    iterations are moved to the rows of the batch that are farthest from
+    their centers, so the codebook always has `k` centers. Stops early when
+    the centers move less than `tol`, relative to the variance of the data.
+    The random number generator is seeded with `seed`.
+
+    If `checkpoint` is set to a file path, the state is saved to that file
+    every `checkpoint_interval` iterations. If the file exists and was saved
+    for the same data and settings, clustering resumes from it, with the
+    same sample of rows. The data are the same if `rows` and the number of
+    rows of `descriptors` are the same, and the string `fingerprint` that
+    identifies the descriptors, if set. Otherwise clustering starts over. The
+    file is removed when clustering completes.
+
+    Returns the codebook as a float32 array of shape ``(k, columns)``.
+    """
+    n = len(rows) if rows is not None else len(descriptors)
+    if k < 1:
+        raise ValueError("The number of clusters must be at least 1")
+    if n < k:
+        raise ValueError("Cannot create %d clusters from %d descriptors" % \
+            (k, n))
+
+    if rows is not None:
+        rows = np.asarray(rows)
+    m = n if not max_samples or max_samples >= n else int(max_samples)
+    batch_size = min(int(batch_size), m)
+
+    # The settings and the data a checkpoint must have been saved with to be
+    # resumed.
+    params = np.array([k, len(descriptors), m, batch_size,
+        -1 if seed is None else seed], dtype=np.int64)
+    data = _data_digest(len(descriptors), rows, fingerprint)
+
+    state = None
+    if checkpoint and os.path.isfile(checkpoint):
+        state = dict(np.load(checkpoint))
+        if not np.array_equal(state['params'], params) or \
+                str(state.get('data')) != data:
+            state = None
+
+    # Use the same sample as the checkpoint, which differs for each run if
+    # `seed` is not set.
+    rng = np.random.RandomState(seed)
+    if state is not None:
+        sample = state['sample'] if m < n else None
+    else:
+        sample = sample_rows(n, max_samples, rng)
+    if sample is not None:
+        rows = sample if rows is None else rows[sample]
+
+    if state is not None:
+        centers = state['centers']
+        counts = state['counts']
+        last_assigned = state['last_assigned']
+        tol_abs = float(state['tol_abs'])
+        start = int(state['iteration'])
+        rng.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']),
+            int(state['rng_has_gauss']), float(state['rng_gauss'])))
+    else:
+        init_size = min(m, max(3 * k, batch_size))
+        init = _read_rows(descriptors, rows,
+            rng.choice(m, init_size, replace=False))
+        centers = kmeans_plusplus(init, k, rng)
+        counts = np.zeros(k, dtype=np.int64)
+        last_assigned = np.zeros(k, dtype=np.int64)
+        tol_abs = tol * init.var(axis=0).mean()
+        start = 0
+        del init
+
+    for i in range(start, iters):
+        batch = _read_rows(descriptors, rows,
+            rng.choice(m, batch_size, replace=False))
+        dist = squared_distances(batch, centers)
+        labels = dist.argmin(axis=1)
+
+        # Sum the rows assigned to each center.
+        batch_counts = np.bincount(labels, minlength=k)
+        hit = batch_counts > 0
+        order = np.argsort(labels, kind='mergesort')
+        starts = np.searchsorted(labels[order], np.arange(k))
+        sums = np.add.reduceat(batch[order], starts[hit], axis=0)
+
+        # Move the centers to the running mean of their rows.
+        old = centers.copy()
+        counts += batch_counts
+        centers[hit] += (sums - batch_counts[hit][:,None] * centers[hit]) / \
+            counts[hit][:,None]
+        last_assigned[hit] = i
+
+        # Move centers that have not been assigned any rows for a while.
+        idle = np.nonzero(i - last_assigned >= reassign_interval)[0]
+        if len(idle) > 0:
+            farthest = np.argsort(-dist.min(axis=1), kind='mergesort')
+            idle = idle[:len(farthest)]
+            centers[idle] = batch[farthest[:len(idle)]]
+            counts[idle] = 1
+            last_assigned[idle] = i
+
+        if checkpoint and (i + 1) % checkpoint_interval == 0:
+            keys, pos, has_gauss, gauss = rng.get_state()[1:]
+            if sample is None:
+                sample = np.empty(0, dtype=np.int64)
+            _save_checkpoint(checkpoint, params=params, data=data,
+                sample=sample, centers=centers, counts=counts,
+                last_assigned=last_assigned, tol_abs=tol_abs,
+                iteration=i + 1, rng_keys=keys, rng_pos=pos,
+                rng_has_gauss=has_gauss, rng_gauss=gauss)
+
+        shift = ((centers - old) ** 2).sum(axis=1).mean()
+        if len(idle) == 0 and shift <= tol_abs:
+            break
+
+    if checkpoint and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+    return centers.astype(np.float32)
+
+def get_codebook_path(filename):
+    """Return the path of the codebook for training data `filename`."""
+    return filename + "_codebook.file"
+
+def get_meta_path(codebook_file):
+    """Return the path of the metadata for codebook file `codebook_file`.
+
+    The metadata of a codebook (see :class:`CodebookRegistry`) is saved next
+    to the codebook, with the extension ``.yml``.
+    """
+    return os.path.splitext(codebook_file)[0] + '.yml'
+
+def get_index_path(codebook_file):
+    """Return the path of the index for codebook file `codebook_file`.
+
+    The index is saved next to the codebook, with the extension ``.index``
+    instead of the extension of the codebook file.
+    """
+    return os.path.splitext(codebook_file)[0] + '.index'
+
+class CodebookIndex(object):
+
+    """Assign descriptors to the nearest codes of a codebook.
+
+    The nearest codes are found with one of the following methods:
+
+    * ``exact``: Brute force search with :meth:`scipy.cluster.vq.vq`. This is
+      the reference method.
+    * ``kdtree``: Search in a k-d tree of the codes. If `eps` is larger than
+      0, the search is approximate: the distance to the returned code is at
+      most ``1 + eps`` times the distance to the nearest code. A k-d tree
+      pays off for large codebooks of descriptors with few dimensions; for
+      SURF descriptors the exact method is often just as fast.
+
+    Codebooks of binary descriptors (see :meth:`hamming_kmajority`) are
+    always searched by Hamming distance with :meth:`hamming_vq`.
+
+    An index is built once for a codebook and can be saved next to it with
+    :meth:`save`.
+    """
+
+    METHODS = ('exact', 'kdtree')
+
+    def __init__(self, codebook, method='exact', eps=0.0):
+        if method not in self.METHODS:
+            raise ValueError("Unknown codebook index method `%s`" % method)
+        self.codebook = np.asarray(codebook)
+        self.method = method
+        self.eps = float(eps)
+        self.binary = self.codebook.dtype == np.uint8
+        self._tree = None
+        if method == 'kdtree' and not self.binary:
+            self._tree = cKDTree(self.codebook)
+
+    def __len__(self):
+        return len(self.codebook)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index that was saved with :meth:`save`."""
+        with open(path, 'rb') as fh:
+            return load(fh)
+
+    @classmethod
+    def from_codebook_file(cls, codebook_file, method='exact', eps=0.0):
+        """Return the index for the codebook in file `codebook_file`.
+
+        The index saved next to the codebook file (see
+        :meth:`get_index_path`) is used if it was built with the same method
+        for the same codebook. Otherwise a new index is built, which is not
+        saved.
+        """
+        with open(codebook_file, 'rb') as fh:
+            codebook = load(fh)
+        index_path = get_index_path(codebook_file)
+        if os.path.isfile(index_path):
+            index = cls.load(index_path)
+            if index.method == method and index.eps == float(eps) and \
+                    np.array_equal(index.codebook, codebook):
+                return index
+        return cls(codebook, method, eps)
+
+    def save(self, path):
+        """Save the index to file `path`."""
+        with open(path, 'wb') as fh:
+            dump(self, fh, protocol=HIGHEST_PROTOCOL)
+
+    def query(self, descriptors):
+        """Return the index of the nearest code for each descriptor."""
+        if len(descriptors) == 0:
+            return np.empty(0, dtype=np.int64)
+        if self.binary:
+            codes, _dist = hamming_vq(descriptors, self.codebook)
+        elif self._tree is not None:
+            _dist, codes = self._tree.query(descriptors, eps=self.eps)
+        else:
+            codes, _dist = vq.vq(descriptors, self.codebook)
+        return codes
+
+    def encode(self, descriptors, counts, rows=None, chunk_size=65536):
+        """Return the BagOfWords codes for the descriptors of many images.
+
+        Expects the descriptors of all images as the rows of matrix
+        `descriptors`, image after image, where `counts` is the number of
+        descriptors of each image. If `rows` is set, the descriptors are the
+        rows of `descriptors` with these numbers. The descriptors are
+        assigned to the codes in chunks of `chunk_size` rows, so
+        `descriptors` can be a memory-mapped matrix that does not fit in
+        memory.
+
+        Returns an array of shape ``(len(counts), len(self))`` with for each
+        image the normalized histogram of its codes, as returned by
+        :meth:`~nbclassify.functions.get_bowcode_from_surf_features`. The
+        histogram of an image without descriptors is all zeros.
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        k = len(self.codebook)
+        owners = np.repeat(np.arange(len(counts)), counts)
+        hists = np.zeros(len(counts) * k, dtype=np.int64)
+        for start in range(0, len(owners), chunk_size):
+            stop = start + chunk_size
+            if rows is None:
+                chunk = descriptors[start:stop]
+            else:
+                chunk = descriptors[rows[start:stop]]
+            codes = self.query(chunk)
+            hists += np.bincount(owners[start:stop] * k + codes,
+                minlength=len(hists))
+        hists = hists.reshape(len(counts), k)
+        return hists / np.maximum(counts, 1)[:,None].astype(float)
+
+class CodebookRegistry(object):
+
+    """A directory of codebooks that can be reused.
+
+    Each codebook is saved under a key that identifies the descriptors it was
+    created from and the settings for creating it, such as the number of
+    clusters and the random seed. A codebook for the same key is only
+    created once, and then reused by other levels of the classification
+    hierarchy and by later runs.
+
+    For a key, the directory contains the codebook ``<key>.file``, in the
+    same format as the codebook files next to training data, and its
+    metadata ``<key>.yml``. The metadata is written last, so a codebook is
+    only registered if it was completely written.
+    """
+
+    def __init__(self, path):
+        """Open or create the registry in directory `path`."""
+        self.path = path
+
+    def get_path(self, key):
+        """Return the path of the codebook file for key `key`."""
+        return os.path.join(self.path, "%s.file" % key)
+
+    def __contains__(self, key):
+        return os.path.isfile(get_meta_path(self.get_path(key)))
+
+    def get(self, key):
+        """Return the codebook for key `key`, or None if there is none."""
+        if key not in self:
+            return None
+        with open(self.get_path(key), 'rb') as fh:
+            return load(fh)
+
+    def get_meta(self, key):
+        """Return the metadata of the codebook for key `key`."""
+        with open(get_meta_path(self.get_path(key)), 'r') as fh:
+            return yaml.safe_load(fh)
+
+    def add(self, key, codebook, meta=None):
+        """Register codebook `codebook` with metadata `meta` under `key`.
+
+        The key is added to the metadata. Returns the path of the codebook
+        file.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        path = self.get_path(key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            dump(codebook, fh, protocol=HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+        meta = dict(meta or {})
+        meta['key'] = key
+        with open(get_meta_path(path), 'w') as fh:
+            yaml.safe_dump(meta, fh, default_flow_style=False)
+        return path
+
+    def copy(self, key, codebook_file):
+        """Copy the codebook for key `key` to file `codebook_file`.
+
+        The metadata is copied along (see :meth:`get_meta_path`), so that it
+        is known which codebook a file is.
+        """
+        path = self.get_path(key)
+        shutil.copyfile(path, codebook_file)
+        shutil.copyfile(get_meta_path(path), get_meta_path(codebook_file))
@@ -25,6 +25,11 @@ ANN_DEFAULTS = {
     'neurons_between_reports': 1,
     'cascade_activation_steepnesses': [0.25, 0.50, 0.75, 1.00],
     'cascade_num_candidate_groups': 2,
+    'validation_split': 0,
+    'validation_interval': 10,
+    'patience': 0,
+    'min_improvement': 0,
+    'validation_seed': 0,
 }
 
 @singleton
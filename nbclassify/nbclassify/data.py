@@ -3,28 +3,202 @@
 """Train data routines."""
 
 from copy import deepcopy
-from cPickle import dump, load, HIGHEST_PROTOCOL
 import csv
 import datetime
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import shelve
+import shutil
 import sys
+import threading
 
 import cv2
 import imgpheno as ft
 import numpy as np
-import scipy.cluster.vq as vq
 from sklearn.preprocessing import MinMaxScaler
+import yaml
 
 from . import conf
 from .base import Common, Struct
 from .exceptions import *
 from .functions import (combined_hash, classification_hierarchy_filters,
-    get_codewords, get_config_hashables, readable_filter,
-    get_bowcode_from_surf_features)
+    get_codewords, get_config_hashables, get_feature_cache_key, get_image_size,
+    readable_filter, get_bow_feature, get_codebook_index_settings,
+    stable_hash, filter_photos)
+from .codebook import (CodebookIndex, CodebookRegistry, get_codebook_path,
+    get_index_path, hamming_kmajority, kmeans_minibatch, sample_rows)
+from .rays import line_pixels, pad_points, ray_histograms, ray_mean_sd
+from .segmentation import segment
+from .store import ArrayStore, RaggedArrayStore, open_store
 import nbclassify.db as db
 
+# Features that do not have a fixed length, and thus cannot be stored as rows
+# of a matrix. These are stored as local descriptors, any number of rows per
+# image, in a :class:`~nbclassify.store.RaggedArrayStore`.
+RAGGED_FEATURES = ('orb', 'surf')
+
+# Features with binary descriptors, which are stored as bytes.
+BINARY_FEATURES = ('orb',)
+
+# The number of bytes of an ORB descriptor.
+ORB_DESCRIPTOR_SIZE = 32
+
+# The length of a SURF descriptor.
+SURF_DESCRIPTOR_SIZE = 128
+
+# The data type of phenotypes if ``data.dtype`` is not set.
+PHENOTYPE_DTYPE = 'float32'
+
+# The version of the cache format. Caches with a manifest for a different
+# version are considered stale and are recreated by :meth:`PhenotypeCache.make`.
+# Must be increased when a change in feature extraction changes the features.
+CACHE_VERSION = 1
+
+# Flags for :meth:`cv2.imread` to decode an image at 1/1, 1/2, 1/4 or 1/8 of
+# its size. Decoding at a reduced size requires OpenCV 3.
+IMREAD_FLAGS = {1: cv2.IMREAD_COLOR}
+for _factor in (2, 4, 8):
+    _flag = getattr(cv2, 'IMREAD_REDUCED_COLOR_%d' % _factor, None)
+    if _flag is not None:
+        IMREAD_FLAGS[_factor] = _flag
+
+# File names in a cache directory start with the cache key, which is a SHA-1
+# digest, or an integer for caches created by older versions.
+CACHE_KEY_PATTERN = re.compile(r'^([0-9a-f]{40}|-?[0-9]+)$')
+
+def _as_dict(obj):
+    """Return a copy of a :class:`Struct` object as a dictionary.
+
+    Other objects are returned unchanged.
+    """
+    if isinstance(obj, Struct):
+        return deepcopy(obj).as_dict()
+    return obj
+
+def get_phenotype_dtype(config):
+    """Return the data type for phenotypes.
+
+    The data type is read from ``data.dtype`` in the configurations `config`,
+    and defaults to :data:`PHENOTYPE_DTYPE`. Returns a :class:`numpy.dtype`.
+    Raises a ConfigurationError if the data type is not a floating point type.
+    """
+    try:
+        dtype = config.data.dtype
+    except AttributeError:
+        dtype = PHENOTYPE_DTYPE
+
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError:
+        raise ConfigurationError("Unknown data type `%s`" % dtype)
+    if dtype.kind != 'f':
+        raise ConfigurationError("The data type must be a floating point " \
+            "type, found `%s`" % dtype)
+    return dtype
+
+def get_descriptor_dtype(name, args, config):
+    """Return the data type in which local descriptors are cached.
+
+    Binary descriptors (see :data:`BINARY_FEATURES`) are always stored as
+    bytes. Other descriptors of feature `name` are stored with the data type
+    set in the feature settings `args` as ``dtype``, which defaults to the
+    data type of the phenotypes of configurations `config` (see
+    :meth:`get_phenotype_dtype`). Storing SURF descriptors as float16 halves
+    the size of the cache.
+    """
+    if name in BINARY_FEATURES:
+        return np.dtype(np.uint8)
+    dtype = getattr(args, 'dtype', None)
+    if dtype is None:
+        return get_phenotype_dtype(config)
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError:
+        raise ConfigurationError("Invalid data type `%s` for feature `%s`" % \
+            (dtype, name))
+    if dtype.kind != 'f':
+        raise ConfigurationError("The data type for feature `%s` must be a " \
+            "floating point type, got `%s`" % (name, dtype))
+    return dtype
+
+def get_feature_columns(name, args):
+    """Return the column names for a feature.
+
+    Returns the names of the data columns for feature `name` with settings
+    `args`, in the order in which the values appear in the phenotype. For
+    features that do not have a fixed length (see :data:`RAGGED_FEATURES`),
+    the columns of the BagOfWords code are returned.
+    """
+    columns = []
+
+    if name == 'color_histograms':
+        for colorspace, bins in vars(args).iteritems():
+            for ch, n in enumerate(bins):
+                for i in range(1, n+1):
+                    columns.append("%s:%d" % (colorspace[ch], i))
+
+    elif name == 'color_bgr_means':
+        bins = getattr(args, 'bins', 20)
+        for i in range(1, bins+1):
+            for axis in ("HOR", "VER"):
+                for ch in "BGR":
+                    columns.append("BGR_MN:%d.%s.%s" % (i,axis,ch))
+
+    elif name == 'shape_outline':
+        n = getattr(args, 'k', 15)
+        for i in range(1, n+1):
+            columns.append("OUTLINE:%d.X" % i)
+            columns.append("OUTLINE:%d.Y" % i)
+
+    elif name == 'shape_360':
+        step = getattr(args, 'step', 1)
+        output_functions = getattr(args, 'output_functions',
+            Struct({'mean_sd': {}}))
+        for f_name, f_args in vars(output_functions).iteritems():
+            if f_name == 'mean_sd':
+                for i in range(0, 360, step):
+                    columns.append("360:%d.MN" % i)
+                    columns.append("360:%d.SD" % i)
+
+            if f_name == 'color_histograms':
+                for i in range(0, 360, step):
+                    for cs, bins in vars(f_args).iteritems():
+                        for j, color in enumerate(cs):
+                            for k in range(1, bins[j]+1):
+                                columns.append("360:%d.%s:%d" % (i,color,k))
+
+    elif name in ('orb', 'surf'):
+        try:
+            n_clusters = int(getattr(args, 'bow_clusters', None))
+        except (TypeError, ValueError):
+            n_clusters = 150
+        for i in range(1, n_clusters+1):
+            columns.append("CL%d" % i)
+
+    else:
+        raise ValueError("Unknown feature `%s`" % name)
+
+    return columns
+
+def get_feature_layout(features):
+    """Return the layout of the phenotype for a features configuration.
+
+    The features in the configurations `features` are sorted by name, which
+    is the order in which they appear in the phenotype. Returns a list of
+    4-tuples ``(name, start, stop, columns)``, one for each feature, where
+    ``phenotype[start:stop]`` are the values of the feature, and `columns`
+    are the column names returned by :meth:`get_feature_columns`.
+    """
+    layout = []
+    start = 0
+    for name in sorted(vars(features).keys()):
+        columns = get_feature_columns(name, features[name])
+        layout.append((name, start, start + len(columns), columns))
+        start += len(columns)
+    return layout
+
 class PhenotypeCache(object):
 
     """Cache and retrieve phenotypes.
@@ -34,6 +208,8 @@ class PhenotypeCache(object):
 
     def __init__(self):
         self._cache = {}
+        self._stores = {}
+        self.dtype = np.dtype(PHENOTYPE_DTYPE)
 
     def get_single_feature_configurations(self, config):
         """Return each configuration together with each feature separately.
@@ -75,13 +251,9 @@ class PhenotypeCache(object):
                 c = deepcopy(c)
                 c.features = Struct({name: feature})
 
-                # Get those configuration objects that are suitable for creating
-                # hashes for the feature caches.
-                hashables = get_config_hashables(c)
-
                 # Create a hash from the configurations. The hash must be
                 # different for different configurations.
-                hash_ = combined_hash(feature, *hashables)
+                hash_ = get_feature_cache_key(name, feature, c)
 
                 if hash_ not in seen_hashes:
                     seen_hashes.append(hash_)
@@ -98,80 +270,519 @@ class PhenotypeCache(object):
     def get_features(self, cache_dir, hash_):
         """Return features from cache for a given hash.
 
-        Looks for a cache file in the directory `cache_dir` with the file name
-        `hash_`. Returns None if the cache could not be found.
+        Looks for a cache in the directory `cache_dir` with the name `hash_`.
+        The cache is returned as an :class:`~nbclassify.store.ArrayStore` or
+        :class:`~nbclassify.store.RaggedArrayStore` if one exists. Otherwise
+        it looks for a legacy cache file, a Python shelve, which is returned
+        as a dictionary. Returns None if the cache could not be found.
         """
+        store_path = self.get_store_path(cache_dir, hash_)
+        if ArrayStore.exists(store_path):
+            return open_store(store_path)
+
         try:
-            cache = shelve.open(os.path.join(cache_dir, str(hash_)))
+            cache = shelve.open(os.path.join(cache_dir, str(hash_)), 'r')
             c = dict(cache)
             cache.close()
             return c
         except:
             return None
 
+    def get_store_path(self, cache_dir, hash_):
+        """Return the path to the array store for a given hash."""
+        return os.path.join(cache_dir, "%s.store" % hash_)
+
+    def get_manifest_path(self, cache_dir, hash_):
+        """Return the path to the manifest for a given hash."""
+        return os.path.join(cache_dir, "%s.manifest.yml" % hash_)
+
+    def read_manifest(self, cache_dir, hash_):
+        """Return the manifest for the cache with a given hash.
+
+        Returns the manifest as a dictionary, or None if the cache has no
+        manifest.
+        """
+        path = self.get_manifest_path(cache_dir, hash_)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as fh:
+            return yaml.safe_load(fh)
+
+    def write_manifest(self, cache_dir, hash_, config, keys):
+        """Write the manifest for the cache with a given hash.
+
+        The manifest records the version of the cache format, the single
+        feature configuration `config` the cache was created for, the number of
+        photos in the cache and a hash of their keys `keys`, and the times at
+        which the cache was created and last updated.
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        manifest = self.read_manifest(cache_dir, hash_) or {'created': now}
+        data, preprocess = get_config_hashables(config)
+        keys = sorted(str(k) for k in keys)
+
+        manifest.update({
+            'version': CACHE_VERSION,
+            'key': str(hash_),
+            'feature': vars(config.features).keys()[0],
+            'config': {
+                'features': _as_dict(config.features),
+                'data': _as_dict(data),
+                'preprocess': _as_dict(preprocess)
+            },
+            'photos': len(keys),
+            'photo_set': stable_hash(keys),
+            'updated': now
+        })
+
+        with open(self.get_manifest_path(cache_dir, hash_), 'w') as fh:
+            yaml.safe_dump(manifest, fh, default_flow_style=False)
+
+    def is_stale(self, cache_dir, hash_):
+        """Return True if the cache with a given hash must be recreated.
+
+        A cache is stale if its manifest was written for a different version
+        of the cache format. Caches without a manifest are not stale.
+        """
+        manifest = self.read_manifest(cache_dir, hash_)
+        return manifest is not None and \
+            manifest.get('version') != CACHE_VERSION
+
+    def get_cached_keys(self, cache_dir, hash_):
+        """Return the keys of the phenotypes in the cache for a given hash.
+
+        Unlike :meth:`get_features`, this does not load the features. Returns
+        None if the cache could not be found.
+        """
+        store_path = self.get_store_path(cache_dir, hash_)
+        if ArrayStore.exists(store_path):
+            return open_store(store_path).keys()
+
+        try:
+            cache = shelve.open(os.path.join(cache_dir, str(hash_)), 'r')
+        except:
+            return None
+        keys = cache.keys()
+        cache.close()
+        return keys
+
+    def get_cache_files(self, cache_dir):
+        """Return the files in a cache directory grouped by cache key.
+
+        A cache may consist of several files and directories, e.g. a shelve,
+        an array store and a manifest. Returns a dictionary ``{key:
+        [filename, ..]}``. Files that do not belong to a cache are ignored.
+        """
+        files = {}
+        for filename in sorted(os.listdir(cache_dir)):
+            key = filename.split('.')[0]
+            if CACHE_KEY_PATTERN.match(key):
+                files.setdefault(key, []).append(filename)
+        return files
+
+    def remove_cache(self, cache_dir, hash_):
+        """Delete all files of the cache with a given hash.
+
+        Returns the list of file names that were removed.
+        """
+        filenames = self.get_cache_files(cache_dir).get(str(hash_), [])
+        for filename in filenames:
+            path = os.path.join(cache_dir, filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        return filenames
+
     def get_phenotype(self, key):
         """Return the phenotype for key `key`.
 
         The `key` is whatever was used as a key for storing the cache for each
         feature. Method :meth:`load_cache` must be called before calling this
-        method.
+        method. The phenotype is returned as a NumPy array with the data type
+        set in the configurations. Features that do not have a fixed length
+        (see :data:`RAGGED_FEATURES`) are returned as they were stored, and
+        cannot be combined with other features. Binary descriptors (see
+        :data:`BINARY_FEATURES`) are returned as bytes.
         """
         if not self._cache:
             raise ValueError("Cache is not loaded")
-        phenotype = []
-        for name in sorted(self._cache.keys()):
-            phenotype.extend(self._cache[name][str(key)])
+
+        names = sorted(self._cache.keys())
+        features = [np.asarray(self._cache[name][str(key)],
+            dtype=np.uint8 if name in BINARY_FEATURES else self.dtype) \
+            for name in names]
+        if len(features) == 1:
+            return np.array(features[0])
+
+        for name in names:
+            if name in RAGGED_FEATURES:
+                raise ValueError("Feature `%s` cannot be combined with " \
+                    "other features" % name)
+
+        # Copy the features into a single array.
+        phenotype = np.empty(sum(f.size for f in features), dtype=self.dtype)
+        start = 0
+        for f in features:
+            phenotype[start:start + f.size] = f.ravel()
+            start += f.size
         return phenotype
 
-    def make(self, image_dir, cache_dir, config, update=False):
+    def get_phenotypes(self, keys):
+        """Return the phenotypes for keys `keys` as a matrix.
+
+        Row `i` of the returned matrix is the phenotype for ``keys[i]``, as
+        returned by :meth:`get_phenotype`. The rows of each feature are read
+        from its cache at once. Method :meth:`load_cache` must be called
+        before calling this method. Features that do not have a fixed length
+        (see :data:`RAGGED_FEATURES`) are not supported.
+        """
+        if not self._cache:
+            raise ValueError("Cache is not loaded")
+
+        keys = [str(k) for k in keys]
+        names = sorted(self._cache.keys())
+        blocks = []
+        for name in names:
+            if name in RAGGED_FEATURES:
+                raise ValueError("Feature `%s` does not have a fixed " \
+                    "length" % name)
+            cache = self._cache[name]
+            dtype = np.uint8 if name in BINARY_FEATURES else self.dtype
+            if isinstance(cache, ArrayStore):
+                rows = [cache.row(k) for k in keys]
+                block = np.asarray(np.asarray(cache.get_matrix())[rows],
+                    dtype=dtype)
+            else:
+                block = np.array([np.asarray(cache[k], dtype=dtype).ravel() \
+                    for k in keys], dtype=dtype)
+                if not keys:
+                    block = np.empty((0, 0), dtype=dtype)
+            blocks.append(block.reshape(len(keys), -1))
+
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.hstack(blocks).astype(self.dtype, copy=False)
+
+    def has_phenotype(self, key):
+        """Return True if all loaded caches have a phenotype for key `key`."""
+        if not self._cache:
+            raise ValueError("Cache is not loaded")
+        return all(str(key) in cache for cache in self._cache.values())
+
+    def get_descriptors(self, name, keys):
+        """Return the local descriptors for keys `keys` without copying them.
+
+        Returns the descriptors of feature `name` (see
+        :data:`RAGGED_FEATURES`) for the keys `keys` as a 3-tuple ``(matrix,
+        rows, counts)``, where `rows` are the numbers of the rows of `matrix`
+        with the descriptors, in the order of the keys, and `counts` is the
+        number of descriptors for each key. If `rows` is None, all rows of
+        `matrix` are used. Method :meth:`load_cache` must be called
+        before calling this method. For caches in a
+        :class:`~nbclassify.store.RaggedArrayStore`, `matrix` is the
+        memory-mapped matrix of the cache, so the descriptors are only read
+        from disk when rows are accessed. If none of the keys have
+        descriptors, `matrix` has no rows.
+        """
+        if not self._cache:
+            raise ValueError("Cache is not loaded")
+        cache = self._cache[name]
+        keys = [str(k) for k in keys]
+        if isinstance(cache, RaggedArrayStore):
+            counts = [cache.count(k) for k in keys]
+            return (cache.get_matrix(), cache.row_indices(keys), counts)
+        descriptors = [np.asarray(cache[k]) for k in keys \
+            if cache[k] is not None]
+        counts = [0 if cache[k] is None else len(cache[k]) for k in keys]
+        if not descriptors:
+            return (self._empty_descriptors(cache), None, counts)
+        return (np.concatenate(descriptors), None, counts)
+
+    def _empty_descriptors(self, cache):
+        """Return an empty matrix for the descriptors in cache `cache`.
+
+        The number of columns and the data type are those of the first
+        descriptors found in the cache, or 0 columns of float32 if the cache
+        has no descriptors.
+        """
+        for key in cache:
+            if cache[key] is not None:
+                value = np.asarray(cache[key])
+                return np.empty((0, value.shape[-1]), dtype=value.dtype)
+        return np.empty((0, 0), dtype=np.float32)
+
+    def make(self, image_dir, cache_dir, config, update=False, workers=1):
         """Cache features for an image directory to disk.
 
-        One cache file is created for each feature configuration set in the
+        One cache is created for each feature configuration set in the
         configurations. The caches are saved in the target directory
-        `cache_dir`. Each cache file is a Python shelve, a persistent,
-        dictionary-like object. If `update` is set to True, existing features
-        are updated. Method :meth:`get_phenotype` can then be used to retrieve
-        these features and combined them to phenotypes.
+        `cache_dir`. Features with a fixed length are stored in an
+        :class:`~nbclassify.store.ArrayStore`; local descriptors (e.g. SURF
+        descriptors) are stored in a
+        :class:`~nbclassify.store.RaggedArrayStore`, in the data type returned
+        by :meth:`get_descriptor_dtype`. Features in a legacy cache file, a
+        Python shelve, are imported into the store. If `update` is set to
+        True, existing features are updated. Method :meth:`get_phenotype` can
+        then be used to retrieve these features and combined them to
+        phenotypes.
+
+        All features for a photo are extracted in a single pass, so that each
+        image is loaded and preprocessed only once for all the features that
+        share the same preprocessing settings.
+
+        If `workers` is larger than 1, features are extracted in that many
+        threads (see :meth:`Phenotyper.make_batch`). The results are written
+        to the cache by the calling thread only, in the same order as the
+        photos are processed serially. Photos for which feature extraction
+        fails are logged and skipped.
+
+        Stale caches (see :meth:`is_stale`) are deleted and created again. A
+        manifest is written for each cache (see :meth:`write_manifest`).
         """
         session, metadata = db.get_session_or_error()
 
-        phenotyper = Phenotyper()
+        if workers < 1:
+            raise ValueError("The number of workers must be at least 1")
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Caches opened by load_cache are out of date once updated.
+        self._stores = {}
 
         # Get a list of all the photos in the database.
         photos = db.get_photos(session, metadata)
 
-        # Cache each feature for each photo separately. One cache per
-        # feature type is created, and each cache contains the features
-        # for all images.
+        # Open the caches. One cache per feature type is created, and each
+        # cache contains the features for all images.
+        hashes = []
+        configs = []
+        caches = []
         for hash_, c in self.get_single_feature_configurations(config):
-            if not os.path.isdir(cache_dir):
-                os.makedirs(cache_dir)
+            if self.is_stale(cache_dir, hash_):
+                logging.info("Cache %s is stale and will be created again",
+                    hash_)
+                self.remove_cache(cache_dir, hash_)
+
+            name, args = vars(c.features).items()[0]
+            cache_path = self.get_store_path(cache_dir, hash_)
+            legacy = None
+            if not ArrayStore.exists(cache_path):
+                legacy = self.get_features(cache_dir, hash_)
+            if name in RAGGED_FEATURES:
+                cache = RaggedArrayStore(cache_path,
+                    get_descriptor_dtype(name, args, config))
+            else:
+                cache = ArrayStore(cache_path, get_phenotype_dtype(config))
 
-            cache_path = os.path.join(cache_dir, str(hash_))
+            # Import the features from a legacy cache file, if any.
+            if legacy:
+                for key, phenotype in legacy.iteritems():
+                    if phenotype is not None:
+                        cache[key] = phenotype
             sys.stderr.write("Caching features in `%s`...\n" % cache_path)
 
-            # Create a shelve for storing features. Empty existing shelves.
-            cache = shelve.open(cache_path)
-
-            # Set the new config.
-            phenotyper.set_config(c)
+            hashes.append(hash_)
+            configs.append(c)
+            caches.append(cache)
+
+        # Get the photos and the features that must be extracted. Skip feature
+        # extraction if the feature already exists, unless update is set to
+        # True.
+        keys = []
+        paths = []
+        indices = []
+        for photo in photos:
+            key = str(photo.md5sum)
+            missing = [i for i, cache in enumerate(caches) \
+                if update or key not in cache]
+            if missing:
+                keys.append(key)
+                paths.append(os.path.join(image_dir, photo.path))
+                indices.append(missing)
+
+        logging.info("Extracting %d features from %d photos",
+            sum(len(x) for x in indices), len(paths))
 
-            # Cache the feature for each photo.
-            for photo in photos:
-                # Skip feature extraction if the feature already exists, unless
-                # update is set to True.
-                if not update and str(photo.md5sum) in cache:
+        phenotyper = Phenotyper()
+        results = phenotyper.make_batch(paths, workers=workers,
+            configs=[[configs[i] for i in x] for x in indices])
+
+        # Cache the features for each photo.
+        failed = 0
+        for key, indices_, (im_path, phenotypes) in zip(keys, indices,
+                results):
+            ok = True
+            for i, phenotype in zip(indices_, phenotypes):
+                if isinstance(phenotype, Exception):
+                    logging.error("Failed to process `%s` for cache %s: " \
+                        "%s: %s", im_path, hashes[i],
+                        type(phenotype).__name__, phenotype)
+                    ok = False
                     continue
+                caches[i][key] = phenotype
+
+            if ok:
+                logging.info("Processed photo %s", im_path)
+            else:
+                failed += 1
+
+        if failed:
+            logging.warning("Feature extraction failed for %d photos", failed)
+
+        for hash_, c, cache in zip(hashes, configs, caches):
+            self.write_manifest(cache_dir, hash_, c, cache.keys())
+            cache.close()
+
+    def status(self, cache_dir, config):
+        """Compare the caches for a configuration with the photos.
+
+        Must be used within a database session scope. For each feature
+        configuration in `config`, the cache in directory `cache_dir` is
+        compared with the photos in the database. Returns a list of
+        dictionaries, one per cache, with the following keys:
+
+        * ``key``: The cache key.
+        * ``feature``: The name of the feature.
+        * ``exists``: True if the cache exists.
+        * ``stale``: True if the cache must be created again.
+        * ``cached``: The number of photos in the cache.
+        * ``missing``: The number of photos for which features must be
+          extracted by :meth:`make`.
+        * ``orphans``: The number of photos in the cache that are no longer in
+          the database. These are removed by :meth:`gc`.
+        * ``updated``: When the cache was last updated, or None if unknown.
+        """
+        session, metadata = db.get_session_or_error()
+
+        photos = set(str(p.md5sum) for p in db.get_photos(session, metadata))
 
-                logging.info("Processing photo %s...", photo.id)
-                
-                # Extract a feature and cache it.
-                im_path = os.path.join(image_dir, photo.path)
-                phenotyper.set_image(im_path)
-                cache[str(photo.md5sum)] = phenotyper.make()
+        status = []
+        for hash_, c in self.get_single_feature_configurations(config):
+            keys = self.get_cached_keys(cache_dir, hash_)
+            manifest = self.read_manifest(cache_dir, hash_) or {}
+            stale = self.is_stale(cache_dir, hash_)
+            cached = set() if stale else set(keys or [])
+
+            status.append({
+                'key': hash_,
+                'feature': vars(c.features).keys()[0],
+                'exists': keys is not None,
+                'stale': stale,
+                'cached': len(cached),
+                'missing': len(photos - cached),
+                'orphans': len(cached - photos),
+                'updated': manifest.get('updated')
+            })
+
+        return status
+
+    def gc(self, cache_dir, configs, dry_run=False):
+        """Remove cached features that are no longer used.
+
+        Must be used within a database session scope. Deletes the caches in
+        directory `cache_dir` that do not belong to any of the configurations
+        in the list `configs`. Caches created by older versions that were not
+        migrated with :meth:`migrate` are kept if they belong to one of the
+        configurations. From the remaining caches the features of photos that
+        are no longer in the database are removed, and array stores are
+        compacted. If `dry_run` is True, nothing is changed.
+
+        Returns a 2-tuple ``(removed, pruned)``, where `removed` is the list of
+        file names that were (or would be) removed, and `pruned` is a
+        dictionary ``{key: n}`` with the number of entries that were (or would
+        be) removed from each cache.
+        """
+        session, metadata = db.get_session_or_error()
 
+        photos = set(str(p.md5sum) for p in db.get_photos(session, metadata))
+
+        # Get the keys for the caches that are in use.
+        used = {}
+        for config in configs:
+            for hash_, c in self.get_single_feature_configurations(config):
+                feature = vars(c.features).values()[0]
+                legacy_hash = combined_hash(feature, *get_config_hashables(c))
+                used[str(hash_)] = c
+                used[str(legacy_hash)] = None
+
+        # Delete caches that are not in use.
+        removed = []
+        for key, filenames in self.get_cache_files(cache_dir).iteritems():
+            if key in used:
+                continue
+            if dry_run:
+                removed.extend(filenames)
+            else:
+                removed.extend(self.remove_cache(cache_dir, key))
+
+        # Remove features for photos that are no longer in the database.
+        pruned = {}
+        for key, c in used.iteritems():
+            if c is None:
+                continue
+
+            store_path = self.get_store_path(cache_dir, key)
+            if ArrayStore.exists(store_path):
+                cache = open_store(store_path)
+                keep = [k for k in cache.keys() if k in photos]
+                n = len(cache) - len(keep) + cache.stale_rows()
+                if n and not dry_run:
+                    cache.compact(keep)
+            else:
+                try:
+                    cache = shelve.open(os.path.join(cache_dir, key),
+                        'r' if dry_run else 'w')
+                except:
+                    continue
+                orphans = [k for k in cache.keys() if k not in photos]
+                n = len(orphans)
+                if not dry_run:
+                    for k in orphans:
+                        del cache[k]
+
+            if n:
+                pruned[key] = n
+                if not dry_run:
+                    self.write_manifest(cache_dir, key, c, cache.keys())
             cache.close()
 
+        return (removed, pruned)
+
+    def migrate(self, cache_dir, config):
+        """Rename caches created by older versions of this package.
+
+        Older versions named the caches in directory `cache_dir` after a hash
+        that depends on the Python interpreter (see
+        :meth:`~nbclassify.functions.combined_hash`). This renames the caches
+        for the feature configurations in `config` to their stable cache keys.
+        Caches can only be found if this is executed with the same Python
+        interpreter build that created them. Returns a list of 2-tuples
+        ``(old_name, new_name)`` for the caches that were renamed.
+        """
+        renamed = []
+        for hash_, c in self.get_single_feature_configurations(config):
+            feature = vars(c.features).values()[0]
+            legacy_hash = str(combined_hash(feature, *get_config_hashables(c)))
+
+            # A shelve may consist of multiple files, depending on the
+            # database backend.
+            for filename in sorted(os.listdir(cache_dir)):
+                root, ext = os.path.splitext(filename)
+                if root != legacy_hash:
+                    continue
+                new_name = str(hash_) + ext
+                if os.path.exists(os.path.join(cache_dir, new_name)):
+                    logging.warning("Not renaming `%s`: `%s` already exists",
+                        filename, new_name)
+                    continue
+                os.rename(os.path.join(cache_dir, filename),
+                    os.path.join(cache_dir, new_name))
+                renamed.append((filename, new_name))
+
+        return renamed
+
     def load_cache(self, cache_dir, config):
         """Load cache for a feature extraction configuration.
 
@@ -180,6 +791,10 @@ class PhenotypeCache(object):
         configurations object `config`. This function does not traverse the
         classification hierarchy, so this function must be called once for each
         features configuration before calling :meth:`get_phenotype`.
+
+        Each cache is opened only once, so loading the cache again for the
+        same features, e.g. for another level of the classification
+        hierarchy, does not read it from disk again.
         """
         try:
             features = config.features
@@ -187,13 +802,92 @@ class PhenotypeCache(object):
             raise ConfigurationError("features not set")
 
         self._cache = {}
+        self.dtype = get_phenotype_dtype(config)
         for name, feature in vars(features).iteritems():
-            hashables = get_config_hashables(config)
-            hash_ = combined_hash(feature, *hashables)
-            cache = self.get_features(cache_dir, hash_)
-            if not cache:
-                raise IOError("Cache {0} not found".format(hash_))
-            self._cache[name] = cache
+            hash_ = get_feature_cache_key(name, feature, config)
+            key = (os.path.abspath(cache_dir), hash_)
+            if key not in self._stores:
+                cache = self.get_features(cache_dir, hash_)
+                if not cache:
+                    raise IOError("Cache {0} not found".format(hash_))
+                self._stores[key] = cache
+            self._cache[name] = self._stores[key]
+
+class ExtractionContext(object):
+
+    """Intermediate results for extracting features from an image.
+
+    Several feature extractors need the same intermediate results, such as the
+    largest contour of the binary mask, the masked image, or the image in
+    another color space. An extraction context computes each of these when it
+    is first needed, and keeps it for the other extractors, so that each is
+    computed at most once per image. A context must only be used for the
+    image `img` and the binary mask `bin_mask` it was created for, and the
+    returned objects must not be modified.
+    """
+
+    # Color conversion codes for :meth:`get_image`.
+    CONVERSIONS = {
+        'gray': cv2.COLOR_BGR2GRAY,
+        'hsv': cv2.COLOR_BGR2HSV,
+        'luv': cv2.COLOR_BGR2LUV
+    }
+
+    def __init__(self, img, bin_mask=None):
+        self.img = img
+        self.bin_mask = bin_mask
+        self._contours = {}
+        self._masked = None
+        self._images = {}
+
+    def get_contour(self, method=cv2.CHAIN_APPROX_SIMPLE):
+        """Return the largest contour of the binary mask.
+
+        The contour approximation `method` is one of the ``CHAIN_APPROX_*``
+        methods of OpenCV. Raises a ValueError if the binary mask is not set
+        or if it has no contours.
+        """
+        if method not in self._contours:
+            if self.bin_mask is None:
+                raise ValueError("Binary mask cannot be None")
+            contour = ft.get_largest_contour(self.bin_mask.copy(),
+                cv2.RETR_EXTERNAL, method)
+            if contour is None:
+                raise ValueError("No contour found for binary image")
+            self._contours[method] = contour
+        return self._contours[method]
+
+    def get_masked_image(self):
+        """Return the image with the background set to black.
+
+        Raises a ValueError if the binary mask is not set.
+        """
+        if self._masked is None:
+            if self.bin_mask is None:
+                raise ValueError("Binary mask cannot be None")
+            self._masked = cv2.bitwise_and(self.img, self.img,
+                mask=self.bin_mask)
+        return self._masked
+
+    def get_image(self, colorspace='bgr', masked=False):
+        """Return the image in color space `colorspace`.
+
+        The color space can be ``bgr`` (the image itself), ``gray``, ``hsv``
+        or ``luv``. If `masked` is True, the masked image (see
+        :meth:`get_masked_image`) is converted instead.
+        """
+        colorspace = colorspace.lower()
+        key = (colorspace, masked)
+        if key not in self._images:
+            src = self.get_masked_image() if masked else self.img
+            if colorspace == 'bgr':
+                img = src
+            elif colorspace in self.CONVERSIONS:
+                img = cv2.cvtColor(src, self.CONVERSIONS[colorspace])
+            else:
+                raise ValueError("Unknown colorspace '%s'" % colorspace)
+            self._images[key] = img
+        return self._images[key]
 
 class Phenotyper(object):
     """Extract features from a digital image and return as a phenotype.
@@ -203,8 +897,8 @@ class Phenotyper(object):
     configuration object as returned by
     :meth:`~nbclassify.functions.open_config`. Then :meth:`make` can be called
     to extract the features as specified in the configurations object and return
-    the phenotype. A single phenotypes is returned, which is a list of floating
-    point numbers.
+    the phenotype. A single phenotypes is returned, which is a NumPy array of
+    floating point numbers.
     """
 
     def __init__(self):
@@ -216,32 +910,108 @@ class Phenotyper(object):
         self.bin_mask = None
         self.roi = None
         self.scaler = None
+        self.dtype = np.dtype(PHENOTYPE_DTYPE)
+
+        # Intermediate results for feature extraction from the preprocessed
+        # image.
+        self.context = None
+
+        # The region of the image to use, and the ROI before preprocessing.
+        self._crop = None
+        self._roi_source = None
+
+        # Decoded images for the image path, keyed by the reduction factor.
+        self._decoded = {}
+
+        # Preprocessing results for the loaded image, keyed by the hash of
+        # the preprocessing settings.
+        self._preprocessed = {}
 
     def set_image(self, path, roi=None):
-        """Load the image from path `path`.
+        """Set the image at path `path` as the image to extract features from.
 
         If a region of interest `roi` is set, only that region is used for
         image processing. The ROI must be a 4-tuple ``(y,y2,x,x2)``. Image
-        related attributes are reset. Returns the image object.
+        related attributes are reset.
+
+        The image is decoded by :meth:`make`, because the resolution at which
+        it is decoded depends on the preprocessing settings (see
+        :meth:`get_decode_factor`).
         """
-        self.img = cv2.imread(path)
-        if self.img is None or self.img.size == 0:
-            raise IOError("Failed to read image %s" % path)
+        if not os.path.isfile(path):
+            raise IOError("Cannot open %s (no such file)" % path)
         if roi and len(roi) != 4:
             raise ValueError("ROI must be a list of four integers")
 
-        # If a ROI was provided, use only that region.
-        if roi:
-            y, y2, x, x2 = roi
-            self.img = self.img[y:y2, x:x2]
-
         # Reset image related variables so one instance can be used for multiple
         # images.
         self.path = path
+        self.img = None
         self.mask = None
         self.bin_mask = None
+        self.context = None
+        self._crop = tuple(roi) if roi else None
+        self._decoded = {}
+        self._preprocessed = {}
+
+    def get_decode_factor(self):
+        """Return the factor by which the image is reduced when decoded.
+
+        Decoding a large JPEG image at a reduced size is much faster and uses
+        less memory than decoding it at full size. This is only done if
+        ``preprocess.reduced_decode`` is enabled and
+        ``preprocess.maximum_perimeter`` is set. The largest factor of 2, 4 or
+        8 is returned for which the perimeter of the image, or of the ROI if
+        one is set, is still at least the maximum perimeter, so that the image
+        is scaled down to the maximum perimeter afterwards like before.
+        Returns 1 if the image must be decoded at full size.
+        """
+        try:
+            preprocess = self.config.preprocess
+        except AttributeError:
+            return 1
 
-        return self.img
+        max_perim = getattr(preprocess, 'maximum_perimeter', None)
+        if not (max_perim and getattr(preprocess, 'reduced_decode', False)):
+            return 1
+
+        if self._roi_source:
+            perim = sum(self._roi_source[2:4])
+        elif self._crop:
+            y, y2, x, x2 = self._crop
+            perim = (y2 - y) + (x2 - x)
+        else:
+            size = get_image_size(self.path)
+            if not size:
+                return 1
+            perim = sum(size)
+
+        factor = 1
+        for f in sorted(IMREAD_FLAGS):
+            if perim / f >= max_perim:
+                factor = f
+        return factor
+
+    def __decode(self, factor):
+        """Return the image decoded at 1/`factor` of its size.
+
+        Decoded images are kept until a new image is set, so that an image is
+        decoded only once for each factor.
+        """
+        if factor in self._decoded:
+            return self._decoded[factor]
+
+        img = cv2.imread(self.path, IMREAD_FLAGS[factor])
+        if img is None or img.size == 0:
+            raise IOError("Failed to read image %s" % self.path)
+
+        # If a ROI was provided, use only that region.
+        if self._crop:
+            y, y2, x, x2 = [v // factor for v in self._crop]
+            img = img[y:y2, x:x2]
+
+        self._decoded[factor] = img
+        return img
 
     def set_config(self, config):
         """Set the configurations object.
@@ -264,6 +1034,7 @@ class Phenotyper(object):
         except AttributeError:
             self.scaler = None
 
+        self.dtype = get_phenotype_dtype(config)
         self.config = config
 
     def set_norm_minmax(self, a=0, b=1):
@@ -281,8 +1052,8 @@ class Phenotyper(object):
     def set_roi(self, roi):
         """Set the region of interest for the image.
 
-        If GrabCut is set as the segmentation algorithm, then GrabCut is
-        executed with this region of interest.
+        If segmentation is set, the segmentation backend is executed with this
+        region of interest.
 
         The ROI must be a 4-tuple ``(x, y, width, height)``.
         """
@@ -293,38 +1064,8 @@ class Phenotyper(object):
                 if not (isinstance(x, int) and x >= 0):
                     raise ValueError("ROI must be a (x, y, w, h) tuple")
         self.roi = roi
-
-    def __grabcut(self, img, iters=5, roi=None, margin=5):
-        """Wrapper for OpenCV's grabCut function.
-
-        Runs the GrabCut algorithm for segmentation. Returns an 8-bit single-
-        channel mask. Its elements may have the following values:
-
-        * ``cv2.GC_BGD`` defines an obvious background pixel
-        * ``cv2.GC_FGD`` defines an obvious foreground pixel
-        * ``cv2.GC_PR_BGD`` defines a possible background pixel
-        * ``cv2.GC_PR_FGD`` defines a possible foreground pixel
-
-        The GrabCut algorithm is executed with `iters` iterations. The region of
-        interest `roi` can be a 4-tuple ``(x, y, width, height)``. If the ROI is
-        not set, the ROI is set to the entire image, with a margin of `margin`
-        pixels from the borders.
-
-        This method is indirectly executed by :meth:`make`.
-        """
-        mask = np.zeros(img.shape[:2], np.uint8)
-        bgdmodel = np.zeros((1,65), np.float64)
-        fgdmodel = np.zeros((1,65), np.float64)
-
-        # Use the margin to set the ROI if the ROI was not provided.
-        if not roi:
-            h, w = img.shape[:2]
-            roi = (margin, margin, w - margin * 2, h - margin * 2)
-
-        cv2.grabCut(img, mask, roi, bgdmodel, fgdmodel, iters,
-            cv2.GC_INIT_WITH_RECT)
-
-        return mask
+        self._roi_source = roi
+        self._preprocessed = {}
 
     def __preprocess(self):
         """Perform preprocessing steps as specified in the configurations.
@@ -335,10 +1076,41 @@ class Phenotyper(object):
         * Color correction
         * Segmentation or cropping
 
+        Preprocessing always starts from the image as it was decoded. The
+        results are kept for the image, so that extracting features with
+        different configurations, but with the same preprocessing settings,
+        only preprocesses the image once. This includes the extraction
+        context (see :class:`ExtractionContext`) for the preprocessed image.
+
         This method is executed by :meth:`make`.
         """
-        if self.img is None:
-            raise RuntimeError("No image is loaded")
+        if self.path is None:
+            raise RuntimeError("No image is set")
+
+        key = stable_hash(get_config_hashables(self.config)[1])
+        if key in self._preprocessed:
+            self.img, self.mask, self.bin_mask, self.roi, self.context = \
+                self._preprocessed[key]
+            return
+
+        factor = self.get_decode_factor()
+        self.img = self.__decode(factor)
+        self.mask = None
+        self.bin_mask = None
+        self.roi = self._roi_source
+
+        # Account for the reduction factor if a ROI is set.
+        if self.roi and factor > 1:
+            self.roi = tuple(x // factor for x in self.roi)
+
+        self.__preprocess_image()
+        self.context = ExtractionContext(self.img, self.bin_mask)
+
+        self._preprocessed[key] = (self.img, self.mask, self.bin_mask,
+            self.roi, self.context)
+
+    def __preprocess_image(self):
+        """Perform the preprocessing steps on the loaded image."""
         if 'preprocess' not in self.config:
             return
 
@@ -376,22 +1148,27 @@ class Phenotyper(object):
 
         # Perform segmentation.
         try:
-            segmentation = self.config.preprocess.segmentation.grabcut
-        except:
-            segmentation = {}
+            segmentation = [(method, options) for method, options in \
+                vars(self.config.preprocess.segmentation).iteritems() \
+                if options is not None]
+        except (AttributeError, TypeError):
+            segmentation = []
+
+        if len(segmentation) > 1:
+            raise ConfigurationError("Only one segmentation method can be set")
 
         if segmentation:
             logging.info("Segmenting...")
-            iters = getattr(segmentation, 'iters', 5)
-            margin = getattr(segmentation, 'margin', 1)
-            output_folder = getattr(segmentation, 'output_folder', None)
+            method, options = segmentation[0]
+            options = _as_dict(options)
+            if not isinstance(options, dict):
+                options = {}
+            output_folder = options.pop('output_folder', None)
 
             # Get the main contour.
-            self.mask = self.__grabcut(self.img, iters, self.roi, margin)
-            self.bin_mask = np.where((self.mask==cv2.GC_FGD) + \
-                (self.mask==cv2.GC_PR_FGD), 255, 0).astype('uint8')
-            contour = ft.get_largest_contour(self.bin_mask, cv2.RETR_EXTERNAL,
-                cv2.CHAIN_APPROX_SIMPLE)
+            self.mask = segment(self.img, method, self.roi, **options)
+            contour = ft.get_largest_contour(self.mask.copy(),
+                cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             if contour is None:
                 raise ValueError("No contour found for binary image")
 
@@ -469,10 +1246,18 @@ class Phenotyper(object):
 
         Performs any image preprocessing if necessary and the image features
         are extracted as specified in the configurations. Finally the
-        phenotype is returned as a list of floating point values.
+        phenotype is returned as a NumPy array with the data type set in the
+        configurations (see :meth:`get_phenotype_dtype`). The values of each
+        feature are copied into the array at the offsets returned by
+        :meth:`get_feature_layout`.
+
+        Features that do not have a fixed length (see :data:`RAGGED_FEATURES`)
+        cannot be combined with other features; for these the phenotype is
+        the array returned by the feature extractor. Binary descriptors (see
+        :data:`BINARY_FEATURES`) are returned as bytes.
         """
-        if self.img is None:
-            raise ValueError("No image was loaded")
+        if self.path is None:
+            raise ValueError("No image was set")
         if self.config is None:
             raise ValueError("Configurations are not set")
 
@@ -482,53 +1267,140 @@ class Phenotyper(object):
         logging.info("Extracting features...")
 
         # Construct the phenotype.
-        phenotype = []
-        for name in sorted(vars(self.config.features).keys()):
+        layout = get_feature_layout(self.config.features)
+        ragged = [name for name, start, stop, columns in layout \
+            if name in RAGGED_FEATURES]
+        if ragged and len(layout) > 1:
+            raise ValueError("Feature `%s` cannot be combined with other " \
+                "features" % ragged[0])
+
+        phenotype = np.empty(layout[-1][2] if layout else 0, dtype=self.dtype)
+        for name, start, stop, columns in layout:
             args = self.config.features[name]
 
             if name == 'color_histograms':
                 logging.info("- Running color:histograms...")
-                data = self.__get_color_histograms(self.img, args, self.bin_mask)
-                phenotype.extend(data)
+                data = self.__get_color_histograms(args, self.bin_mask)
 
             elif name == 'color_bgr_means':
                 logging.info("- Running color:bgr_means...")
-                data = self.__get_color_bgr_means(self.img, args, self.bin_mask)
-                phenotype.extend(data)
+                data = self.__get_color_bgr_means(args)
 
             elif name == 'shape_outline':
                 logging.info("- Running shape:outline...")
-                data = self.__get_shape_outline(args, self.bin_mask)
-                phenotype.extend(data)
+                data = self.__get_shape_outline(args)
 
             elif name == 'shape_360':
                 logging.info("- Running shape:360...")
-                data = self.__get_shape_360(args, self.bin_mask)
-                phenotype.extend(data)
+                data = self.__get_shape_360(args)
 
             elif name == 'surf':
                 logging.info("- Running feature:surf...")
-                data = self.__get_surf_features(args, self.img)
-                phenotype.extend(data)
+                data = self.__get_surf_features(args)
 
-            else:
-                raise ValueError("Unknown feature `%s`" % name)
+            elif name == 'orb':
+                logging.info("- Running feature:orb...")
+                data = self.__get_orb_features(args)
+
+            if name in BINARY_FEATURES:
+                return np.asarray(data, dtype=np.uint8)
+            if name in RAGGED_FEATURES:
+                return np.asarray(data, dtype=self.dtype)
+
+            data = np.asarray(data).ravel()
+            if len(data) != stop - start:
+                raise ValueError("Expected %d values for feature `%s`, got " \
+                    "%d" % (stop - start, name, len(data)))
+            phenotype[start:stop] = data
 
         return phenotype
 
-    def __get_color_histograms(self, src, args, bin_mask=None):
+    def make_batch(self, paths, rois=None, workers=1, configs=None):
+        """Return the phenotypes for a batch of images.
+
+        This is a generator that yields a 2-tuple ``(path, phenotype)`` for
+        each image path in `paths`, in the same order. Images are decoded,
+        preprocessed, and their features are extracted in a pool of `workers`
+        threads, each with its own phenotyper. Most of the time is spent in
+        OpenCV routines that release the global interpreter lock, so the
+        threads run in parallel. If `rois` is set, it is a list with a region
+        of interest for each path (see :meth:`set_roi`).
+
+        Features are extracted with the configurations set with
+        :meth:`set_config`. If `configs` is set, it is a list with for each
+        path a list of configurations instead, and the phenotype is a list
+        with the phenotype for each of these configurations. The image is
+        then loaded once, and configurations with the same preprocessing
+        settings share the preprocessed image.
+
+        If feature extraction fails, the exception is yielded instead of the
+        phenotype, so that a single bad image does not abort the whole batch.
+        """
+        if workers < 1:
+            raise ValueError("The number of workers must be at least 1")
+        if configs is None and self.config is None:
+            raise ValueError("Configurations are not set")
+        if rois is None:
+            rois = [None] * len(paths)
+        if configs is None:
+            tasks = [(p, r, [self.config]) for p, r in zip(paths, rois)]
+        else:
+            tasks = zip(paths, rois, configs)
+
+        local = threading.local()
+
+        def extract(task):
+            path, roi, configs_ = task
+            phenotyper = getattr(local, 'phenotyper', None)
+            if phenotyper is None:
+                phenotyper = local.phenotyper = Phenotyper()
+
+            try:
+                phenotyper.set_image(path)
+                phenotyper.set_roi(roi)
+            except Exception as e:
+                if conf.debug: raise
+                return (path, [e] * len(configs_))
+
+            phenotypes = []
+            for config in configs_:
+                try:
+                    phenotyper.set_config(config)
+                    phenotypes.append(phenotyper.make())
+                except Exception as e:
+                    if conf.debug: raise
+                    phenotypes.append(e)
+            return (path, phenotypes)
+
+        if workers > 1:
+            pool = ThreadPool(workers)
+            results = pool.imap(extract, tasks)
+        else:
+            pool = None
+            results = (extract(task) for task in tasks)
+
+        try:
+            for path, phenotypes in results:
+                if configs is None:
+                    yield (path, phenotypes[0])
+                else:
+                    yield (path, phenotypes)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def __get_color_histograms(self, args, bin_mask=None):
         """Executes :meth:`features.color_histograms`."""
         histograms = []
         for colorspace, bins in vars(args).iteritems():
+            img = self.context.get_image(colorspace)
             if colorspace.lower() == "bgr":
                 colorspace = ft.CS_BGR
-                img = src
             elif colorspace.lower() == "hsv":
                 colorspace = ft.CS_HSV
-                img = cv2.cvtColor(src, cv2.COLOR_BGR2HSV)
             elif colorspace.lower() == "luv":
                 colorspace = ft.CS_LUV
-                img = cv2.cvtColor(src, cv2.COLOR_BGR2LUV)
             else:
                 raise ValueError("Unknown colorspace '%s'" % colorspace)
 
@@ -548,19 +1420,11 @@ class Phenotyper(object):
 
         return histograms
 
-    def __get_color_bgr_means(self, src, args, bin_mask=None):
+    def __get_color_bgr_means(self, args):
         """Executes :meth:`features.color_bgr_means`."""
-        if self.bin_mask is None:
-            raise ValueError("Binary mask cannot be None")
-
-        # Get the contours from the mask.
-        contour = ft.get_largest_contour(bin_mask.copy(), cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_SIMPLE)
-        if contour is None:
-            raise ValueError("No contour found for binary image")
-
-        # Create a masked image.
-        img = cv2.bitwise_and(src, src, mask=bin_mask)
+        # Get the largest contour and the masked image.
+        contour = self.context.get_contour(cv2.CHAIN_APPROX_SIMPLE)
+        img = self.context.get_masked_image()
 
         bins = getattr(args, 'bins', 20)
         hor_means, ver_means = ft.color_bgr_means(img, contour, bins)
@@ -573,30 +1437,20 @@ class Phenotyper(object):
 
         return output
 
-    def __get_shape_outline(self, args, bin_mask):
+    def __get_shape_outline(self, args):
         """Executes :meth:`features.shape_outline`."""
-        if self.bin_mask == None:
-            raise ValueError("Binary mask cannot be None")
-
         k = getattr(args, 'k', 15)
 
-        # Obtain contours (all points) from the mask.
-        contour = ft.get_largest_contour(bin_mask.copy(), cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_NONE)
-        if contour == None:
-            raise ValueError("No contour found for binary image")
+        # Obtain the largest contour (all points) from the mask.
+        contour = self.context.get_contour(cv2.CHAIN_APPROX_NONE)
 
         # Get the outline.
         outline = ft.shape_outline(contour, k)
 
-        # Compute the delta's for the horizontal and vertical point pairs.
-        shape = []
-        for x, y in outline:
-            delta_x = x[0] - x[1]
-            delta_y = y[0] - y[1]
-            shape.append(delta_x)
-            shape.append(delta_y)
-        shape = np.array(shape, dtype=float)
+        # Compute the delta's for the horizontal and vertical point pairs,
+        # in the order delta_x, delta_y for each pair.
+        outline = np.asarray(outline, dtype=float).reshape(-1, 2, 2)
+        shape = (outline[:,:,0] - outline[:,:,1]).ravel()
 
         # Normalize the features if a scaler is set.
         if self.scaler:
@@ -604,21 +1458,16 @@ class Phenotyper(object):
 
         return shape
 
-    def __get_shape_360(self, args, bin_mask):
+    def __get_shape_360(self, args):
         """Executes :meth:`features.shape_360`."""
-        if self.bin_mask == None:
-            raise ValueError("Binary mask cannot be None")
-
         rotation = getattr(args, 'rotation', 0)
         step = getattr(args, 'step', 1)
         t = getattr(args, 't', 8)
-        output_functions = getattr(args, 'output_functions', {'mean_sd': True})
+        output_functions = getattr(args, 'output_functions',
+            Struct({'mean_sd': {}}))
 
         # Get the largest contour from the binary mask.
-        contour = ft.get_largest_contour(bin_mask, cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_NONE)
-        if contour == None:
-            raise ValueError("No contour found for binary image")
+        contour = self.context.get_contour(cv2.CHAIN_APPROX_NONE)
 
         # Set the rotation.
         if rotation == 'FIT_ELLIPSE':
@@ -631,56 +1480,24 @@ class Phenotyper(object):
         # Extract shape feature.
         intersects, center = ft.shape_360(contour, rotation, step, t)
 
-        # Create a masked image.
-        if 'color_histograms' in output_functions:
-            img_masked = cv2.bitwise_and(self.img, self.img, mask=bin_mask)
-
-        # Run the output function for each angle.
+        # Run the output functions for all angles.
+        angles = range(0, 360, step)
         means = []
         sds = []
         histograms = []
-        for angle in range(0, 360, step):
-            for f_name, f_args in vars(output_functions).iteritems():
-                # Mean distance + standard deviation.
-                if f_name == 'mean_sd':
-                    distances = []
-                    for p in intersects[angle]:
-                        d = ft.point_dist(center, p)
-                        distances.append(d)
-
-                    if len(distances) == 0:
-                        mean = 0
-                        sd = 0
-                    else:
-                        mean = np.mean(distances, dtype=np.float32)
-                        if len(distances) > 1:
-                            sd = np.std(distances, ddof=1, dtype=np.float32)
-                        else:
-                            sd = 0
-
-                    means.append(mean)
-                    sds.append(sd)
-
-                # Color histograms.
-                if f_name == 'color_histograms':
-                    # Get a line from the center to the outer intersection point.
-                    line = None
-                    if intersects[angle]:
-                        line = ft.extreme_points([center] + intersects[angle])
-
-                    # Create a mask for the line, where the line is foreground.
-                    line_mask = np.zeros(self.img.shape[:2], dtype=np.uint8)
-                    if line is not None:
-                        cv2.line(line_mask, tuple(line[0]), tuple(line[1]),
-                            255, 1)
-
-                    # Create histogram from masked + line masked image.
-                    hists = self.__get_color_histograms(img_masked, f_args,
-                        line_mask)
-                    histograms.append(hists)
-
-        means = means.astype(float)
-        sds = sds.astype(float)
+        for f_name, f_args in vars(output_functions).iteritems():
+            # Mean distance + standard deviation, for all angles at once.
+            if f_name == 'mean_sd':
+                points, mask = pad_points([intersects[a] for a in angles])
+                means, sds = ray_mean_sd(center, points, mask)
+
+            # Color histograms.
+            if f_name == 'color_histograms':
+                histograms = self.__get_ray_histograms(f_args, center,
+                    intersects, angles)
+
+        means = np.array(means, dtype=float)
+        sds = np.array(sds, dtype=float)
 
         # Normalize the features if a scaler is set.
         if self.scaler and 'mean_sd' in output_functions:
@@ -692,17 +1509,76 @@ class Phenotyper(object):
 
         return np.append(means_sds, histograms)
 
-    def __get_surf_features(self, args, src):
+    def __get_ray_histograms(self, args, center, intersects, angles):
+        """Return the color histograms along the rays of shape_360.
+
+        For each angle in `angles`, the color histograms are computed for the
+        pixels of the masked image on the line from the `center` to the outer
+        point of the `intersects` for that angle. The histograms for all
+        angles are computed at once, and are identical to histograms computed
+        with :meth:`features.color_histograms` with a mask of the line drawn
+        by :meth:`cv2.line`. Angles without intersections get empty
+        histograms. Returns an array with one row per angle, with the
+        histograms for each color space in `args` and each channel.
+        """
+        # Get a line from the center to the outer intersection point.
+        rays = []
+        starts = []
+        ends = []
+        for i, angle in enumerate(angles):
+            if intersects[angle]:
+                line = ft.extreme_points([center] + intersects[angle])
+                rays.append(i)
+                starts.append(line[0])
+                ends.append(line[1])
+
+        index, xs, ys = line_pixels(starts, ends, self.img.shape)
+        index = np.asarray(rays, dtype=int)[index]
+
+        histograms = []
+        for colorspace, bins in vars(args).iteritems():
+            img = self.context.get_image(colorspace, masked=True)
+            if colorspace.lower() == "bgr":
+                colorspace = ft.CS_BGR
+            elif colorspace.lower() == "hsv":
+                colorspace = ft.CS_HSV
+            elif colorspace.lower() == "luv":
+                colorspace = ft.CS_LUV
+            else:
+                raise ValueError("Unknown colorspace '%s'" % colorspace)
+
+            hists = ray_histograms(img, index, xs, ys, len(angles), bins,
+                ft.CS_RANGE[colorspace])
+
+            # Get the color space ranges. Correct for the exclusive upper
+            # boundaries.
+            ranges = np.array(ft.CS_RANGE[colorspace]).astype(float) - [0,1]
+
+            for i, hist in enumerate(hists):
+                # Normalize the features if a scaler is set. Each value is
+                # scaled separately, so scaling the histograms for all angles
+                # at once gives the same result as scaling them one by one.
+                if self.scaler:
+                    self.scaler.fit(ranges[i])
+                    hist = self.scaler.transform(
+                        hist.reshape(-1, 1).astype(float)).reshape(hist.shape)
+
+                histograms.append(hist)
+
+        return np.hstack(histograms)
+
+    def __get_surf_features(self, args):
         """Executes :meth:`features.surf`."""
         threshVal = getattr(args, 'thresholdVal', None)
         maxVal = getattr(args, 'maxVal', None)
         ht = getattr(args, 'HessianThreshold', 400)
         mask = getattr(args, 'mask', None)
 
+        src = self.img
         if type(src) == np.ndarray:
             # Convert img to grayscale if it is in color.
             if len(src.shape) == 3:
-                img_gray = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
+                img_gray = self.context.get_image('gray')
             else:
                 img_gray = src
 
@@ -716,8 +1592,131 @@ class Phenotyper(object):
             # Get keypoints and descriptors from the SURF features.
             _kp, des = ft.surf_features(thresh, ht, mask)
 
+            if des is None:
+                des = np.empty((0, SURF_DESCRIPTOR_SIZE), dtype=np.float32)
             return des
 
+    def __get_orb_features(self, args):
+        """Return the binary descriptors of ORB keypoints.
+
+        ORB keypoints are detected in the grayscale image, within the binary
+        mask if ``mask`` is set. Their descriptors are returned as an array of
+        bytes with one row per keypoint, which is empty if no keypoints were
+        found. ORB descriptors are much cheaper to compute, store and cluster
+        than SURF descriptors.
+        """
+        n_features = getattr(args, 'n_features', 500)
+        scale_factor = getattr(args, 'scale_factor', 1.2)
+        n_levels = getattr(args, 'n_levels', 8)
+        use_mask = getattr(args, 'mask', False)
+
+        if hasattr(cv2, 'ORB_create'):
+            orb = cv2.ORB_create(nfeatures=n_features,
+                scaleFactor=scale_factor, nlevels=n_levels)
+        else:
+            orb = cv2.ORB(nfeatures=n_features, scaleFactor=scale_factor,
+                nlevels=n_levels)
+
+        img_gray = self.context.get_image('gray')
+        mask = self.bin_mask if use_mask else None
+        _kp, des = orb.detectAndCompute(img_gray, mask)
+
+        if des is None:
+            des = np.empty((0, ORB_DESCRIPTOR_SIZE), dtype=np.uint8)
+        return des
+
+
+def normalize_array(data, alpha, beta, norm_type=cv2.NORM_MINMAX, axis=0):
+    """Normalize the columns or rows of a 2D array.
+
+    Each column (`axis` is 0) or row (`axis` is 1) of `data` is normalized as
+    with :meth:`cv2.normalize`, with the same `alpha`, `beta`, and
+    `norm_type` arguments, but for all columns or rows at once. Norm types
+    ``cv2.NORM_MINMAX``, ``cv2.NORM_INF``, ``cv2.NORM_L1``, and
+    ``cv2.NORM_L2`` are supported. Returns a new array of the same data type
+    as `data`.
+    """
+    data = np.asarray(data)
+    eps = np.finfo(np.float64).eps
+
+    # The statistics are computed in double precision, and the data is
+    # scaled in its own precision if it is floating point data.
+    if np.issubdtype(data.dtype, np.floating):
+        values = data.copy()
+    else:
+        values = data.astype(np.float64)
+
+    if norm_type == cv2.NORM_MINMAX:
+        low, high = min(alpha, beta), max(alpha, beta)
+        smin = values.min(axis=axis, keepdims=True).astype(np.float64)
+        smax = values.max(axis=axis, keepdims=True).astype(np.float64)
+        span = smax - smin
+        scale = np.where(span > eps, (high - low) / np.where(span > eps,
+            span, 1), 0)
+        shift = low - smin * scale
+    elif norm_type in (cv2.NORM_INF, cv2.NORM_L1, cv2.NORM_L2):
+        if norm_type == cv2.NORM_INF:
+            norm = np.abs(values).max(axis=axis, keepdims=True)
+        elif norm_type == cv2.NORM_L1:
+            norm = np.abs(values).sum(axis=axis, keepdims=True,
+                dtype=np.float64)
+        else:
+            norm = np.sqrt(np.square(values, dtype=np.float64).sum(
+                axis=axis, keepdims=True))
+        norm = norm.astype(np.float64)
+        scale = np.where(norm > eps, alpha / np.where(norm > eps, norm, 1), 0)
+        shift = None
+    else:
+        raise ValueError("Unsupported norm type %s" % norm_type)
+
+    values *= scale.astype(values.dtype)
+    if shift is not None:
+        values += shift.astype(values.dtype)
+
+    if np.issubdtype(data.dtype, np.integer):
+        values = np.clip(np.around(values), np.iinfo(data.dtype).min,
+            np.iinfo(data.dtype).max)
+    return values.astype(data.dtype, copy=False)
+
+def is_binary_train_file(path):
+    """Return True if `path` is a training data file in binary format.
+
+    Training data files with the extension ``.npz`` are stored in the binary
+    format of :meth:`TrainData.write_to_file`, any other file is a tab
+    separated file.
+    """
+    return os.path.splitext(path)[1].lower() == '.npz'
+
+def get_layout_path(filename):
+    """Return the path of the layout file for training data `filename`.
+
+    The layout of training data (see :meth:`write_layout`) is saved next to
+    the training data, and next to the neural networks trained on it.
+    """
+    return filename + "_layout.yml"
+
+def write_layout(path, input_columns, classes):
+    """Write the layout of training data to file `path`.
+
+    The layout consists of a hash of the names of the input columns
+    `input_columns`, and the list of classes `classes`, in the order of the
+    output columns. Training data with the same layout have the same inputs
+    and outputs, so that a neural network trained on one can be trained
+    further on the other.
+    """
+    layout = {
+        'inputs': stable_hash(list(input_columns)),
+        'classes': list(classes)
+    }
+    with open(path, 'w') as fh:
+        yaml.safe_dump(layout, fh, default_flow_style=False)
+
+def read_layout(path):
+    """Return the layout from file `path`, or None if there is none."""
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as fh:
+        return yaml.safe_load(fh)
 
 class TrainData(object):
 
@@ -726,9 +1725,18 @@ class TrainData(object):
     An instance of this class is iterable, which returns 3-tuples ``(label,
     input_data, output_data)`` per iteration. Data can either be loaded from
     file with :meth:`read_from_file` or manually appended with :meth:`append`.
+
+    Training data files are either tab separated files, or NumPy ``.npz``
+    files for large data sets (see :meth:`write_to_file`). The format is
+    picked by the file extension.
+
+    The data is stored in preallocated NumPy arrays, which grow as rows are
+    appended. Iterating over the data returns views of the rows, and
+    :meth:`subset` returns a selection of the samples which shares the data.
     """
 
-    def __init__(self, num_input=None, num_output=None):
+    def __init__(self, num_input=None, num_output=None, dtype=float,
+            size=0):
         """Set the number of input and output columns.
 
         Training data consists of input data columns, and output data columns.
@@ -737,19 +1745,57 @@ class TrainData(object):
 
         If :meth:`read_from_file` is used to load training data from a file,
         the number of input and output columns is automatically set.
+
+        The data is stored in NumPy arrays of data type `dtype`, with room for
+        `size` rows. The arrays grow if more rows are appended.
         """
         self.labels = []
-        self.input = []
-        self.output = []
-        self.counter = 0
         self.num_input = num_input
         self.num_output = num_output
+        self.dtype = np.dtype(dtype)
+        self.finalized = False
+
+        # The data arrays, of which the first `_size` rows are set. If
+        # `_rows` is set, the data is a subset of these rows, which is
+        # either a slice or an array of row indices.
+        self._input = None
+        self._output = None
+        self._size = 0
+        self._capacity = max(int(size), 0)
+        self._rows = None
 
         if num_input:
             self.set_num_input(num_input)
         if num_output:
             self.set_num_output(num_output)
 
+    @classmethod
+    def from_arrays(cls, input_, output, labels=None):
+        """Return finalized training data for existing data arrays.
+
+        Expects a 2D array `input_` with the input data and a 2D array
+        `output` with the output data, with one row per sample, and
+        optionally the sample labels `labels`. The data is stored in the data
+        type of `input_`, without copying it if `output` has the same data
+        type.
+        """
+        input_ = np.asarray(input_)
+        output = np.asarray(output, dtype=input_.dtype)
+        if input_.ndim != 2 or output.ndim != 2 or \
+                len(input_) != len(output):
+            raise ValueError("Expected 2D input and output arrays with the " \
+                "same number of rows")
+        if labels is None:
+            labels = [None] * len(input_)
+        if len(labels) != len(input_):
+            raise ValueError("Expected a label for each row")
+
+        data = cls(input_.shape[1], output.shape[1], input_.dtype)
+        data._set_arrays(input_, output)
+        data.labels = list(labels)
+        data.finalized = True
+        return data
+
     def set_num_input(self, n):
         if not n > 0:
             raise ValueError("The number of input columns must be at least 1")
@@ -768,62 +1814,214 @@ class TrainData(object):
         starting with `dependent_prefix` are used as output columns. Optionally,
         labels for the samples can be stored in a column with the name "ID". All
         remaining columns are used as input data.
+
+        If `path` has the extension ``.npz``, the data is loaded from the
+        binary format written by :meth:`write_to_file` instead, where the
+        columns are set by the stored header in the same way.
         """
+        if is_binary_train_file(path):
+            self._read_from_npz(path, dependent_prefix)
+            return
+
         with open(path, 'r') as fh:
             reader = csv.reader(fh, delimiter="\t")
 
             # Figure out the format of the data.
-            self.num_input = 0
-            self.num_output = 0
-            input_start = None
-            output_start = None
-            label_idx = None
-            header = reader.next()
-            for i, field in enumerate(header):
-                if field == "ID":
-                    label_idx = i
-                elif field.startswith(dependent_prefix):
-                    if output_start == None:
-                        output_start = i
-                    self.num_output += 1
-                else:
-                    if input_start == None:
-                        input_start = i
-                    self.num_input += 1
-
-            if not self.num_input > 0:
-                raise ValueError("No input columns found in training data")
-            if not self.num_output > 0:
-                raise ValueError("Training data needs at least 1 output " \
-                    "columns, found %d" % self.num_output)
-
+            label_idx, input_idx, output_idx = self._parse_header(
+                reader.next(), dependent_prefix)
+            input_start = input_idx[0]
+            output_start = output_idx[0]
             input_end = input_start + self.num_input
             output_end = output_start + self.num_output
 
             for row in reader:
                 if label_idx is not None:
-                    self.labels.append(row[label_idx])
+                    label = row[label_idx]
                 else:
-                    self.labels.append(None)
-                self.input.append(row[input_start:input_end])
-                self.output.append(row[output_start:output_end])
+                    label = None
+                self.append(row[input_start:input_end],
+                    row[output_start:output_end], label)
 
             self.finalize()
 
+    def _parse_header(self, header, dependent_prefix):
+        """Return the column indices for header `header`.
+
+        Sets the number of input and output columns and returns a 3-tuple
+        ``(label_idx, input_idx, output_idx)``, where `label_idx` is None if
+        there is no "ID" column.
+        """
+        label_idx = None
+        input_idx = []
+        output_idx = []
+        for i, field in enumerate(header):
+            if field == "ID":
+                label_idx = i
+            elif field.startswith(dependent_prefix):
+                output_idx.append(i)
+            else:
+                input_idx.append(i)
+
+        if not len(input_idx) > 0:
+            raise ValueError("No input columns found in training data")
+        if not len(output_idx) > 0:
+            raise ValueError("Training data needs at least 1 output " \
+                "columns, found %d" % len(output_idx))
+
+        self.num_input = len(input_idx)
+        self.num_output = len(output_idx)
+        return (label_idx, input_idx, output_idx)
+
+    def _read_from_npz(self, path, dependent_prefix):
+        """Load training data from a binary file.
+
+        The file at `path` must have been written by :meth:`write_to_file`.
+        """
+        # Each access of a member of an .npz file reads the array again.
+        with np.load(path, allow_pickle=False) as data:
+            header = [str(field) for field in data['header']]
+            input_ = data['input']
+            output = data['output']
+            labels = data['labels']
+
+        label_idx, input_idx, output_idx = self._parse_header(header,
+            dependent_prefix)
+        if input_.shape[1:] != (self.num_input,) or \
+                output.shape[1:] != (self.num_output,) or \
+                len(input_) != len(output):
+            raise ValueError("Training data in %s does not match its " \
+                "header" % path)
+
+        self._set_arrays(input_.astype(self.dtype, copy=False),
+            output.astype(self.dtype, copy=False))
+        if label_idx is not None:
+            self.labels = [str(label) for label in labels]
+        else:
+            self.labels = [None] * len(input_)
+        self.finalized = True
+
+    def write_to_file(self, path, header):
+        """Write the training data to file.
+
+        The data is written to `path` with column names `header`, which lists
+        the name of the label column "ID", followed by the names of the input
+        and output columns. This method can only be called after
+        :meth:`finalize` was executed.
+
+        If `path` has the extension ``.npz``, the header, labels, input and
+        output data are stored as arrays in an uncompressed NumPy ``.npz``
+        file, which is read back much faster than a tab separated file and
+        stores the data in its own data type. Otherwise a tab separated file
+        is written, which can be read by :meth:`read_from_file`.
+        """
+        if not self.finalized:
+            raise ValueError("Data must be finalized before running this " \
+                "function")
+        if len(header) != 1 + self.num_input + self.num_output:
+            raise ValueError("Expected %d column names, got %d" % \
+                (1 + self.num_input + self.num_output, len(header)))
+
+        labels = ["" if label is None else str(label) \
+            for label in self.labels]
+
+        if is_binary_train_file(path):
+            with open(path, 'wb') as fh:
+                np.savez(fh,
+                    header=np.array(header, dtype=str),
+                    labels=np.array(labels, dtype=str),
+                    input=self.get_input(),
+                    output=self.get_output())
+            return
+
+        with open(path, 'w') as fh:
+            fh.write("%s\n" % "\t".join(header))
+            for label, (_, input_, output) in zip(labels, self):
+                row = [label]
+                row.extend(input_.astype(str))
+                row.extend(output.astype(str))
+                fh.write("%s\n" % "\t".join(row))
+
+    def _set_arrays(self, input_, output):
+        """Set the data arrays `input_` and `output` with all rows set."""
+        self._input = input_
+        self._output = output
+        self._size = len(input_)
+        self._capacity = len(input_)
+        self._rows = None
+
+    def _reserve(self, n):
+        """Make sure the data arrays have room for `n` rows."""
+        if self._input is not None and self._capacity >= n:
+            return
+        capacity = max(n, 2 * self._capacity, 16)
+        input_ = np.empty((capacity, self.num_input), dtype=self.dtype)
+        output = np.empty((capacity, self.num_output), dtype=self.dtype)
+        if self._input is not None:
+            input_[:self._size] = self._input[:self._size]
+            output[:self._size] = self._output[:self._size]
+        self._input = input_
+        self._output = output
+        self._capacity = capacity
+
+    def _view(self, data, columns):
+        """Return the rows of data array `data` that belong to this data.
+
+        Returns a view, unless the data is a subset of rows that are not
+        contiguous.
+        """
+        if data is None:
+            return np.empty((0, columns or 0), dtype=self.dtype)
+        data = data[:self._size]
+        if self._rows is None or isinstance(self._rows, slice):
+            return data if self._rows is None else data[self._rows]
+        return data.take(self._rows, axis=0)
+
+    def _own(self):
+        """Make sure the input data can be modified in place.
+
+        Copies the input data if it is shared with other training data or if
+        it is read-only. Must be called before the input data is modified in
+        place.
+        """
+        if self._rows is None and (self._input is None or \
+                self._input.flags.writeable):
+            return
+        input_ = self.get_input()
+        if self._rows is None or isinstance(self._rows, slice):
+            input_ = input_.copy()
+        self._set_arrays(input_, self.get_output())
+
+    @property
+    def input(self):
+        """The input data."""
+        return self._view(self._input, self.num_input)
+
+    @property
+    def output(self):
+        """The output data."""
+        return self._view(self._output, self.num_output)
+
     def __len__(self):
-        return len(self.input)
+        return len(self.labels)
 
     def __iter__(self):
-        return self
+        """Return an iterator over the samples.
 
-    def next(self):
-        if self.counter >= len(self.input):
-            self.counter = 0
-            raise StopIteration
+        Each iteration returns a 3-tuple ``(label, input_data,
+        output_data)``, where the data are views of the rows. Iterations are
+        independent of each other, so the data can be iterated over more than
+        once at the same time.
+        """
+        if self._rows is None or isinstance(self._rows, slice):
+            input_, output = self.input, self.output
+            rows = None
         else:
-            self.counter += 1
-            i = self.counter - 1
-            return (self.labels[i], self.input[i], self.output[i])
+            input_, output = self._input, self._output
+            rows = self._rows
+
+        for n, label in enumerate(self.labels):
+            i = n if rows is None else rows[n]
+            yield (label, input_[i], output[i])
 
     def append(self, input, output, label=None):
         """Append a training data row.
@@ -831,7 +2029,7 @@ class TrainData(object):
         A data row consists of input data `input`, output data `output`, and
         an optional sample label `label`.
         """
-        if isinstance(self.input, np.ndarray):
+        if self.finalized:
             raise ValueError("Cannot add data once finalized")
         if len(input) != self.num_input:
             raise ValueError("Incorrect input array length (expected " \
@@ -840,44 +2038,95 @@ class TrainData(object):
             raise ValueError("Incorrect output array length (expected " \
                 "length of %d)" % self.num_output)
 
+        self._reserve(self._size + 1)
+        self._input[self._size] = input
+        self._output[self._size] = output
+        self._size += 1
         self.labels.append(label)
-        self.input.append(input)
-        self.output.append(output)
 
     def finalize(self):
-        """Transform input and output data to Numpy arrays."""
-        self.input = np.array(self.input).astype(float)
-        self.output = np.array(self.output).astype(float)
+        """Finalize the data, after which no more rows can be added.
+
+        The data arrays are trimmed to the number of rows that were added.
+        """
+        if self._input is not None and self._capacity > self._size:
+            self._set_arrays(self._input[:self._size].copy(),
+                self._output[:self._size].copy())
+        self.finalized = True
+
+    def subset(self, labels):
+        """Return the samples with a label in `labels`.
+
+        Labels are compared as strings, so that photo IDs can be used as
+        labels for data that was loaded from file. Returns a new
+        :class:`TrainData` instance with the selected samples in their
+        original order. The subset shares the data with this instance, so
+        that no data is copied if the same data is used for several subsets,
+        for example the folds of a cross validation. Modifying the data of a
+        subset does not modify the data of this instance. This method can only
+        be called after :meth:`finalize` was executed.
+        """
+        if not self.finalized:
+            raise ValueError("Data must be finalized before running this " \
+                "function")
+
+        labels = set(str(label) for label in labels)
+        rows = np.array([i for i, label in enumerate(self.labels) \
+            if str(label) in labels], dtype=np.intp)
+
+        # Translate the rows to rows of the data arrays.
+        if isinstance(self._rows, slice):
+            rows = rows + self._rows.start
+        elif self._rows is not None:
+            rows = self._rows[rows]
+
+        subset = TrainData(self.num_input, self.num_output, self.dtype)
+        subset.labels = [label for label in self.labels \
+            if str(label) in labels]
+        subset._input = self._input
+        subset._output = self._output
+        subset._size = self._size
+        subset._capacity = self._capacity
+        if len(rows) == 0:
+            subset._rows = slice(0, 0)
+        elif rows[-1] - rows[0] + 1 == len(rows):
+            subset._rows = slice(rows[0], rows[-1] + 1)
+        else:
+            subset._rows = rows
+        subset.finalized = True
+        return subset
 
     def normalize_input_columns(self, alpha, beta, norm_type=cv2.NORM_MINMAX):
-        """Normalize the input columns using :meth:`cv2.normalize`.
+        """Normalize the input columns as with :meth:`cv2.normalize`.
 
-        This method can only be called after :meth:`finalize` was executed.
+        All columns are normalized at once with :meth:`normalize_array`. This
+        method can only be called after :meth:`finalize` was executed.
         """
-        if not isinstance(self.input, np.ndarray):
+        if not self.finalized:
             raise ValueError("Data must be finalized before running this " \
                 "function")
 
-        for col in range(self.num_input):
-            tmp = cv2.normalize(self.input[:,col], None, alpha, beta, norm_type)
-            self.input[:,col] = tmp[:,0]
+        self._own()
+        data = self.input
+        data[:] = normalize_array(data, alpha, beta, norm_type, axis=0)
 
     def normalize_input_rows(self, alpha, beta, norm_type=cv2.NORM_MINMAX):
-        """Normalize the input rows using :meth:`cv2.normalize`.
+        """Normalize the input rows as with :meth:`cv2.normalize`.
 
-        This method can only be called after :meth:`finalize` was executed.
+        All rows are normalized at once with :meth:`normalize_array`. This
+        method can only be called after :meth:`finalize` was executed.
         """
-        if not isinstance(self.input, np.ndarray):
+        if not self.finalized:
             raise ValueError("Data must be finalized before running this " \
                 "function")
 
-        for i, row in enumerate(self.input):
-            self.input[i] = cv2.normalize(row, None, alpha, beta,
-                norm_type).reshape(-1)
+        self._own()
+        data = self.input
+        data[:] = normalize_array(data, alpha, beta, norm_type, axis=1)
 
     def round_input(self, decimals=4):
         """Rounds the input data to `decimals` decimals."""
-        self.input = np.around(self.input, decimals)
+        self._set_arrays(np.around(self.input, decimals), self.get_output())
 
     def get_input(self):
         """Return the input data."""
@@ -887,6 +2136,42 @@ class TrainData(object):
         """Return the output data."""
         return self.output
 
+class TrainDataCache(object):
+
+    """Cache training data that was loaded from files.
+
+    A training data file is loaded once, after which subsets of its samples
+    can be obtained without loading the file again (see
+    :meth:`TrainData.subset`). This is used to share the data between the
+    folds of a cross validation.
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def get(self, path, dependent_prefix, subset=None):
+        """Return the training data from file `path`.
+
+        The file is loaded with :meth:`TrainData.read_from_file`, unless it
+        was loaded before and was not modified since. If `subset` is set,
+        only the samples with a label in `subset` are returned.
+        """
+        key = (os.path.abspath(path), dependent_prefix)
+        mtime = os.path.getmtime(path)
+        if key not in self._data or self._data[key][0] != mtime:
+            data = TrainData()
+            data.read_from_file(path, dependent_prefix)
+            self._data[key] = (mtime, data)
+
+        data = self._data[key][1]
+        if subset is not None:
+            data = data.subset(subset)
+        return data
+
+    def clear(self):
+        """Remove all training data from the cache."""
+        self._data = {}
+
 class MakeTrainData(Common):
 
     """Generate training data.
@@ -925,24 +2210,52 @@ class MakeTrainData(Common):
     def export(self, filename, filter_, config=None, codebook_file=None):
         """Write the training data to `filename`.
 
+        The training data is written in the binary format if `filename` has
+        the extension ``.npz``, and as a tab separated file otherwise (see
+        :meth:`TrainData.write_to_file`).
+
         Images to be processed are obtained from the database. Which images are
         obtained and with which classes is set by the filter `filter_`. Image
         fingerprints are obtained from cache, which must have been created for
         configuration `config` or `self.config`.
+
+        If the BagOfWords model is used, the descriptors of all images are
+        encoded at once with a :class:`~nbclassify.codebook.CodebookIndex`
+        for the codebook in `codebook_file`, or for a new codebook if no
+        codebook file is given.
         """
         session, metadata = db.get_session_or_error()
 
         if not conf.force_overwrite and os.path.isfile(filename):
             raise FileExistsError(filename)
 
-        # Get the classification categories from the database.
-        classes = db.get_classes_from_filter(session, metadata, filter_)
-        assert len(classes) > 0, \
-            "No classes found for filter `%s`" % filter_
-
         # Get the photos and corresponding classification using the filter.
         images = db.get_filtered_photos_with_taxon(session, metadata, filter_)
-        images = images.all()
+        self.export_images(filename, filter_, images.all(), config,
+            codebook_file)
+
+    def export_images(self, filename, filter_, images, config=None,
+            codebook_file=None, phenotypes=None):
+        """Write the training data for photos `images` to `filename`.
+
+        Does the same as :meth:`export`, for the photos `images` that were
+        obtained with the filter `filter_`, as 2-tuples ``(photo, class)``.
+        The classes of the training data are the classes of these photos.
+
+        If the BagOfWords model is not used, the phenotypes can be given with
+        `phenotypes`, a 2-tuple ``(index, matrix)``, where `matrix` is a
+        matrix with phenotypes (see :meth:`PhenotypeCache.get_phenotypes`)
+        and `index` is a dictionary which maps the MD5 sum of each photo to
+        its row in `matrix`. Photos that are not in `index` are skipped. If
+        `phenotypes` is not set, the phenotypes are read from the cache.
+        """
+        if not conf.force_overwrite and os.path.isfile(filename):
+            raise FileExistsError(filename)
+
+        # Get the classification categories.
+        classes = set(class_ for photo, class_ in images)
+        assert len(classes) > 0, \
+            "No classes found for filter `%s`" % filter_
 
         if not images:
             logging.info("No images found for the filter `%s`", filter_)
@@ -975,66 +2288,90 @@ class MakeTrainData(Common):
         if not config:
             config = self.config
 
+        # Check if the BagOfWords alogrithm needs to be applied.
+        bow_feature = get_bow_feature(self.config.features)
+        use_bow = bow_feature is not None
+
         # Load the fingerprint cache.
-        self.cache.load_cache(self.cache_path, config)
+        if use_bow or phenotypes is None:
+            self.cache.load_cache(self.cache_path, config)
 
-        # Check if the BagOfWords alogrithm needs to be applied.
-        use_bow = getattr(self.config.features['surf'], 'bow_clusters', False)
         if use_bow and codebook_file == None:
-            codebook = self.__make_codebook(images, filename)
+            # A shared codebook is created from the photos of all classes,
+            # so that it is the same for all levels of the classification
+            # hierarchy.
+            codebook_images = images
+            if getattr(getattr(self.config.features[bow_feature], 'codebook',
+                    None), 'shared', False):
+                session, metadata = db.get_session_or_error()
+                codebook_images = db.get_filtered_photos_with_taxon(session,
+                    metadata, {'class': filter_.get('class')}).all()
+            index = self.__make_codebook(codebook_images, filename, config)
         elif use_bow:
-            with open(codebook_file, "rb") as cb:
-                codebook = load(cb)
+            method, eps = get_codebook_index_settings(
+                self.config.features[bow_feature])
+            index = CodebookIndex.from_codebook_file(codebook_file, method,
+                eps)
 
+        # Select the photos with cached features.
+        selected = []
+        for photo, class_ in images:
+            # Only export the subset if an export subset is set.
+            if self.subset and photo.id not in self.subset:
+                continue
 
-        # Generate the training data.
-        with open(filename, 'w') as fh:
-            # Write the header.
-            fh.write( "%s\n" % "\t".join(header) )
-
-            # Set the training data.
-            training_data = TrainData(len(header_data), len(classes))
+            if use_bow or phenotypes is None:
+                cached = self.cache.has_phenotype(photo.md5sum)
+            else:
+                cached = str(photo.md5sum) in phenotypes[0]
+            if not cached:
+                logging.warning("No features cached for `%s`. Skipping.",
+                    photo.path)
+                continue
 
-            for photo, class_ in images:
-                # Only export the subset if an export subset is set.
-                if self.subset and photo.id not in self.subset:
-                    continue
+            selected.append((photo, class_))
 
-                logging.info("Processing `%s` of class `%s`...",
-                    photo.path, class_)
+        if not selected:
+            raise ValueError("Training data cannot be empty")
 
-                # Get phenotype for this image from the cache.
-                phenotype = self.cache.get_phenotype(photo.md5sum)
+        keys = [photo.md5sum for photo, _ in selected]
+        logging.info("Processing %d photos...", len(selected))
 
-                # If the BagOfWords algorithm is applied,
-                # convert phenotype to BOW-code.
-                if use_bow:
-                    phenotype = get_bowcode_from_surf_features(phenotype,
-                                                               codebook)
+        # Get the phenotypes of all photos at once, or the BOW-codes if the
+        # BagOfWords algorithm is applied.
+        if use_bow:
+            descriptors, rows, counts = self.cache.get_descriptors(
+                bow_feature, keys)
+            input_ = index.encode(descriptors, counts, rows)
+        elif phenotypes is not None:
+            index, matrix = phenotypes
+            input_ = matrix[[index[str(key)] for key in keys]]
+        else:
+            input_ = self.cache.get_phenotypes(keys)
 
-                assert len(phenotype) == len(header_data), \
-                    "Fingerprint size mismatch. According to the header " \
-                    "there are {0} data columns, but the fingerprint has " \
-                    "{1}".format(len(header_data), len(phenotype))
+        assert input_.shape[1] == len(header_data), \
+            "Fingerprint size mismatch. According to the header " \
+            "there are {0} data columns, but the fingerprint has " \
+            "{1}".format(len(header_data), input_.shape[1])
 
-                training_data.append(phenotype, codewords[class_],
-                    label=photo.id)
+        # Set the training data.
+        output = [codewords[class_] for _, class_ in selected]
+        training_data = TrainData.from_arrays(
+            np.asarray(input_, dtype=get_phenotype_dtype(config)), output,
+            [photo.id for photo, _ in selected])
 
-            training_data.finalize()
+        # Round feature data only if BOW is not applied and the data is
+        # written as text.
+        if not use_bow and not is_binary_train_file(filename):
+            training_data.round_input(6)
 
-            if not training_data:
-                raise ValueError("Training data cannot be empty")
+        # Write the training data, as a binary file if the file name has the
+        # extension .npz.
+        training_data.write_to_file(filename, header)
 
-            # Round feature data only if BOW is not applied.
-            if not use_bow:
-                training_data.round_input(6)
-
-            # Write data rows.
-            for photo_id, input_, output in training_data:
-                row = [str(photo_id)]
-                row.extend(input_.astype(str))
-                row.extend(output.astype(str))
-                fh.write("%s\n" % "\t".join(row))
+        # The output columns are the classes in sorted order (see
+        # get_codewords()).
+        write_layout(get_layout_path(filename), header_data, sorted(classes))
 
         logging.info("Training data written to %s", filename)
 
@@ -1042,6 +2379,8 @@ class MakeTrainData(Common):
         """Construct a header from features settings.
 
         Header is returned as a 2-tuple ``(data_columns, output_columns)``.
+        The data columns are derived from the layout of the phenotype (see
+        :meth:`get_feature_layout`).
         """
         if 'features' not in self.config:
             raise ConfigurationError("missing `features`")
@@ -1049,56 +2388,11 @@ class MakeTrainData(Common):
         data = []
         out = []
 
-        # Always sort the features by name so that the headers match the
-        # data column.
-        features = sorted(vars(self.config.features).keys())
-
-        for feature in features:
-            args = self.config.features[feature]
-
-            if feature == 'color_histograms':
-                for colorspace, bins in vars(args).iteritems():
-                    for ch, n in enumerate(bins):
-                        for i in range(1, n+1):
-                            data.append("%s:%d" % (colorspace[ch], i))
-
-            if feature == 'color_bgr_means':
-                bins = getattr(args, 'bins', 20)
-                for i in range(1, bins+1):
-                    for axis in ("HOR", "VER"):
-                        for ch in "BGR":
-                            data.append("BGR_MN:%d.%s.%s" % (i,axis,ch))
-
-            if feature == 'shape_outline':
-                n = getattr(args, 'k', 15)
-                for i in range(1, n+1):
-                    data.append("OUTLINE:%d.X" % i)
-                    data.append("OUTLINE:%d.Y" % i)
-
-            if feature == 'shape_360':
-                step = getattr(args, 'step', 1)
-                output_functions = getattr(args, 'output_functions', {'mean_sd': 1})
-                for f_name, f_args in vars(output_functions).iteritems():
-                    if f_name == 'mean_sd':
-                        for i in range(0, 360, step):
-                            data.append("360:%d.MN" % i)
-                            data.append("360:%d.SD" % i)
-
-                    if f_name == 'color_histograms':
-                        for i in range(0, 360, step):
-                            for cs, bins in vars(f_args).iteritems():
-                                for j, color in enumerate(cs):
-                                    for k in range(1, bins[j]+1):
-                                        data.append("360:%d.%s:%d" % (i,color,k))
-
-            if feature == 'surf':
-                try:
-                    n_clusters = int(getattr(args, 'bow_clusters', None))
-                except ValueError:
-                    n_clusters = 150
-                for i in range(1, n_clusters+1):
-                    data.append("CL%d" % i)
-
+        # The features are sorted by name, so that the headers match the
+        # data columns.
+        for name, start, stop, columns in \
+                get_feature_layout(self.config.features):
+            data.extend(columns)
 
         # Write classification columns.
         try:
@@ -1111,75 +2405,133 @@ class MakeTrainData(Common):
 
         return (data, out)
 
-    def __make_codebook(self, images, filename):
-        # Create nparray with all descriptors of the SURF features.
-        descr_array = np.zeros((len(images) * 1000, 128))
-        position = 0
+    def __make_codebook(self, images, filename, config):
+        """Create a codebook for the BagOfWords model and save it.
+
+        The descriptors of the feature returned by
+        :meth:`~nbclassify.functions.get_bow_feature` for the photos in
+        `images` are clustered, with mini-batch k-means for SURF descriptors
+        (see :meth:`~nbclassify.codebook.kmeans_minibatch`), or with
+        k-majority by Hamming distance for binary ORB descriptors. The
+        clustering is set with the ``codebook`` settings of the feature.
+
+        Codebooks are kept in a :class:`~nbclassify.codebook.CodebookRegistry`
+        in the cache directory, under a key for the cached descriptors of
+        configuration `config`, the photos, the number of clusters and the
+        clustering settings. If the registry has a codebook for the key, it is
+        used instead of creating a new one. Mini-batch k-means saves a
+        checkpoint in the registry, from which an interrupted run resumes.
+
+        The codebook and its metadata are copied next to the training data
+        `filename`, together with a
+        :class:`~nbclassify.codebook.CodebookIndex` for the codebook, which is
+        returned.
+        """
+        name = get_bow_feature(self.config.features)
+        feature = self.config.features[name]
+        settings = getattr(feature, 'codebook', Struct({}))
+
+        # Collect the keys of the images that have descriptors in the cache.
+        keys = set()
         for photo, class_ in images:
             # Only export the subset if an export subset is set.
             if self.subset and photo.id not in self.subset:
                 continue
+            if self.cache.has_phenotype(photo.md5sum):
+                keys.add(str(photo.md5sum))
 
-            # Get descriptors for this image from the cache.
-            descriptors = self.cache.get_phenotype(photo.md5sum)
-            
-            # Convert list to nparray.
-            descriptors = np.asarray(descriptors)
-
-            # Add descriptors to nparray.
-            n_features = descriptors.shape[0]
-            while position + n_features > descr_array.shape[0]:
-                elongation = np.zeros_like(descr_array)
-                descr_array = np.vstack((descr_array, elongation))
-            descr_array[position: position + n_features] = descriptors
-            position += n_features
-
-        # Adjust size of nparray to number of descriptors.
-        descr_array = np.resize(descr_array, (position, 128))
+        if not keys:
+            raise ValueError("No descriptors found to create a codebook")
+        keys = sorted(keys)
 
         try:
-            n_clusters = int(getattr(self.config.features['surf'],
-                                     'bow_clusters', None))
-        except ValueError:
+            n_clusters = int(getattr(feature, 'bow_clusters', None))
+        except (TypeError, ValueError):
             logging.warning("No (valid) value for bow_clusters is set in "
                             "configurations. Default 150 will be used.")
             n_clusters = 150
 
-        logging.info("%d extracted features will now be clustered into "
-                     "%d clusters to create a codebook (this will take "
-                     "a while)...", descr_array.shape[0], 
-                     n_clusters)
-                     
-        start = datetime.datetime.now().replace(microsecond=0)
-        logging.info("\nStart creating codebook at: %s\n", start)
-        codebook, _distortion = vq.kmeans(descr_array, n_clusters)
-        end = datetime.datetime.now().replace(microsecond=0)
-        
-        # Check if the length of the codebook is correct.
-        while len(codebook) != n_clusters:
-            time = end - start
-            logging.warning("%d clusters were created in stead of %d. "
-                            "The codebook must be created again. This "
-                            "will probably take the same time as last "
-                            "time: %s (H:M:S), starting at %s", 
-                            len(codebook), n_clusters, time,
-                            datetime.datetime.now().replace(microsecond=0))
+        max_samples = getattr(settings, 'max_samples', None)
+        seed = getattr(settings, 'seed', None)
+        iters = getattr(settings, 'iterations',
+            10 if name in BINARY_FEATURES else 100)
+        batch_size = getattr(settings, 'batch_size', 1000)
+
+        # The key of the codebook in the registry. The cache key identifies
+        # the descriptors of each photo.
+        descriptors_digest = stable_hash(
+            get_feature_cache_key(name, config.features[name], config), keys)
+        key = stable_hash(descriptors_digest, n_clusters, seed, max_samples,
+            iters, batch_size if name not in BINARY_FEATURES else None)
+        registry = CodebookRegistry(os.path.join(self.cache_path,
+            'codebooks'))
+        codebook = registry.get(key)
+
+        if codebook is not None:
+            logging.info("Using codebook %s from the codebook registry", key)
+        else:
+            descriptors, rows, _counts = self.cache.get_descriptors(name,
+                keys)
+            n_descriptors = len(descriptors) if rows is None else len(rows)
+
+            logging.info("%d extracted features will now be clustered into "
+                         "%d clusters to create a codebook...", n_descriptors,
+                         n_clusters)
+            if max_samples and max_samples < n_descriptors:
+                logging.info("A sample of %d features will be clustered",
+                    max_samples)
+
             start = datetime.datetime.now().replace(microsecond=0)
-            codebook, _distortion = vq.kmeans(descr_array, n_clusters)
+            logging.info("\nStart creating codebook at: %s\n", start)
+            if name in BINARY_FEATURES:
+                sample = sample_rows(n_descriptors, max_samples,
+                    np.random.RandomState(seed))
+                if sample is not None:
+                    rows = sample if rows is None else rows[sample]
+                if rows is not None:
+                    descriptors = descriptors[rows]
+                codebook = hamming_kmajority(descriptors, n_clusters,
+                    iters=iters, seed=seed)
+            else:
+                checkpoint = None
+                if getattr(settings, 'checkpoint', True):
+                    if not os.path.isdir(registry.path):
+                        os.makedirs(registry.path)
+                    checkpoint = os.path.join(registry.path,
+                        "%s.checkpoint.npz" % key)
+                codebook = kmeans_minibatch(descriptors, n_clusters,
+                    batch_size=batch_size, iters=iters,
+                    max_samples=max_samples, seed=seed,
+                    checkpoint=checkpoint, rows=rows, fingerprint=key)
             end = datetime.datetime.now().replace(microsecond=0)
-        
-        time = end - start
-        logging.info("\nThe codebook was succesfully created! It took %s "
-                     "(H:M:S)\n", time)
+
+            time = end - start
+            logging.info("\nThe codebook was succesfully created! It took "
+                         "%s (H:M:S)\n", time)
+
+            registry.add(key, codebook, {
+                'feature': name,
+                'descriptors': descriptors_digest,
+                'photos': len(keys),
+                'clusters': n_clusters,
+                'seed': seed,
+                'max_samples': max_samples,
+                'iterations': iters,
+                'created': start.isoformat()
+            })
 
         # Save the codebook.
-        codebookfilename = filename + "_codebook.file"
-        with open(codebookfilename, "wb") as f:
-            dump(codebook, f, protocol=HIGHEST_PROTOCOL)
+        codebookfilename = get_codebook_path(filename)
+        registry.copy(key, codebookfilename)
+
+        logging.info("Codebook saved to %s", codebookfilename)
 
-        logging.info("Codebook created and saved to %s", codebookfilename)
+        # Build and save the index for the codebook.
+        method, eps = get_codebook_index_settings(feature)
+        index = CodebookIndex(codebook, method, eps)
+        index.save(get_index_path(codebookfilename))
 
-        return codebook
+        return index
 
 
 class BatchMakeTrainData(MakeTrainData):
@@ -1217,12 +2569,31 @@ class BatchMakeTrainData(MakeTrainData):
             self.taxon_hr = db.get_taxon_hierarchy(session, metadata)
 
     def batch_export(self, target_dir, codebook_dir=None):
-        """Batch export training data to directory `target_dir`."""
+        """Batch export training data to directory `target_dir`.
+
+        Training data is exported for each node of the classification
+        hierarchy in a single pass. The photos and their classes for all
+        nodes are obtained with a single database query. Unless the
+        BagOfWords model is used, the feature caches for each features
+        configuration are loaded once, and the phenotypes of all photos are
+        read into one matrix, of which the training data for each node is a
+        selection of rows. With the BagOfWords model, the descriptors of each
+        node are encoded with the codebook for that node, which is looked up
+        in `codebook_dir` if given.
+        """
+        session, metadata = db.get_session_or_error()
+
         self._load_taxon_hierarchy()
 
         # Get the name of each level in the classification hierarchy.
         levels = [l.name for l in self.class_hr]
 
+        # Get the photos with their classes on all levels at once.
+        photos = db.get_photos_with_taxa(session, metadata).all()
+
+        use_bow = get_bow_feature(self.config.features) is not None
+        phenotypes = {}
+
         # Make training data for each path in the classification hierarchy.
         for filter_ in classification_hierarchy_filters(levels, self.taxon_hr):
             level = levels.index(filter_.get('class'))
@@ -1244,7 +2615,7 @@ class BatchMakeTrainData(MakeTrainData):
                 train_file = train_file.replace("__%s__" % key, val)
                 codebook_file = codebook_file.replace("__%s__" % key, val)
             
-            codebook_file = codebook_file + "_codebook.file"
+            codebook_file = get_codebook_path(codebook_file)
             if not os.path.isfile(codebook_file):
                 codebook_file = None
 
@@ -1252,7 +2623,42 @@ class BatchMakeTrainData(MakeTrainData):
             logging.info("Exporting train data for classification on %s" % \
                 readable_filter(filter_))
             try:
-                self.export(train_file, filter_, config, codebook_file)
+                if not conf.force_overwrite and os.path.isfile(train_file):
+                    raise FileExistsError(train_file)
+
+                matrix = None
+                if not use_bow:
+                    matrix = self._get_phenotype_matrix(photos, config,
+                        phenotypes)
+                self.export_images(train_file, filter_,
+                    filter_photos(photos, filter_), config, codebook_file,
+                    matrix)
             except FileExistsError as e:
                 # Don't export if the file already exists.
                 logging.warning("Skipping: %s" % e)
+
+    def _get_phenotype_matrix(self, photos, config, phenotypes):
+        """Return the phenotypes of all photos for configurations `config`.
+
+        Returns a 2-tuple ``(index, matrix)`` as expected by
+        :meth:`export_images`, for all photos in `photos` that have cached
+        features. The phenotypes are kept in the dictionary `phenotypes`,
+        from which they are returned if they were read before for the same
+        features.
+        """
+        key = tuple(sorted(get_feature_cache_key(name, feature, config) \
+            for name, feature in vars(config.features).iteritems()))
+        key += (get_phenotype_dtype(config).name,)
+        if key not in phenotypes:
+            self.cache.load_cache(self.cache_path, config)
+            keys = []
+            seen = set()
+            for row in photos:
+                md5sum = str(row[0].md5sum)
+                if md5sum not in seen and self.cache.has_phenotype(md5sum):
+                    keys.append(md5sum)
+                seen.add(md5sum)
+            matrix = self.cache.get_phenotypes(keys)
+            phenotypes[key] = (dict((k, i) for i, k in enumerate(keys)),
+                matrix)
+        return phenotypes[key]
@@ -4,8 +4,11 @@
 
 from argparse import Namespace
 from copy import deepcopy
+import hashlib
+import json
 import os
 import shutil
+import struct
 import tempfile
 
 import numpy as np
@@ -13,6 +16,11 @@ import scipy.cluster.vq as vq
 
 import yaml
 
+from .codebook import hamming_vq
+
+# Features of local descriptors to which the BagOfWords model can be applied.
+BOW_FEATURES = ('orb', 'surf')
+
 def classification_hierarchy_filters(levels, hr, path=[]):
     """Return the classification filter for each path in a hierarchy.
 
@@ -82,12 +90,89 @@ def classification_hierarchy_filters(levels, hr, path=[]):
                 path+[c]):
             yield f
 
+def filter_photos(photos, filter_):
+    """Return the photos for a classification filter.
+
+    Selects the photos for the classification filter `filter_` from the
+    4-tuples ``(photo, genus, section, species)`` `photos`, as returned by
+    :meth:`~nbclassify.db.get_photos_with_taxa`. Returns the same 2-tuples
+    ``(photo, class)`` as :meth:`~nbclassify.db.get_filtered_photos_with_taxon`
+    does for the filter, without querying the database for each filter.
+    """
+    ranks = ('genus', 'section', 'species')
+    class_ = ranks.index(filter_.get('class')) + 1
+    where = [(ranks.index(rank) + 1, taxon) for rank, taxon in \
+        filter_.get('where', {}).items() if rank in ranks]
+
+    selected = []
+    for row in photos:
+        if all(row[i] == taxon for i, taxon in where):
+            selected.append((row[0], row[class_]))
+    return selected
+
+def canonical_form(obj):
+    """Return a canonical, JSON serializable representation of an object.
+
+    Dictionaries and :class:`Struct` objects are converted to lists of
+    key-value pairs sorted by key, and each value is tagged with its type, so
+    that for example ``1``, ``1.0``, ``True`` and ``"1"`` all have a different
+    canonical form. Tuples are treated as lists. Raises a TypeError for
+    objects that have no canonical form.
+    """
+    if obj is None:
+        return ['none']
+    if isinstance(obj, bool):
+        return ['bool', obj]
+    if isinstance(obj, (int, long)):
+        return ['int', str(obj)]
+    if isinstance(obj, float):
+        return ['float', repr(obj)]
+    if isinstance(obj, basestring):
+        return ['str', obj]
+    if isinstance(obj, (list, tuple)):
+        return ['list', [canonical_form(x) for x in obj]]
+    if isinstance(obj, (dict, Struct)):
+        if isinstance(obj, Struct):
+            type_, obj = 'struct', vars(obj)
+        else:
+            type_ = 'dict'
+        items = [[canonical_form(k), canonical_form(v)] for k, v in \
+            obj.iteritems()]
+        items.sort(key=lambda x: json.dumps(x[0]))
+        return [type_, items]
+    raise TypeError("Cannot create a canonical form for type %s" % type(obj))
+
+def stable_hash(*args):
+    """Create a deterministic hash from one or more objects.
+
+    The hash is the hexadecimal SHA-1 digest of the canonical form (see
+    :meth:`canonical_form`) of the arguments. In contrast to
+    :meth:`combined_hash`, the returned hash does not depend on the order of
+    dictionary keys or on the Python interpreter, so it can be used for file
+    names of caches that are shared between machines.
+
+    Example::
+
+        >>> stable_hash(Struct({'a': 1, 'b': [1, 2]}))
+        '97a70e228b1931a87d399236f81008ea376d85d3'
+    """
+    canonical = json.dumps([canonical_form(x) for x in args], sort_keys=True,
+        separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
 def combined_hash(*args):
     """Create a combined hash from one or more hashable objects.
 
     Each argument must be an hashable object. Returned hash is a negative or
     positive integer.
 
+    .. note::
+
+       This hash depends on the Python interpreter and is not unique for the
+       combination of objects. It is only used to find caches that were
+       created by older versions of this package. Use :meth:`stable_hash`
+       instead.
+
     Example::
 
         >>> a = Struct({'a': True})
@@ -234,7 +319,8 @@ def get_config_hashables(config):
     if preprocess:
         preprocess = deepcopy(preprocess)
         try:
-            del preprocess.segmentation.grabcut.output_folder
+            for options in vars(preprocess.segmentation).values():
+                del options.output_folder
         except:
             pass
 
@@ -244,6 +330,67 @@ def get_config_hashables(config):
 
     return hashables
 
+def get_feature_cache_key(name, feature, config):
+    """Return the cache key for a single feature configuration.
+
+    The key is created from the feature name `name`, the feature settings
+    `feature`, and the configuration objects returned by
+    :meth:`get_config_hashables` for the configurations `config`. Settings of
+    the feature that have no effect on the extracted features (e.g. the number
+    of clusters and the codebook settings for the bag-of-words) are ignored.
+    Returns a string.
+    """
+    feature = deepcopy(feature)
+    for setting in ('bow_clusters', 'codebook'):
+        try:
+            delattr(feature, setting)
+        except:
+            pass
+    return stable_hash(name, feature, *get_config_hashables(config))
+
+def get_image_size(path):
+    """Return the size of an image without decoding it.
+
+    The size is read from the header of JPEG and PNG files. Returns a 2-tuple
+    ``(width, height)``, or None if the size could not be determined.
+    """
+    with open(path, 'rb') as fh:
+        head = fh.read(24)
+
+        if head.startswith('\x89PNG\r\n\x1a\n') and head[12:16] == 'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if not head.startswith('\xff\xd8'):
+            return None
+
+        # Walk the JPEG markers until a start of frame (SOF) marker is found,
+        # which contains the image size.
+        fh.seek(2)
+        try:
+            while True:
+                byte = fh.read(1)
+                while byte and byte != '\xff':
+                    byte = fh.read(1)
+                while byte == '\xff':
+                    byte = fh.read(1)
+                if not byte:
+                    return None
+
+                marker = ord(byte)
+                if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                    # These markers have no length field.
+                    continue
+                if marker in (0xd9, 0xda):
+                    # End of image or start of scan.
+                    return None
+
+                length = struct.unpack('>H', fh.read(2))[0]
+                if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack('>xHH', fh.read(5))
+                    return (width, height)
+                fh.seek(length - 2, 1)
+        except struct.error:
+            return None
+
 def open_config(path):
     """Read a configurations file and return as a nested :class:`Struct` object.
 
@@ -324,13 +471,61 @@ def get_bowcode_from_surf_features(surf_features, codebook):
     """Return the BagOfWords code of SURF features.
 
     The codebook contains clustered SURF features.
-    A list of the corresponding clusters of the given
-    surf_features is returned.
+    An array with the normalized histogram of the corresponding clusters of
+    the given surf_features is returned.
     """
     code, _dist = vq.vq(surf_features, codebook)
     word_hist, _bin_edges = np.histogram(
         code, bins=range(codebook.shape[0] + 1), normed=True)
-    return list(word_hist)
+    return word_hist
+
+def get_bowcode_from_orb_features(orb_features, codebook):
+    """Return the BagOfWords code of ORB features.
+
+    The codebook contains clustered binary ORB descriptors (see
+    :meth:`~nbclassify.codebook.hamming_kmajority`), and each feature is
+    assigned to the cluster with the smallest Hamming distance. An array with
+    the normalized histogram of the clusters is returned.
+    """
+    code, _dist = hamming_vq(orb_features, codebook)
+    word_hist, _bin_edges = np.histogram(
+        code, bins=range(codebook.shape[0] + 1), normed=True)
+    return word_hist
+
+def get_bow_feature(features):
+    """Return the name of the feature for the BagOfWords model.
+
+    Returns the name of the first feature in :data:`BOW_FEATURES` for which
+    ``bow_clusters`` is set in the features configurations `features`, or
+    None if the BagOfWords model is not used.
+    """
+    for name in BOW_FEATURES:
+        if name in features and getattr(features[name], 'bow_clusters',
+                False):
+            return name
+    return None
+
+def get_codebook_index_settings(args):
+    """Return the codebook index settings of a BagOfWords feature.
+
+    Returns a 2-tuple ``(method, eps)`` with the ``index`` and ``eps``
+    settings of the ``codebook`` settings in the feature settings `args`,
+    which default to ``exact`` and 0 (see
+    :class:`~nbclassify.codebook.CodebookIndex`).
+    """
+    settings = getattr(args, 'codebook', None)
+    return (getattr(settings, 'index', 'exact'),
+        getattr(settings, 'eps', 0.0))
+
+def get_bowcode(name, descriptors, codebook):
+    """Return the BagOfWords code for the descriptors of feature `name`.
+
+    Uses :meth:`get_bowcode_from_orb_features` for binary ORB descriptors and
+    :meth:`get_bowcode_from_surf_features` otherwise.
+    """
+    if name == 'orb':
+        return get_bowcode_from_orb_features(descriptors, codebook)
+    return get_bowcode_from_surf_features(descriptors, codebook)
 
 
 class Struct(Namespace):
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""Vectorized routines for sampling images along rays.
+
+The shape features sample the image along rays from the center of an object
+to its outline, one ray per angle. These routines process all rays at once
+with NumPy, instead of processing one ray at a time. Rays can have any number
+of points on the outline; such points are stored in padded arrays with a mask
+(see :meth:`pad_points`).
+"""
+
+import numpy as np
+
+def line_pixels(starts, ends, shape=None):
+    """Return the pixels on line segments, as drawn by OpenCV.
+
+    Expects two sequences of ``(x, y)`` points `starts` and `ends` of equal
+    length, where line segment `i` runs from ``starts[i]`` to ``ends[i]``.
+    The pixels are the same as those set by :meth:`cv2.line` with thickness 1
+    and 8-connectivity, which draws a Bresenham line from the left-most to the
+    right-most end point. If the image shape `shape` is set, pixels outside
+    the image are discarded. Note that :meth:`cv2.line` clips line segments
+    to the image before drawing, so the pixels are only identical for end
+    points within the image.
+
+    Returns a 3-tuple ``(index, xs, ys)`` of integer arrays, with for each
+    pixel the index of its line segment and its coordinates.
+    """
+    starts = np.asarray(starts, dtype=np.int64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.int64).reshape(-1, 2)
+
+    # Draw from left to right.
+    swap = ends[:,0] < starts[:,0]
+    p1 = np.where(swap[:,None], ends, starts)
+    p2 = np.where(swap[:,None], starts, ends)
+
+    dx = p2[:,0] - p1[:,0]
+    dy = p2[:,1] - p1[:,1]
+    sy = np.where(dy < 0, -1, 1)
+    dy = np.abs(dy)
+
+    # Step along the major axis, and along the minor axis when the error
+    # term of the Bresenham algorithm becomes negative.
+    y_major = dy > dx
+    d_major = np.where(y_major, dy, dx)
+    d_minor = np.where(y_major, dx, dy)
+    counts = d_major + 1
+
+    index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    k = np.arange(counts.sum()) - np.repeat(offsets, counts)
+
+    # The number of minor steps after k major steps.
+    d_major_pix = np.repeat(d_major, counts)
+    d_minor_pix = np.repeat(d_minor, counts)
+    m = -((d_major_pix - 2 * d_minor_pix * k) // \
+        np.maximum(2 * d_major_pix, 1))
+    m[d_major_pix == 0] = 0
+
+    y_major_pix = np.repeat(y_major, counts)
+    xs = np.repeat(p1[:,0], counts) + np.where(y_major_pix, m, k)
+    ys = np.repeat(p1[:,1], counts) + np.repeat(sy, counts) * \
+        np.where(y_major_pix, k, m)
+
+    if shape is not None:
+        h, w = shape[:2]
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        index, xs, ys = index[inside], xs[inside], ys[inside]
+
+    return (index, xs, ys)
+
+def ray_histograms(img, index, xs, ys, n_rays, bins, ranges):
+    """Return color histograms for the pixels on rays.
+
+    Computes for each ray and each channel of the 8-bit image `img` the
+    histogram of the pixels on that ray. The pixels are given by `index`,
+    `xs` and `ys` as returned by :meth:`line_pixels`, where `n_rays` is the
+    number of rays. The number of bins and the ``(low, high)`` range for each
+    channel are set with `bins` and `ranges`. Values outside the range are
+    not counted.
+
+    The histograms are identical to those computed by :meth:`cv2.calcHist`
+    for each ray separately, with a mask for the pixels on the ray. Returns a
+    list with for each channel a float32 array of shape ``(n_rays, bins)``.
+    """
+    values = img[ys, xs].reshape(len(xs), -1)
+    hists = []
+    for ch, n in enumerate(bins):
+        # The bin for each possible value, as in the lookup table that
+        # cv2.calcHist uses for 8-bit images.
+        low, high = ranges[ch]
+        a = float(n) / (high - low)
+        b = -a * low
+        v = np.arange(256)
+        lut = np.clip(np.floor(v * a + b), 0, n - 1).astype(np.int64)
+        valid = (v >= low) & (v < high)
+
+        val = values[:,ch]
+        ok = valid[val]
+        counts = np.bincount(index[ok] * n + lut[val[ok]],
+            minlength=n_rays * n)
+        hists.append(counts.reshape(n_rays, n).astype(np.float32))
+    return hists
+
+def pad_points(point_lists):
+    """Return lists of points as a padded array with a mask.
+
+    Expects a sequence `point_lists` of ``n`` lists of ``(x, y)`` points,
+    where the lists can have different lengths, including zero. Returns a
+    2-tuple ``(points, mask)``, where `points` is a float array of shape
+    ``(n, m, 2)`` with `m` the length of the longest list, and `mask` is a
+    boolean array of shape ``(n, m)`` which is True for the elements of
+    `points` that are set.
+    """
+    counts = np.array([len(p) for p in point_lists], dtype=int)
+    m = counts.max() if len(counts) > 0 else 0
+    points = np.zeros((len(counts), m, 2), dtype=float)
+    mask = np.arange(m) < counts[:,None]
+    if mask.any():
+        points[mask] = [p for ray in point_lists for p in ray]
+    return (points, mask)
+
+def ray_mean_sd(center, points, mask):
+    """Return the mean and standard deviation of distances along rays.
+
+    For each ray, computes the distances from point `center` to the points on
+    that ray, given by `points` and `mask` as returned by :meth:`pad_points`.
+    Returns a 2-tuple ``(means, sds)`` of float32 arrays with the mean
+    distance and the sample standard deviation (``ddof=1``) for each ray. The
+    mean is 0 for rays without points, and the standard deviation is 0 for
+    rays with fewer than two points.
+    """
+    counts = mask.sum(axis=1)
+    delta = points - np.asarray(center, dtype=float)
+    distances = np.where(mask, np.sqrt((delta ** 2).sum(axis=2)), 0)
+
+    means = distances.sum(axis=1) / np.maximum(counts, 1)
+    deviations = np.where(mask, distances - means[:,None], 0)
+    sds = np.sqrt((deviations ** 2).sum(axis=1) / np.maximum(counts - 1, 1))
+    sds[counts < 2] = 0
+
+    return (means.astype(np.float32), sds.astype(np.float32))
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""Image segmentation routines.
+
+Segmentation backends separate the foreground from the background of an image.
+Each backend is a function ``backend(img, roi=None, **options)`` which returns
+a binary mask, an 8-bit single-channel image of the same size as `img`, where
+foreground pixels are 255 and background pixels are 0. The region of interest
+`roi` is a 4-tuple ``(x, y, width, height)``; pixels outside the ROI are
+always background. Backends are registered in :data:`BACKENDS` under the name
+that is used in the configurations (``preprocess.segmentation.<name>``), and
+are executed with :meth:`segment`.
+"""
+
+import inspect
+
+import cv2
+import numpy as np
+
+from .exceptions import ConfigurationError
+
+def grabcut(img, iters=5, roi=None, margin=5):
+    """Wrapper for OpenCV's grabCut function.
+
+    Runs the GrabCut algorithm for segmentation. Returns an 8-bit single-
+    channel mask. Its elements may have the following values:
+
+    * ``cv2.GC_BGD`` defines an obvious background pixel
+    * ``cv2.GC_FGD`` defines an obvious foreground pixel
+    * ``cv2.GC_PR_BGD`` defines a possible background pixel
+    * ``cv2.GC_PR_FGD`` defines a possible foreground pixel
+
+    The GrabCut algorithm is executed with `iters` iterations. The region of
+    interest `roi` can be a 4-tuple ``(x, y, width, height)``. If the ROI is
+    not set, the ROI is set to the entire image, with a margin of `margin`
+    pixels from the borders.
+    """
+    mask = np.zeros(img.shape[:2], np.uint8)
+    bgdmodel = np.zeros((1,65), np.float64)
+    fgdmodel = np.zeros((1,65), np.float64)
+
+    # Use the margin to set the ROI if the ROI was not provided.
+    if not roi:
+        h, w = img.shape[:2]
+        roi = (margin, margin, w - margin * 2, h - margin * 2)
+
+    cv2.grabCut(img, mask, tuple(roi), bgdmodel, fgdmodel, iters,
+        cv2.GC_INIT_WITH_RECT)
+
+    return mask
+
+def grabcut_pyramid(img, iters=5, roi=None, margin=5, levels=1, band=5,
+        refine_iters=1):
+    """Run GrabCut on a downscaled image and refine the result.
+
+    The image is scaled down `levels` times by a factor 2 and segmented with
+    :meth:`grabcut` with `iters` iterations. The resulting mask is scaled up
+    to the size of `img`. Only the pixels within `band` pixels from the
+    boundary of the foreground are then refined with `refine_iters` GrabCut
+    iterations at full resolution; all other pixels are marked as obvious
+    foreground or background. The refinement runs on the bounding box of
+    this band only.
+
+    Since the cost of GrabCut is roughly proportional to the number of
+    pixels, each level makes the initial segmentation about four times
+    cheaper. Arguments `roi` and `margin` are as for :meth:`grabcut` and are
+    given for the full resolution image. Returns a mask with the same values
+    as the mask returned by :meth:`grabcut`.
+    """
+    if levels < 1:
+        return grabcut(img, iters, roi, margin)
+
+    h, w = img.shape[:2]
+    factor = 2 ** levels
+
+    # Segment the downscaled image.
+    small = img
+    for i in range(levels):
+        small = cv2.pyrDown(small)
+    if roi:
+        small_roi = tuple(max(1, int(x / factor)) for x in roi)
+    else:
+        small_roi = None
+    small_mask = grabcut(small, iters, small_roi, max(1, margin // factor))
+    mask = cv2.resize(small_mask, (w, h), interpolation=cv2.INTER_NEAREST)
+
+    fg = np.where((mask == cv2.GC_FGD) + (mask == cv2.GC_PR_FGD), 255,
+        0).astype('uint8')
+    if refine_iters < 1 or band < 1 or not fg.any() or fg.all():
+        return mask
+
+    # Mark everything outside the band around the boundary of the foreground
+    # as obvious foreground or background.
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,
+        (2 * band + 1, 2 * band + 1))
+    outer = cv2.dilate(fg, kernel)
+    inner = cv2.erode(fg, kernel)
+    mask = np.where(fg > 0, cv2.GC_PR_FGD, cv2.GC_PR_BGD).astype('uint8')
+    mask[outer == 0] = cv2.GC_BGD
+    mask[inner > 0] = cv2.GC_FGD
+
+    # Pixels outside the ROI are background, as with the initial segmentation.
+    if roi:
+        x, y, rw, rh = roi
+        inside = np.zeros((h, w), dtype=bool)
+        inside[y:y+rh, x:x+rw] = True
+        mask[~inside] = cv2.GC_BGD
+
+    # Refine the band on its bounding box, with some obvious foreground and
+    # background around it.
+    ys, xs = np.nonzero((mask == cv2.GC_PR_FGD) + (mask == cv2.GC_PR_BGD))
+    if len(ys) == 0:
+        return mask
+    y1, y2 = max(0, ys.min() - band), min(h, ys.max() + band + 1)
+    x1, x2 = max(0, xs.min() - band), min(w, xs.max() + band + 1)
+    sub_mask = mask[y1:y2, x1:x2].copy()
+
+    # GrabCut needs both foreground and background samples.
+    has_bgd = ((sub_mask == cv2.GC_BGD) + (sub_mask == cv2.GC_PR_BGD)).any()
+    has_fgd = ((sub_mask == cv2.GC_FGD) + (sub_mask == cv2.GC_PR_FGD)).any()
+    if has_bgd and has_fgd:
+        bgdmodel = np.zeros((1,65), np.float64)
+        fgdmodel = np.zeros((1,65), np.float64)
+        cv2.grabCut(np.ascontiguousarray(img[y1:y2, x1:x2]), sub_mask, None,
+            bgdmodel, fgdmodel, refine_iters, cv2.GC_INIT_WITH_MASK)
+        mask[y1:y2, x1:x2] = sub_mask
+
+    return mask
+
+def mask_agreement(a, b):
+    """Return the agreement between two binary masks.
+
+    The agreement is the intersection over union of the nonzero pixels of
+    masks `a` and `b`, a value between 0 (no overlap) and 1 (identical masks).
+    Two empty masks agree completely.
+    """
+    a = np.asarray(a) > 0
+    b = np.asarray(b) > 0
+    union = np.count_nonzero(a | b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(a & b) / float(union)
+
+def segment_grabcut(img, roi=None, iters=5, margin=1, pyramid=None):
+    """Segment an image with GrabCut.
+
+    Cost profile: GrabCut fits color models and computes a graph cut over all
+    pixels in each of the `iters` iterations, which makes this by far the
+    most expensive backend, typically around a second per image with a
+    perimeter of 1000 pixels. It also gives the best results on cluttered
+    backgrounds. If `pyramid` is set, :meth:`grabcut_pyramid` is used with
+    the options in the dictionary `pyramid`, which is several times faster.
+    Otherwise :meth:`grabcut` is used.
+    """
+    if pyramid:
+        options = pyramid if isinstance(pyramid, dict) else {}
+        mask = grabcut_pyramid(img, iters, roi, margin, **options)
+    else:
+        mask = grabcut(img, iters, roi, margin)
+    return np.where((mask==cv2.GC_FGD) + (mask==cv2.GC_PR_FGD), 255,
+        0).astype('uint8')
+
+def segment_threshold(img, roi=None, channel='gray', blur=5,
+        foreground='auto'):
+    """Segment an image with Otsu's thresholding method.
+
+    The threshold that best separates the values of `channel` within the ROI
+    in two classes is computed, and pixels are assigned to the class on
+    their side of the threshold. The channel can be ``gray``, one of the HSV
+    channels ``hue``, ``saturation`` and ``value``, or one of the BGR
+    channels ``blue``, ``green`` and ``red``. The channel is first smoothed
+    with a Gaussian kernel of size `blur` (0 disables smoothing). If
+    `foreground` is ``bright`` or ``dark``, pixels above or below the
+    threshold are foreground. If it is ``auto``, the class that covers most
+    of the border of the ROI is background.
+
+    Cost profile: a color conversion, a histogram and a single pass over the
+    pixels, typically a few milliseconds per image, which makes this the
+    cheapest backend. Only suitable if the object stands out from a fairly
+    uniform background in the chosen channel.
+    """
+    channels = {
+        'hue': 0, 'saturation': 1, 'value': 2,
+        'blue': 0, 'green': 1, 'red': 2
+    }
+    if channel == 'gray':
+        values = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    elif channel in ('hue', 'saturation', 'value'):
+        values = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)[:,:,channels[channel]]
+    elif channel in ('blue', 'green', 'red'):
+        values = img[:,:,channels[channel]]
+    else:
+        raise ConfigurationError("Unknown channel `%s` for thresholding" % \
+            channel)
+    if foreground not in ('auto', 'bright', 'dark'):
+        raise ConfigurationError("Foreground must be auto, bright or dark")
+
+    h, w = img.shape[:2]
+    x, y, rw, rh = roi if roi else (0, 0, w, h)
+    values = np.ascontiguousarray(values[y:y+rh, x:x+rw])
+    if blur:
+        values = cv2.GaussianBlur(values, (blur | 1, blur | 1), 0)
+
+    _, bin_roi = cv2.threshold(values, 0, 255,
+        cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    if foreground == 'auto':
+        border = np.concatenate((bin_roi[0], bin_roi[-1], bin_roi[:,0],
+            bin_roi[:,-1]))
+        invert = np.count_nonzero(border) > len(border) / 2
+    else:
+        invert = foreground == 'dark'
+    if invert:
+        bin_roi = 255 - bin_roi
+
+    mask = np.zeros((h, w), dtype=np.uint8)
+    mask[y:y+rh, x:x+rw] = bin_roi
+    return mask
+
+def segment_watershed(img, roi=None, margin=5, core=0.2):
+    """Segment an image with the watershed algorithm, seeded by the ROI.
+
+    Pixels outside the ROI are marked as background, and a rectangle at the
+    center of the ROI with a size of `core` times the size of the ROI is
+    marked as foreground. The watershed algorithm then floods the remaining
+    pixels from these markers. If the ROI is not set, the ROI is set to the
+    entire image, with a margin of `margin` pixels from the borders. This
+    assumes that the object is roughly centered in the ROI.
+
+    Cost profile: a single priority flood over the pixels, typically an order
+    of magnitude cheaper than GrabCut. Works well for objects with clear
+    edges, but the boundary follows the strongest edges between the markers
+    and may leak through weak edges.
+    """
+    h, w = img.shape[:2]
+    if not roi:
+        margin = max(1, margin)
+        roi = (margin, margin, w - margin * 2, h - margin * 2)
+    x, y, rw, rh = roi
+
+    markers = np.ones((h, w), dtype=np.int32)
+    markers[y:y+rh, x:x+rw] = 0
+
+    cx, cy = x + rw / 2.0, y + rh / 2.0
+    dx, dy = max(1, rw * core / 2.0), max(1, rh * core / 2.0)
+    markers[int(cy - dy):int(cy + dy), int(cx - dx):int(cx + dx)] = 2
+
+    cv2.watershed(np.ascontiguousarray(img), markers)
+    return np.where(markers == 2, 255, 0).astype('uint8')
+
+# The segmentation backends, by the name used in the configurations.
+BACKENDS = {
+    'grabcut': segment_grabcut,
+    'threshold': segment_threshold,
+    'watershed': segment_watershed
+}
+
+def segment(img, method, roi=None, **options):
+    """Segment an image with a segmentation backend.
+
+    Executes the backend registered as `method` in :data:`BACKENDS` on image
+    `img` with region of interest `roi` and options `options`. Returns the
+    binary mask returned by the backend. Raises a ConfigurationError if the
+    backend or any of the options is unknown.
+    """
+    try:
+        backend = BACKENDS[method]
+    except KeyError:
+        raise ConfigurationError("Unknown segmentation method `%s`" % method)
+
+    args = inspect.getargspec(backend).args[2:]
+    for name in options:
+        if name not in args:
+            raise ConfigurationError("Unknown option `%s` for segmentation " \
+                "method `%s`" % (name, method))
+
+    return backend(img, roi, **options)
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent storage for extracted features.
+
+Phenotypes are stored as rows of a memory-mapped matrix. An
+:class:`ArrayStore` stores one row per key and is used for features with a
+fixed length. A :class:`RaggedArrayStore` stores any number of rows per key
+and is used for local descriptors, such as those of SURF and ORB, of which
+each image has a different number. A :class:`ShardedArrayStore` spreads local
+descriptors over several ragged stores of bounded size.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import yaml
+
+def _write_meta(path, meta):
+    """Write the metadata `meta` of a store to file `path`.
+
+    The metadata is written to a temporary file first, which then replaces
+    `path`, so that an interrupted process never leaves incomplete metadata.
+    Since a store exists once its metadata exists, the files of the store
+    must be created before this is called.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        yaml.safe_dump(meta, fh, default_flow_style=False)
+    os.rename(tmp_path, path)
+
+class ArrayStore(object):
+
+    """Store fixed length phenotypes as rows of a memory-mapped matrix.
+
+    A store is a directory containing the following files:
+
+    * ``data.bin``: The phenotypes as a contiguous, row-major matrix.
+    * ``index.txt``: The key for each row in the matrix, one per line.
+    * ``meta.yml``: The data type and the number of columns of the matrix.
+
+    Rows are only ever appended. Setting a key that already exists appends a
+    new row and the key then refers to that new row. The matrix is
+    memory-mapped when it is read, so looking up the phenotype for a key does
+    not require loading the whole store into memory.
+
+    An instance of this class behaves like a read-only dictionary, with the
+    exception that phenotypes can be added with ``store[key] = phenotype``.
+    """
+
+    def __init__(self, path, dtype=np.float32):
+        """Open or create the store in directory `path`.
+
+        The data type `dtype` is only used if a new store is created. Existing
+        stores always keep the data type they were created with.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.columns = None
+        self._index = {}
+        self._keys = []
+        self._matrix = None
+        self._sizes = None
+
+        if os.path.isfile(self._meta_path):
+            self._load()
+
+    @classmethod
+    def exists(cls, path):
+        """Return True if a store exists in directory `path`."""
+        return os.path.isfile(os.path.join(path, 'meta.yml'))
+
+    @property
+    def _data_path(self):
+        return os.path.join(self.path, 'data.bin')
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.path, 'index.txt')
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.path, 'meta.yml')
+
+    def _load(self):
+        """Load the metadata and the row index from disk.
+
+        Rows for which the data or the key was not completely written (e.g.
+        when the process writing the store was killed) are ignored. They are
+        removed from the files before the next row is added (see
+        :meth:`_truncate`).
+        """
+        with open(self._meta_path, 'r') as fh:
+            meta = yaml.safe_load(fh)
+        self.dtype = np.dtype(str(meta['dtype']))
+        self.columns = int(meta['columns'])
+
+        lines = self._read_index()
+        row_size = self.dtype.itemsize * self.columns
+        n_rows = min(len(lines), self._file_size(self._data_path) // row_size)
+
+        self._keys = [line.rstrip('\r') for line in lines[:n_rows]]
+        self._index = {}
+        for i, key in enumerate(self._keys):
+            self._index[key] = i
+        self._matrix = None
+        self._set_sizes(n_rows * row_size, lines[:n_rows])
+
+    def _file_size(self, path):
+        """Return the size of file `path`, or 0 if it does not exist."""
+        if not os.path.isfile(path):
+            return 0
+        return os.path.getsize(path)
+
+    def _read_index(self):
+        """Return the lines of the index file.
+
+        A last line without a newline was not completely written and is left
+        out.
+        """
+        if not os.path.isfile(self._index_path):
+            return []
+        with open(self._index_path, 'rb') as fh:
+            return fh.read().split('\n')[:-1]
+
+    def _set_sizes(self, data_size, lines):
+        """Set the sizes of the data and the index files after loading.
+
+        The size of the data file is `data_size` and the index consists of
+        the lines `lines`. Anything beyond these sizes was not completely
+        written, and is removed by :meth:`_truncate`.
+        """
+        index_size = sum(len(line) + 1 for line in lines)
+        if self._file_size(self._data_path) > data_size or \
+                self._file_size(self._index_path) > index_size:
+            self._sizes = (data_size, index_size)
+        else:
+            self._sizes = None
+
+    def _truncate(self):
+        """Remove incompletely written rows from the end of the files.
+
+        This must be done before a row is added, because rows are appended
+        to the files and the position of a row follows from its line in the
+        index. This is not done when the store is loaded, so that reading a
+        store never changes it.
+        """
+        if self._sizes is None:
+            return
+        for path, size in zip((self._data_path, self._index_path),
+                self._sizes):
+            if self._file_size(path) > size:
+                with open(path, 'r+b') as fh:
+                    fh.truncate(size)
+        self._sizes = None
+
+    def _create(self, columns):
+        """Create a new, empty store with `columns` columns."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.columns = int(columns)
+        open(self._data_path, 'wb').close()
+        open(self._index_path, 'w').close()
+        _write_meta(self._meta_path, self._get_meta())
+
+    def _get_meta(self):
+        """Return the metadata that is saved in ``meta.yml``."""
+        return {
+            'dtype': self.dtype.name,
+            'columns': self.columns
+        }
+
+    def get_matrix(self):
+        """Return the memory-mapped matrix with all rows.
+
+        The matrix may contain rows that are no longer referenced by any key.
+        Use :meth:`row` to get the row number for a key.
+        """
+        if self._matrix is None:
+            if not self._keys:
+                return np.empty((0, self.columns or 0), dtype=self.dtype)
+            self._matrix = np.memmap(self._data_path, dtype=self.dtype,
+                mode='r', shape=(len(self._keys), self.columns))
+        return self._matrix
+
+    def row(self, key):
+        """Return the row number for key `key`."""
+        return self._index[str(key)]
+
+    def keys(self):
+        """Return the keys for the phenotypes in this store."""
+        return self._index.keys()
+
+    def __contains__(self, key):
+        return str(key) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __getitem__(self, key):
+        return self.get_matrix()[self._index[str(key)]]
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value, dtype=self.dtype).ravel()
+        if self.columns is None:
+            self._create(len(value))
+        if len(value) != self.columns:
+            raise ValueError("Expected a phenotype of length %d, got %d" % \
+                (self.columns, len(value)))
+
+        # The data row must be on disk before the key is, so that a key never
+        # refers to an incomplete row.
+        self._truncate()
+        with open(self._data_path, 'ab') as fh:
+            value.tofile(fh)
+        with open(self._index_path, 'a') as fh:
+            fh.write("%s\n" % key)
+
+        self._index[str(key)] = len(self._keys)
+        self._keys.append(str(key))
+        self._matrix = None
+
+    def stale_rows(self):
+        """Return the number of rows that are no longer referenced by a key."""
+        return len(self._keys) - len(self._index)
+
+    def compact(self, keys=None):
+        """Rewrite the store without unreferenced rows.
+
+        Only the rows for keys in `keys` are kept. If `keys` is None, the rows
+        for all keys are kept, which only removes rows that were replaced by
+        setting an existing key. The new store is written next to the current
+        one and then replaces it, so that the store is never left in an
+        incomplete state. Returns the number of rows removed.
+        """
+        if self.columns is None:
+            return 0
+        if keys is None:
+            keys = self._keys
+        keys = sorted(set(str(k) for k in keys if str(k) in self._index),
+            key=self._index.get)
+
+        n_removed = len(self._keys) - len(keys)
+        if n_removed == 0:
+            return 0
+
+        matrix = self.get_matrix()
+        tmp_path = self.path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        new = self.__class__(tmp_path, self.dtype)
+        new._create(self.columns)
+        self._write_rows(new, keys)
+
+        del matrix
+        self.close()
+        old_path = self.path + '.old'
+        os.rename(self.path, old_path)
+        os.rename(tmp_path, self.path)
+        shutil.rmtree(old_path)
+        self._load()
+
+        return n_removed
+
+    def _write_rows(self, new, keys):
+        """Write the rows for keys `keys` to the empty store `new`."""
+        matrix = self.get_matrix()
+        with open(new._data_path, 'ab') as fh:
+            for key in keys:
+                matrix[self._index[key]].tofile(fh)
+        with open(new._index_path, 'a') as fh:
+            for key in keys:
+                fh.write("%s\n" % key)
+
+    def close(self):
+        """Release the memory-mapped matrix."""
+        self._matrix = None
+
+class RaggedArrayStore(ArrayStore):
+
+    """Store any number of rows per key in a memory-mapped matrix.
+
+    This is the equivalent of :class:`ArrayStore` for phenotypes that consist
+    of a variable number of rows of equal length, such as the local
+    descriptors of an image. The rows for all keys are stored in a single
+    contiguous matrix, and each line of ``index.txt`` holds a key and its
+    number of rows. The offset of the rows for each key follows from these
+    numbers, so the rows for a key are a slice of the matrix that is
+    returned without copying. The matrix with all rows, as needed to create a
+    codebook, is available with :meth:`get_matrix`.
+
+    Methods that count rows of an :class:`ArrayStore`, such as
+    :meth:`stale_rows` and :meth:`compact`, count entries instead.
+    """
+
+    def __init__(self, path, dtype=np.float32):
+        self._spans = {}
+        self._counts = []
+        ArrayStore.__init__(self, path, dtype)
+
+    def _load(self):
+        """Load the metadata and the row index from disk.
+
+        Entries for which the rows or the index line were not completely
+        written (e.g. when the process writing the store was killed) are
+        ignored. They are removed from the files before the next entry is
+        added (see :meth:`_truncate`).
+        """
+        with open(self._meta_path, 'r') as fh:
+            meta = yaml.safe_load(fh)
+        self.dtype = np.dtype(str(meta['dtype']))
+        self.columns = int(meta['columns'])
+
+        lines = self._read_index()
+        row_size = self.dtype.itemsize * self.columns
+        n_rows = self._file_size(self._data_path) // max(row_size, 1)
+
+        self._keys = []
+        self._counts = []
+        self._spans = {}
+        self._index = {}
+        start = 0
+        for line in lines:
+            key, count = line.rstrip('\r').rsplit(' ', 1)
+            stop = start + int(count)
+            if stop > n_rows:
+                break
+            self._index[key] = len(self._keys)
+            self._spans[key] = (start, stop)
+            self._keys.append(key)
+            self._counts.append(int(count))
+            start = stop
+        self._matrix = None
+        self._set_sizes(start * row_size, lines[:len(self._keys)])
+
+    def _get_meta(self):
+        meta = ArrayStore._get_meta(self)
+        meta['ragged'] = True
+        return meta
+
+    def get_matrix(self):
+        """Return the memory-mapped matrix with the rows for all keys.
+
+        The matrix may contain rows that are no longer referenced by any key.
+        Use :meth:`span` to get the rows for a key.
+        """
+        if self._matrix is None:
+            n_rows = sum(self._counts)
+            if n_rows == 0:
+                return np.empty((0, self.columns or 0), dtype=self.dtype)
+            self._matrix = np.memmap(self._data_path, dtype=self.dtype,
+                mode='r', shape=(n_rows, self.columns))
+        return self._matrix
+
+    def row_count(self):
+        """Return the number of rows in the matrix."""
+        return sum(self._counts)
+
+    def span(self, key):
+        """Return the rows for key `key` as a 2-tuple ``(start, stop)``."""
+        return self._spans[str(key)]
+
+    def count(self, key):
+        """Return the number of rows for key `key`."""
+        start, stop = self._spans[str(key)]
+        return stop - start
+
+    def row_indices(self, keys):
+        """Return the row numbers for keys `keys` as a single array.
+
+        The row numbers are in the order of `keys`. Returns None if these are
+        exactly the rows of the matrix, in which case the matrix can be used
+        as is.
+        """
+        spans = [self._spans[str(k)] for k in keys]
+        if self._is_whole_matrix(spans):
+            return None
+        if not spans:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, stop, dtype=np.int64) \
+            for start, stop in spans])
+
+    def _is_whole_matrix(self, spans):
+        """Return True if `spans` are the consecutive rows of the matrix."""
+        stop = 0
+        for span in spans:
+            if span[0] != stop:
+                return False
+            stop = span[1]
+        return stop == sum(self._counts)
+
+    def get_rows(self, keys):
+        """Return the rows for keys `keys` as a single matrix.
+
+        The rows are in the order of `keys`. If these are exactly the rows of
+        the matrix, the memory-mapped matrix is returned as is. Otherwise the
+        rows are copied into a new array.
+        """
+        spans = [self._spans[str(k)] for k in keys]
+        matrix = self.get_matrix()
+        if self._is_whole_matrix(spans):
+            return matrix
+
+        n_rows = sum(stop - start for start, stop in spans)
+        rows = np.empty((n_rows, self.columns or 0), dtype=self.dtype)
+        i = 0
+        for start, stop in spans:
+            rows[i:i + stop - start] = matrix[start:stop]
+            i += stop - start
+        return rows
+
+    def __getitem__(self, key):
+        start, stop = self._spans[str(key)]
+        return self.get_matrix()[start:stop]
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value, dtype=self.dtype)
+        if self.columns is None:
+            if value.size == 0 and value.ndim < 2:
+                raise ValueError("Cannot infer the number of columns from " \
+                    "an empty value")
+            self._create(value.shape[-1] if value.ndim > 1 else value.size)
+        if value.size % max(self.columns, 1) or \
+                (value.ndim > 1 and value.shape[-1] != self.columns):
+            raise ValueError("Expected rows of length %d, got %s" % \
+                (self.columns, value.shape))
+        value = value.reshape(-1, self.columns)
+
+        self._truncate()
+        with open(self._data_path, 'ab') as fh:
+            value.tofile(fh)
+        with open(self._index_path, 'a') as fh:
+            fh.write("%s %d\n" % (key, len(value)))
+
+        start = sum(self._counts)
+        self._index[str(key)] = len(self._keys)
+        self._spans[str(key)] = (start, start + len(value))
+        self._keys.append(str(key))
+        self._counts.append(len(value))
+        self._matrix = None
+
+    def _write_rows(self, new, keys):
+        matrix = self.get_matrix()
+        with open(new._data_path, 'ab') as fh:
+            for key in keys:
+                start, stop = self._spans[key]
+                matrix[start:stop].tofile(fh)
+        with open(new._index_path, 'a') as fh:
+            for key in keys:
+                start, stop = self._spans[key]
+                fh.write("%s %d\n" % (key, stop - start))
+
+class ConcatenatedMatrix(object):
+
+    """The rows of several matrices as a single read-only matrix.
+
+    Supports ``len()`` and indexing with a slice or an array of row numbers,
+    which returns the rows as a new array. Only the indexed rows are read,
+    so the matrices can be memory-mapped matrices that together do not fit
+    in memory.
+    """
+
+    def __init__(self, matrices, columns, dtype):
+        self.matrices = matrices
+        self.dtype = np.dtype(dtype)
+        self.offsets = np.cumsum([0] + [len(m) for m in matrices])
+        self.shape = (int(self.offsets[-1]), columns)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self)))
+        index = np.asarray(index, dtype=np.int64)
+        rows = np.empty((len(index), self.shape[1]), dtype=self.dtype)
+        matrix_numbers = np.searchsorted(self.offsets, index, side='right') - 1
+        for i in np.unique(matrix_numbers):
+            mask = matrix_numbers == i
+            rows[mask] = self.matrices[i][index[mask] - self.offsets[i]]
+        return rows
+
+class ShardedArrayStore(object):
+
+    """Store local descriptors in shards of bounded size.
+
+    A sharded store is a directory with a file ``shards.yml`` and numbered
+    subdirectories ``shard-00000``, ``shard-00001``, etc., each of which is
+    a :class:`RaggedArrayStore`. Descriptors are appended to the last shard
+    until it holds `shard_size` rows, after which a new shard is started.
+    Since each shard only ever grows, an interrupted process loses at most
+    the entry that was being written, and can resume by skipping the keys
+    that are already in the store. Only the last shard is ever written to,
+    so only that shard can contain an incompletely written entry. It is
+    ignored, and removed before the next entry is added (see
+    :meth:`RaggedArrayStore._load`). A shard that was being created when the
+    process was interrupted has no metadata yet, and is created again.
+
+    The store has the same interface as a :class:`RaggedArrayStore`. The
+    matrix returned by :meth:`get_matrix` is a :class:`ConcatenatedMatrix`
+    of the matrices of the shards.
+    """
+
+    def __init__(self, path, dtype=np.float32, shard_size=100000):
+        """Open or create the store in directory `path`.
+
+        The data type `dtype` and the shard size `shard_size` are only used
+        if a new store is created.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shard_size = int(shard_size)
+        self._shards = []
+        self._where = {}
+
+        if self.exists(path):
+            with open(self._meta_path, 'r') as fh:
+                meta = yaml.safe_load(fh)
+            self.dtype = np.dtype(str(meta['dtype']))
+            self.shard_size = int(meta['shard_size'])
+            for name in sorted(os.listdir(path)):
+                if name.startswith('shard-'):
+                    self._add_shard(RaggedArrayStore(os.path.join(path, name),
+                        self.dtype))
+
+    @classmethod
+    def exists(cls, path):
+        """Return True if a sharded store exists in directory `path`."""
+        return os.path.isfile(os.path.join(path, 'shards.yml'))
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.path, 'shards.yml')
+
+    @property
+    def columns(self):
+        for shard in self._shards:
+            if shard.columns is not None:
+                return shard.columns
+        return None
+
+    def _add_shard(self, shard):
+        n = len(self._shards)
+        self._shards.append(shard)
+        for key in shard.keys():
+            self._where[key] = n
+
+    def shards(self):
+        """Return the shards, each a :class:`RaggedArrayStore`."""
+        return list(self._shards)
+
+    def keys(self):
+        """Return the keys for the descriptors in this store."""
+        return self._where.keys()
+
+    def __contains__(self, key):
+        return str(key) in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+    def __iter__(self):
+        return iter(self._where)
+
+    def __getitem__(self, key):
+        return self._shards[self._where[str(key)]][key]
+
+    def __setitem__(self, key, value):
+        if not self.exists(self.path):
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            _write_meta(self._meta_path, {
+                'dtype': self.dtype.name,
+                'shard_size': self.shard_size
+            })
+
+        if not self._shards or \
+                self._shards[-1].row_count() >= self.shard_size:
+            path = os.path.join(self.path, 'shard-%05d' % len(self._shards))
+            self._add_shard(RaggedArrayStore(path, self.dtype))
+
+        self._shards[-1][key] = value
+        self._where[str(key)] = len(self._shards) - 1
+
+    def count(self, key):
+        """Return the number of rows for key `key`."""
+        return self._shards[self._where[str(key)]].count(key)
+
+    def get_matrix(self):
+        """Return the rows of all shards as a :class:`ConcatenatedMatrix`."""
+        return ConcatenatedMatrix([s.get_matrix() for s in self._shards],
+            self.columns or 0, self.dtype)
+
+    def row_indices(self, keys):
+        """Return the row numbers in :meth:`get_matrix` for keys `keys`.
+
+        As :meth:`RaggedArrayStore.row_indices`, except that an array is
+        always returned.
+        """
+        offsets = np.cumsum([0] + [s.row_count() for s in self._shards])
+        rows = [np.empty(0, dtype=np.int64)]
+        for key in keys:
+            n = self._where[str(key)]
+            start, stop = self._shards[n].span(key)
+            rows.append(np.arange(offsets[n] + start, offsets[n] + stop,
+                dtype=np.int64))
+        return np.concatenate(rows)
+
+    def get_rows(self, keys):
+        """Return the rows for keys `keys` as a single matrix."""
+        return self.get_matrix()[self.row_indices(keys)]
+
+    def stale_rows(self):
+        """Return the number of entries that are no longer referenced."""
+        return sum(len(s._keys) for s in self._shards) - len(self._where)
+
+    def close(self):
+        """Release the memory-mapped matrices."""
+        for shard in self._shards:
+            shard.close()
+
+def open_store(path, dtype=np.float32):
+    """Open the store in directory `path`.
+
+    Returns a :class:`ShardedArrayStore` or a :class:`RaggedArrayStore` if
+    the store was created as such, and an :class:`ArrayStore` otherwise. The
+    data type `dtype` is only used if the store does not exist yet, in which
+    case an :class:`ArrayStore` is created.
+    """
+    if ShardedArrayStore.exists(path):
+        return ShardedArrayStore(path)
+    meta_path = os.path.join(path, 'meta.yml')
+    if os.path.isfile(meta_path):
+        with open(meta_path, 'r') as fh:
+            meta = yaml.safe_load(fh)
+        if meta.get('ragged'):
+            return RaggedArrayStore(path, dtype)
+    return ArrayStore(path, dtype)
@@ -2,23 +2,73 @@
 
 """ANN training routines."""
 
+import filecmp
 import logging
+import multiprocessing
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 
+import numpy as np
 from pyfann import libfann
 import yaml
 
 from . import conf, ANN_DEFAULTS
 from .base import Common, Struct
-from .data import TrainData
+from .codebook import get_codebook_path, get_meta_path
+from .data import (TrainData, TrainDataCache, is_binary_train_file,
+    get_layout_path, read_layout)
 from .exceptions import *
 from .functions import (get_codewords, get_classification,
-    classification_hierarchy_filters, readable_filter)
+    classification_hierarchy_filters, readable_filter, stable_hash)
 import nbclassify.db as db
 
+# The training settings that determine the topology of a neural network. A
+# network is only trained further if these are unchanged.
+TOPOLOGY_OPTIONS = ('train_type', 'hidden_layers', 'hidden_neurons',
+    'connection_rate', 'activation_function_hidden',
+    'activation_function_output')
+
+def load_data(path, dependent_prefix, subset=None, cache=None):
+    """Return the training data from file `path`.
+
+    If `subset` is set, only the samples with a label in `subset` are
+    returned. The data is loaded from the
+    :class:`~nbclassify.data.TrainDataCache` `cache` if set.
+    """
+    if cache is not None:
+        return cache.get(path, dependent_prefix, subset)
+
+    data = TrainData()
+    data.read_from_file(path, dependent_prefix)
+    if subset is not None:
+        data = data.subset(subset)
+    return data
+
+def get_validation_mask(output, fraction, seed=None):
+    """Return which samples to hold out from training for validation.
+
+    Holds out a fraction `fraction` of the samples of each class, but keeps
+    at least one sample of each class for training. The class of a sample is
+    the column with the highest value in its row of the output data
+    `output`. Returns a boolean array which is True for the samples that are
+    held out. The samples are chosen at random, and the random number
+    generator is seeded with `seed`.
+    """
+    rng = np.random.RandomState(seed)
+    classes = np.argmax(output, axis=1)
+    mask = np.zeros(len(classes), dtype=bool)
+    for c in np.unique(classes):
+        rows = np.flatnonzero(classes == c)
+        n = min(int(round(fraction * len(rows))), len(rows) - 1)
+        if n > 0:
+            mask[rng.permutation(rows)[:n]] = True
+    return mask
+
 class TrainANN(object):
 
     """Train artificial neural networks."""
@@ -28,6 +78,9 @@ class TrainANN(object):
         self.ann = None
         self.train_data = None
         self.test_data = None
+        self.best_epoch = None
+        self.best_error = None
+        self.stopped_epoch = None
 
         # Set the default training settings.
         for option, val in ANN_DEFAULTS.iteritems():
@@ -46,9 +99,14 @@ class TrainANN(object):
             raise ValueError("Train data is empty")
         self.train_data = data
 
-    def train(self, data):
+    def train(self, data, ann=None):
         """Train a neural network on training data `data`.
 
+        If a FANN structure `ann` is given, training continues from that
+        network instead of a new network with random weights. This is only
+        supported for ordinary training, and the network must have the same
+        number of inputs and outputs as the training data.
+
         Returns a FANN structure.
         """
         self.set_train_data(data)
@@ -61,6 +119,20 @@ class TrainANN(object):
                 raise ValueError("Expected TRAIN_RPROP or TRAIN_QUICKPROP "\
                     "as the training algorithm")
 
+        if self.train_type == 'ordinary' and self.epochs < 1:
+            raise ValueError("The number of epochs must be at least 1")
+        if not 0 <= self.validation_split < 1:
+            raise ValueError("The validation split must be at least 0 and " \
+                "less than 1")
+        if ann is not None:
+            if self.train_type != 'ordinary':
+                raise ValueError("Only ordinary training can continue " \
+                    "from an existing network")
+            if ann.get_num_input() != self.train_data.num_input or \
+                    ann.get_num_output() != self.train_data.num_output:
+                raise ValueError("The number of inputs and outputs of the " \
+                    "network must be the same as for the train data")
+
         # Get FANN train data object.
         fann_train_data = libfann.training_data()
         fann_train_data.set_train_data(self.train_data.get_input(),
@@ -72,8 +144,11 @@ class TrainANN(object):
             layers.extend(hidden_layers)
             layers.append(self.train_data.num_output)
 
-            self.ann = libfann.neural_net()
-            self.ann.create_sparse_array(self.connection_rate, layers)
+            if ann is not None:
+                self.ann = ann
+            else:
+                self.ann = libfann.neural_net()
+                self.ann.create_sparse_array(self.connection_rate, layers)
 
             # Set training parameters.
             self.ann.set_learning_rate(self.learning_rate)
@@ -84,12 +159,19 @@ class TrainANN(object):
             self.ann.set_training_algorithm(
                 getattr(libfann, self.training_algorithm))
 
-            sys.stderr.write("Ordinary training...\n")
+            if ann is not None:
+                sys.stderr.write("Ordinary training, continuing from an " \
+                    "existing network...\n")
+            else:
+                sys.stderr.write("Ordinary training...\n")
             self.ann.print_parameters()
 
             # Ordinary training.
-            self.ann.train_on_data(fann_train_data, self.epochs,
-                self.iterations_between_reports, self.desired_error)
+            if self.validation_split > 0 or self.patience > 0:
+                self._train_epochs()
+            else:
+                self.ann.train_on_data(fann_train_data, self.epochs,
+                    self.iterations_between_reports, self.desired_error)
 
         if self.train_type == 'cascade':
             # This algorithm adds neurons to the neural network while training,
@@ -120,6 +202,110 @@ class TrainANN(object):
 
         return self.ann
 
+    def split_train_data(self, fraction):
+        """Split the training data into a training and a validation set.
+
+        Holds out a fraction `fraction` of the samples of each class (see
+        :meth:`get_validation_mask`). The samples are chosen at random with
+        seed ``validation_seed``, so that the same samples are held out each
+        time. Returns a 2-tuple ``(train,
+        validation)`` of FANN training data objects, where `validation` is
+        None if no samples were held out.
+        """
+        input_ = self.train_data.get_input()
+        output = self.train_data.get_output()
+        held_out = get_validation_mask(output, fraction,
+            self.validation_seed)
+
+        if not held_out.any():
+            return (self._get_fann_data(input_, output), None)
+
+        train = self._get_fann_data(input_[~held_out], output[~held_out])
+        validation = self._get_fann_data(input_[held_out], output[held_out])
+        return (train, validation)
+
+    def _get_fann_data(self, input_, output):
+        """Return a FANN training data object for `input_` and `output`."""
+        data = libfann.training_data()
+        data.set_train_data(input_, output)
+        return data
+
+    def _train_epochs(self):
+        """Train the neural network one epoch at a time.
+
+        Holds out ``validation_split`` of the training data as a validation
+        set and computes the mean square error on the validation set every
+        ``validation_interval`` epochs, or the error on the training data if
+        nothing is held out. Training stops when the training error reaches
+        ``desired_error``, after ``epochs`` epochs, or when the error did not
+        improve by more than ``min_improvement`` for ``patience`` epochs, if
+        `patience` is set. The network with the lowest error is kept, and the
+        error and the epoch of that network are set as `best_error` and
+        `best_epoch`.
+        """
+        fann_train_data, fann_val_data = \
+            self.split_train_data(self.validation_split)
+        if self.validation_split > 0 and fann_val_data is None:
+            logging.warning("Too few samples for a validation set; using " \
+                "the training error for early stopping")
+
+        interval = max(int(self.validation_interval), 1)
+        best_is_current = False
+        self.best_epoch = None
+        self.best_error = None
+
+        # The best network is saved to a temporary file, so that it can be
+        # restored if the error did not improve in later epochs.
+        fd, checkpoint = tempfile.mkstemp(suffix='.ann')
+        os.close(fd)
+        try:
+            for epoch in xrange(1, self.epochs + 1):
+                train_error = self.ann.train_epoch(fann_train_data)
+                done = train_error <= self.desired_error or \
+                    epoch == self.epochs
+
+                if epoch % interval == 0 or done:
+                    if fann_val_data is not None:
+                        self.ann.reset_MSE()
+                        error = self.ann.test_data(fann_val_data)
+                    else:
+                        error = train_error
+
+                    best_is_current = self.best_error is None or \
+                        error < self.best_error - self.min_improvement
+                    if best_is_current:
+                        self.best_error = error
+                        self.best_epoch = epoch
+                        self.ann.save(checkpoint)
+                    elif self.patience > 0 and \
+                            epoch - self.best_epoch >= self.patience:
+                        sys.stderr.write("No improvement in %d epochs; " \
+                            "stopping early\n" % (epoch - self.best_epoch))
+                        done = True
+
+                if self.best_error is not None and \
+                        self.iterations_between_reports > 0 and \
+                        epoch % self.iterations_between_reports == 0:
+                    sys.stderr.write("Epochs %8d. Current error: %.10f. " \
+                        "Best error: %.10f (epoch %d)\n" % (epoch,
+                        train_error, self.best_error, self.best_epoch))
+
+                if done:
+                    break
+
+            self.stopped_epoch = epoch
+
+            # Restore the best network.
+            if not best_is_current:
+                self.ann = libfann.neural_net()
+                self.ann.create_from_file(checkpoint)
+        finally:
+            os.remove(checkpoint)
+
+        logging.info("Stopped training after %d epochs; the best network " \
+            "was found at epoch %d with error %f" % (self.stopped_epoch,
+            self.best_epoch, self.best_error))
+
     def test(self, data):
         """Test the trained neural network.
 
@@ -206,6 +392,98 @@ class MakeAnn(Common):
         super(MakeAnn, self).__init__(config)
         self._train_method = 'default'
         self._aivolver_config_path = None
+        self.subset = None
+        self.data_cache = None
+        self.warm_start = False
+
+    def set_subset(self, subset):
+        """Set the sample subset that should be used for training.
+
+        A subset of the samples in the training data can be used by providing
+        a list of sample labels `subset` for the samples to be used. If subset
+        is None, all samples are used.
+        """
+        if subset is not None and not isinstance(subset, set):
+            subset = set(subset)
+        self.subset = subset
+
+    def set_data_cache(self, cache):
+        """Set a :class:`~nbclassify.data.TrainDataCache` `cache`.
+
+        If set, training data files are loaded from the cache, so that each
+        file is loaded only once when training on several subsets of the same
+        data.
+        """
+        self.data_cache = cache
+
+    def set_warm_start(self, warm_start):
+        """Set whether existing neural networks are trained further.
+
+        If `warm_start` is True, :meth:`train` continues training an existing
+        neural network on the new training data, instead of training a new
+        network from scratch. This is only done if the training data has the
+        same layout as the data the network was trained on (see
+        :meth:`~nbclassify.data.write_layout`), the settings that determine
+        the topology of the network are unchanged, and the training data was
+        made with the same codebook, if any; otherwise a new network is
+        trained.
+        """
+        self.warm_start = bool(warm_start)
+
+    def get_ann_layout(self, train_file, trainer):
+        """Return the layout of a network trained on `train_file`.
+
+        The layout of a neural network is the layout of its training data
+        (see :meth:`~nbclassify.data.write_layout`), with a hash of the
+        settings of trainer `trainer` that determine the topology of the
+        network (see :data:`TOPOLOGY_OPTIONS`). Returns None if the layout of
+        the training data is unknown.
+        """
+        layout = read_layout(get_layout_path(train_file))
+        if layout is None:
+            return None
+        layout['network'] = stable_hash(dict((option,
+            getattr(trainer, option)) for option in TOPOLOGY_OPTIONS))
+        return layout
+
+    def get_warm_start_ann(self, train_file, ann_file, trainer):
+        """Return the existing neural network to continue training from.
+
+        Returns the FANN structure from `ann_file` if warm start is enabled
+        and the network can be trained further on training data
+        `train_file` with the settings of trainer `trainer`. Returns None if
+        a new network must be trained.
+        """
+        if not self.warm_start or not os.path.isfile(ann_file):
+            return None
+
+        layout = self.get_ann_layout(train_file, trainer)
+        codebook_meta = get_meta_path(get_codebook_path(train_file))
+        ann_codebook_meta = get_meta_path(get_codebook_path(ann_file))
+
+        reason = None
+        if trainer.train_type != 'ordinary':
+            reason = "%s training cannot be continued" % trainer.train_type
+        elif self._train_method != 'default':
+            reason = "only the default training method can be continued"
+        elif layout is None:
+            reason = "the layout of the training data is unknown"
+        elif layout != read_layout(get_layout_path(ann_file)):
+            reason = "the inputs, classes or network settings have changed"
+        elif os.path.isfile(codebook_meta) != \
+                os.path.isfile(ann_codebook_meta) or \
+                (os.path.isfile(codebook_meta) and
+                not filecmp.cmp(codebook_meta, ann_codebook_meta, False)):
+            reason = "the codebook has changed"
+
+        if reason:
+            logging.info("Training %s from scratch: %s" % (ann_file, reason))
+            return None
+
+        logging.info("Continuing training of %s" % ann_file)
+        ann = libfann.neural_net()
+        ann.create_from_file(str(ann_file))
+        return ann
 
     def set_training_method(self, method, *args):
         methods = ('default', 'aivolver')
@@ -220,28 +498,19 @@ class MakeAnn(Common):
                     "passed as the second argument")
         self._train_method = method
 
-    def train(self, train_file, ann_file, config=None):
-        """Train an artificial neural network.
+    def get_trainer(self, config=None):
+        """Return a trainer with the training parameters `config`.
 
-        Loads training data from a TSV file `train_file`, trains a neural
-        network `ann_file` with training paramerters ``ann`` from the
-        configurations. If training parameters are provided with `config`,
-        those are used instead.
+        Returns a :class:`TrainANN` instance, or an :class:`Aivolver`
+        instance if that is the training method. If `config` is not set, the
+        training parameters ``ann`` from the configurations are used. Any
+        parameters that are not set have their default value.
         """
-        if not os.path.isfile(train_file):
-            raise IOError("Cannot open %s (no such file)" % train_file)
-        if not conf.force_overwrite and os.path.isfile(ann_file):
-            raise FileExistsError(ann_file)
-        if config and not isinstance(config, Struct):
-            raise TypeError("Expected an nbclassify.Struct instance for `config`")
-
-        # Instantiate the ANN trainer.
         if self._train_method == 'default':
             trainer = TrainANN()
         if self._train_method == 'aivolver':
             trainer = Aivolver()
 
-        # Set the training parameters.
         if not config:
             try:
                 config = self.config.ann
@@ -254,6 +523,38 @@ class MakeAnn(Common):
             setattr(trainer, option, value)
 
         trainer.iterations_between_reports = trainer.epochs / 100
+        return trainer
+
+    def train(self, train_file, ann_file, config=None):
+        """Train an artificial neural network.
+
+        Loads training data from a TSV file or a binary ``.npz`` file
+        `train_file` (see :meth:`~nbclassify.data.TrainData.read_from_file`),
+        trains a neural network `ann_file` with training paramerters ``ann``
+        from the configurations. If training parameters are provided with `config`,
+        those are used instead. If the training data was made with a
+        codebook, the metadata of that codebook is saved next to the neural
+        network.
+
+        Returns the mean square error of the neural network on the training
+        data, or None if the network was trained with Aivolver.
+        """
+        if not os.path.isfile(train_file):
+            raise IOError("Cannot open %s (no such file)" % train_file)
+        if not conf.force_overwrite and not self.warm_start and \
+                os.path.isfile(ann_file):
+            raise FileExistsError(ann_file)
+        if config and not isinstance(config, Struct):
+            raise TypeError("Expected an nbclassify.Struct instance for `config`")
+        if self._train_method == 'aivolver' and \
+                is_binary_train_file(train_file):
+            raise ValueError("Aivolver requires tab separated training data")
+        if self._train_method == 'aivolver' and self.subset is not None:
+            raise ValueError("Aivolver cannot train on a subset of the " \
+                "training data")
+
+        # Instantiate the ANN trainer with the training parameters.
+        trainer = self.get_trainer(config)
 
         # Train the ANN.
         if self._train_method == 'default':
@@ -262,18 +563,67 @@ class MakeAnn(Common):
             except:
                 dependent_prefix = OUTPUT_PREFIX
 
-            train_data = TrainData()
-            train_data.read_from_file(train_file, dependent_prefix)
+            train_data = load_data(train_file, dependent_prefix,
+                self.subset, self.data_cache)
 
-            ann = trainer.train(train_data)
+            ann = trainer.train(train_data,
+                self.get_warm_start_ann(train_file, ann_file, trainer))
+            mse = trainer.test(train_data)
 
         if self._train_method == 'aivolver':
             ann = trainer.train(train_file, self._aivolver_config_path)
+            mse = None
 
         # Save the neural network to disk.
         ann.save(str(ann_file))
         logging.info("Artificial neural network saved to %s" % ann_file)
 
+        # Record the codebook the training data depends on, if any, and the
+        # layout of the network.
+        codebook_meta = get_meta_path(get_codebook_path(train_file))
+        if os.path.isfile(codebook_meta):
+            shutil.copyfile(codebook_meta,
+                get_meta_path(get_codebook_path(ann_file)))
+        layout = self.get_ann_layout(train_file, trainer)
+        if layout is not None:
+            with open(get_layout_path(ann_file), 'w') as fh:
+                yaml.safe_dump(layout, fh, default_flow_style=False)
+        elif os.path.isfile(get_layout_path(ann_file)):
+            os.remove(get_layout_path(ann_file))
+
+        return mse
+
+def train_node(maker, train_file, ann_file, config=None):
+    """Train the neural network for a node of a classification hierarchy.
+
+    Trains a neural network `ann_file` on training data `train_file` with
+    training parameters `config` using :meth:`MakeAnn.train` of the
+    :class:`MakeAnn` instance `maker`. Returns a report for the network,
+    which is a dictionary with the keys ``train_file``, ``ann_file``,
+    ``seconds`` (the time spent on training), and ``mse`` (the mean square
+    error on the training data). Returns None if the network already exists.
+    """
+    logging.info("Training network `%s` with training data " \
+        "from `%s` ..." % (ann_file, train_file))
+    start = time.time()
+    try:
+        mse = maker.train(train_file, ann_file, config)
+    except FileExistsError as e:
+        # Don't train if the file already exists.
+        logging.warning("Skipping: %s" % e)
+        return None
+
+    return {
+        'train_file': train_file,
+        'ann_file': ann_file,
+        'seconds': time.time() - start,
+        'mse': mse
+    }
+
+def _train_node_star(args):
+    """Call :meth:`train_node` with the arguments in the tuple `args`."""
+    return train_node(*args)
+
 class BatchMakeAnn(MakeAnn):
 
     """Generate training data.
@@ -309,16 +659,28 @@ class BatchMakeAnn(MakeAnn):
         if not self.taxon_hr:
             self.taxon_hr = db.get_taxon_hierarchy(session, metadata)
 
-    def batch_train(self, data_dir, output_dir):
+    def batch_train(self, data_dir, output_dir, jobs=1):
         """Batch train neural networks.
 
         Training data is obtained from the directory `data_dir` and the
         neural networks are saved to the directory `output_dir`. Which training
         data to train on is set in the classification hierarchy of the
         configurations.
+
+        The networks for the nodes of the hierarchy are independent of each
+        other. If `jobs` is larger than 1, that many networks are trained at
+        the same time in separate processes. Networks are trained in order of
+        the size of their training data files, the largest first, so that a
+        large network does not start last and delay the end of the batch.
+
+        Returns a list with the report returned by :meth:`train_node` for
+        each trained network, in the order in which training finished.
         """
         session, metadata = db.get_session_or_error()
 
+        if jobs < 1:
+            raise ValueError("The number of jobs must be at least 1")
+
         # Must not be loaded in the constructor, in case set_photo_count_min()
         # is used.
         self._load_taxon_hierarchy()
@@ -326,7 +688,9 @@ class BatchMakeAnn(MakeAnn):
         # Get the name of each level in the classification hierarchy.
         levels = [l.name for l in self.class_hr]
 
-        # Train an ANN for each path in the classification hierarchy.
+        # Collect the networks to train for each path in the classification
+        # hierarchy.
+        tasks = []
         for filter_ in classification_hierarchy_filters(levels, self.taxon_hr):
             level = levels.index(filter_.get('class'))
             train_file = os.path.join(data_dir, self.class_hr[level].train_file)
@@ -354,14 +718,42 @@ class BatchMakeAnn(MakeAnn):
                     "training of %s" % ann_file)
                 continue
 
-            # Train the ANN.
-            logging.info("Training network `%s` with training data " \
-                "from `%s` ..." % (ann_file, train_file))
+            tasks.append((train_file, ann_file, config))
+
+        # Train the networks with the largest training data first.
+        tasks.sort(key=lambda task: os.path.getsize(task[0]) \
+            if os.path.isfile(task[0]) else 0, reverse=True)
+
+        reports = []
+        if jobs == 1 or len(tasks) < 2:
+            for task in tasks:
+                reports.append(train_node(self, *task))
+        else:
+            # The training settings are passed to the processes with a new
+            # instance, without the data cache.
+            maker = MakeAnn(self.config)
+            maker._train_method = self._train_method
+            maker._aivolver_config_path = self._aivolver_config_path
+            maker.set_subset(self.subset)
+            maker.set_warm_start(self.warm_start)
+
+            pool = multiprocessing.Pool(min(jobs, len(tasks)))
             try:
-                self.train(train_file, ann_file, config)
-            except FileExistsError as e:
-                # Don't train if the file already exists.
-                logging.warning("Skipping: %s" % e)
+                for report in pool.imap_unordered(_train_node_star,
+                        [(maker,) + task for task in tasks]):
+                    reports.append(report)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        reports = [r for r in reports if r is not None]
+        for report in reports:
+            logging.info("Trained `%s` in %.1f seconds (MSE: %s)",
+                report['ann_file'], report['seconds'], report['mse'])
+        return reports
 
 class TestAnn(Common):
 
@@ -379,6 +771,27 @@ class TestAnn(Common):
         self.classifications_expected = {}
         self.class_hr = None
         self.taxon_hr = None
+        self.subset = None
+        self.data_cache = None
+
+    def set_subset(self, subset):
+        """Set the sample subset that should be used for testing.
+
+        A subset of the samples in the test data can be used by providing a
+        list of sample labels `subset` for the samples to be used. If subset
+        is None, all samples are used.
+        """
+        if subset is not None and not isinstance(subset, set):
+            subset = set(subset)
+        self.subset = subset
+
+    def set_data_cache(self, cache):
+        """Set a :class:`~nbclassify.data.TrainDataCache` `cache`.
+
+        If set, test data files are loaded from the cache, so that each file
+        is loaded only once when testing on several subsets of the same data.
+        """
+        self.data_cache = cache
 
     def test(self, ann_file, test_file):
         """Test an artificial neural network."""
@@ -396,9 +809,9 @@ class TestAnn(Common):
         self.ann = libfann.neural_net()
         self.ann.create_from_file(ann_file)
 
-        self.test_data = TrainData()
         try:
-            self.test_data.read_from_file(test_file, dependent_prefix)
+            self.test_data = load_data(test_file, dependent_prefix,
+                self.subset, self.data_cache)
         except IOError as e:
             logging.error("Failed to process the test data: %s" % e)
             exit(1)
@@ -554,8 +967,8 @@ class TestAnn(Common):
                 ann.create_from_file(str(ann_file))
 
             # Load the test data.
-            test_data = TrainData()
-            test_data.read_from_file(test_file, dependent_prefix)
+            test_data = load_data(test_file, dependent_prefix, self.subset,
+                self.data_cache)
 
             # Test each sample in the test data.
             for label, input_, output in test_data:
@@ -9,7 +9,9 @@ import numpy as np
 from sklearn import cross_validation
 
 from .base import Common
-from .data import BatchMakeTrainData
+from .data import BatchMakeTrainData, TrainDataCache
+from .exceptions import *
+from .functions import get_bow_feature
 from .training import BatchMakeAnn, TestAnn
 import nbclassify.db as db
 
@@ -56,6 +58,23 @@ class Validator(Common):
             raise IOError("Cannot open %s (no such directory)" % path)
         self.temp_dir = path
 
+    def uses_codebooks(self):
+        """Return True if the training data depends on a codebook.
+
+        This is the case if the BagOfWords model is used, in which case the
+        codebook is created from the training data of each fold.
+        """
+        configs = [self.config]
+        try:
+            configs.extend(self.config.classification.hierarchy)
+        except AttributeError:
+            pass
+        for config in configs:
+            features = getattr(config, 'features', None)
+            if features and get_bow_feature(features):
+                return True
+        return False
+
     def k_fold_xval_stratified(self, k=3, autoskip=False):
         """Perform stratified K-folds cross validation.
 
@@ -63,6 +82,12 @@ class Validator(Common):
         members for any class cannot be less than `k`, or an AssertionError is
         raised. If `autoskip` is set to True, only the members for classes with
         at least `k` members are used for the cross validation.
+
+        Unless the training data depends on a codebook (see
+        :meth:`uses_codebooks`) or Aivolver is used, the training data is
+        exported once for all samples. The data of each file is then loaded
+        once and shared by the training and testing of all folds, which each
+        use a subset of the samples.
         """
         session, metadata = db.get_session_or_error()
 
@@ -124,13 +149,29 @@ class Validator(Common):
         tester = TestAnn(self.config)
         tester.set_photo_count_min(photo_count_min)
 
+        # Export the data for all samples at once if the folds can share it.
+        shared = not self.uses_codebooks() and not self.aivolver_config_path
+        if shared:
+            data_dir = os.path.join(self.temp_dir, 'data')
+            if not os.path.isdir(data_dir):
+                os.makedirs(data_dir)
+            train_data.set_subset(None)
+            train_data.batch_export(data_dir)
+
+            data_cache = TrainDataCache()
+            trainer.set_data_cache(data_cache)
+            tester.set_data_cache(data_cache)
+
         # Obtain cross validation folds.
         folds = cross_validation.StratifiedKFold(classes, k)
         result_dir = os.path.join(self.temp_dir, 'results')
         for i, (train_idx, test_idx) in enumerate(folds):
             # Make data directories.
-            train_dir = os.path.join(self.temp_dir, 'train', str(i))
-            test_dir = os.path.join(self.temp_dir, 'test', str(i))
+            if shared:
+                train_dir = test_dir = data_dir
+            else:
+                train_dir = os.path.join(self.temp_dir, 'train', str(i))
+                test_dir = os.path.join(self.temp_dir, 'test', str(i))
             ann_dir = os.path.join(self.temp_dir, 'ann', str(i))
             test_result = os.path.join(result_dir, '{0}.tsv'.format(i))
 
@@ -138,15 +179,21 @@ class Validator(Common):
                 if not os.path.isdir(path):
                     os.makedirs(path)
 
-            # Make train data for this fold.
             train_samples = photo_ids[train_idx]
-            train_data.set_subset(train_samples)
-            train_data.batch_export(train_dir)
-
-            # Make test data for this fold.
             test_samples = photo_ids[test_idx]
-            train_data.set_subset(test_samples)
-            train_data.batch_export(test_dir, train_dir)
+
+            if shared:
+                # Select the samples for this fold from the shared data.
+                trainer.set_subset(train_samples)
+                tester.set_subset(test_samples)
+            else:
+                # Make train data for this fold.
+                train_data.set_subset(train_samples)
+                train_data.batch_export(train_dir)
+
+                # Make test data for this fold.
+                train_data.set_subset(test_samples)
+                train_data.batch_export(test_dir, train_dir)
 
             # Train neural networks on training data.
             trainer.batch_train(data_dir=train_dir, output_dir=ann_dir)
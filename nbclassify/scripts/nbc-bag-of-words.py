@@ -2,9 +2,15 @@
 Bag-of-words creator.
 
 The program takes a dictionary with image
-feature descriptors and a database. 
-A codebook is created by performing a kmeans
-on all feature descriptors (this takes a while!).
+feature descriptors, or a descriptor store
+created by nbc-trainer or a directory of descriptor
+shards created by nbc-feature-extraction.py, and a
+database. Descriptor stores are read in batches, so
+they do not need to fit in memory. 
+A codebook is created by performing a mini-batch
+kmeans on the feature descriptors.
+Binary descriptors (ORB) are clustered with
+k-majority by Hamming distance instead.
 For every image is then determined to which cluster
 each feature belongs and a histogram (= word)is made of
 the presence of each cluster in that image.
@@ -25,11 +31,19 @@ import datetime
 import os
 
 import numpy as np
-import scipy.cluster.vq as vq
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import configure_mappers
 
+from nbclassify.codebook import (CodebookIndex, hamming_kmajority,
+    kmeans_minibatch)
 import nbclassify.db as db
+from nbclassify.functions import (get_bowcode_from_orb_features,
+    get_bowcode_from_surf_features, stable_hash)
+from nbclassify.store import (RaggedArrayStore, ShardedArrayStore,
+                              open_store)
+
+# Types of descriptor stores that can be given instead of a dictionary file.
+STORE_TYPES = (RaggedArrayStore, ShardedArrayStore)
 
 
 def main():
@@ -51,7 +65,8 @@ def main():
     parser.add_argument(
         "descr_dict",
         metavar="FILE.file",
-        help="File with a dictionary of image feature descriptors per image."
+        help="File with a dictionary of image feature descriptors per image, "
+             "or the directory of a descriptor store or descriptor shards."
     )
     parser.add_argument(
         "meta_file",
@@ -101,8 +116,10 @@ def main():
     # Parse arguments.
     args = parser.parse_args()
 
-    # Check if the dictionary file exists.
-    if not os.path.isfile(args.descr_dict):
+    # Check if the dictionary file or the descriptor store exists.
+    if not os.path.isfile(args.descr_dict) and \
+            not RaggedArrayStore.exists(args.descr_dict) and \
+            not ShardedArrayStore.exists(args.descr_dict):
         raise IOError("The given dictionary file does not exist.")
 
     # Check if the metadata file exists.
@@ -129,7 +146,8 @@ def main():
         newtime = print_duration(starttime, newtime)
 
     # Create codebook according to Bag-Of-Words priciple.
-    codebook = create_codebook(descr_array, args)
+    codebook = create_codebook(descr_array, args,
+                               get_fingerprint(args, descr_dict))
     
     # Display time and duration if wanted.
     if args.time:
@@ -184,8 +202,15 @@ def open_dict_file(args):
     """
     The function takes the result of an argument parser.
     The given dictionary file is opened and loaded. The loaded
-    dictionary is returned.
+    dictionary is returned. If a descriptor store is given
+    instead, the store is opened and returned; it is used
+    like a dictionary, but the descriptors are only read
+    from disk when they are needed.
     """
+    if RaggedArrayStore.exists(args.descr_dict) or \
+            ShardedArrayStore.exists(args.descr_dict):
+        print("Opening descriptor store...")
+        return open_store(args.descr_dict)
     print("Reading dictionary file...")
     dict_file = open(args.descr_dict, 'rb')
     descr_dict = load(dict_file)
@@ -197,24 +222,41 @@ def dict2nparray(descr_dict):
     """
     The function takes a dictionary and stores its
     values into a nparray. The nparray is returned.
+    For a descriptor store, the memory-mapped matrix with
+    the descriptors of all images is returned without
+    copying, unless the store contains descriptors that
+    were replaced.
     """
+    if isinstance(descr_dict, STORE_TYPES):
+        if descr_dict.stale_rows() == 0:
+            return descr_dict.get_matrix()
+        return descr_dict.get_rows(descr_dict.keys())
     print("Converting dictionary to nparray...")
-    nimages = len(descr_dict)
-    descr_array = np.zeros((nimages * 1000, 128))
-    position = 0
-    for imagename in descr_dict.keys():
-        descriptors = descr_dict[imagename]
-        nfeatures = descriptors.shape[0]
-        while position + nfeatures > descr_array.shape[0]:
-            elongation = np.zeros_like(descr_array)
-            descr_array = np.vstack((descr_array, elongation))
-        descr_array[position: position + nfeatures] = descriptors
-        position += nfeatures
-    descr_array = np.resize(descr_array, (position, 128))
-    return descr_array
-
-
-def create_codebook(descr_array, args):
+    arrays = [np.asarray(d) for d in descr_dict.values() if d is not None]
+    return np.concatenate(arrays)
+
+
+def get_fingerprint(args, descr_dict):
+    """
+    The function takes the result of an argument parser
+    and the opened dictionary or descriptor store.
+    A fingerprint of the descriptors is returned, so that
+    a checkpoint of the codebook is only resumed for the
+    same descriptors. For a descriptor store, the
+    fingerprint is made from the keys and the number of
+    descriptors of each key. For a dictionary file, it is
+    made from the size and modification time of the file.
+    """
+    path = os.path.abspath(args.descr_dict)
+    if isinstance(descr_dict, STORE_TYPES):
+        counts = sorted((key, descr_dict.count(key))
+                        for key in descr_dict.keys())
+        return stable_hash(path, counts)
+    stat = os.stat(path)
+    return stable_hash(path, stat.st_size, stat.st_mtime)
+
+
+def create_codebook(descr_array, args, fingerprint=None):
     """
     The function takes a nparray with descriptors and
     the result of an argument parser.
@@ -222,9 +264,11 @@ def create_codebook(descr_array, args):
     clusters will be the squareroot of the total number
     of feature descriptors. Otherwise the given number
     of clusters will be used. A codebook is created
-    by the kmeans-algorithm. The processing time depends
-    on the total number of feature descriptors and the 
-    number of clusters, but will take some hours. 
+    by the mini-batch kmeans-algorithm, which saves a
+    checkpoint next to the codebook file so that an
+    interrupted run can be resumed. The checkpoint is
+    only resumed for descriptors with the same
+    fingerprint (see get_fingerprint()).
     The codebook is a nparray of length 'number of clusters'
     and each cluster is of length 128 (for there are
     128 dimensions in a descriptor). The positions of the 
@@ -239,8 +283,14 @@ def create_codebook(descr_array, args):
     else:
         nclusters = int(np.sqrt(total_features))
     print("Number of clusters: %d" % nclusters)
-    print("\nCreating codebook (this will take a while)...")
-    codebook, distortion = vq.kmeans(descr_array, nclusters)
+    print("\nCreating codebook...")
+    if descr_array.dtype == np.uint8:
+        codebook = hamming_kmajority(descr_array[:], nclusters)
+    else:
+        checkpoint = args.codebookfile + ".checkpoint.npz"
+        codebook = kmeans_minibatch(descr_array, nclusters,
+                                    checkpoint=checkpoint,
+                                    fingerprint=fingerprint)
     return codebook
 
 
@@ -263,11 +313,23 @@ def create_bow(descr_dict, codebook):
     """
     print("Creating Bag-of-words...")
     bag_of_words = {}
+    if isinstance(descr_dict, STORE_TYPES):
+        # Encode the descriptors of all images in one pass over the store.
+        imagenames = list(descr_dict.keys())
+        counts = [descr_dict.count(k) for k in imagenames]
+        rows = descr_dict.row_indices(imagenames)
+        index = CodebookIndex(codebook)
+        hists = index.encode(descr_dict.get_matrix(), counts, rows)
+        for imagename, word_hist in zip(imagenames, hists):
+            bag_of_words[imagename] = list(word_hist)
+        return bag_of_words
     for imagename in descr_dict:
-        code, dist = vq.vq(descr_dict[imagename], codebook)
-        word_hist, bin_edges = np.histogram(code,
-                                            bins=range(codebook.shape[0] + 1),
-                                            normed=True)
+        if codebook.dtype == np.uint8:
+            word_hist = get_bowcode_from_orb_features(descr_dict[imagename],
+                                                      codebook)
+        else:
+            word_hist = get_bowcode_from_surf_features(descr_dict[imagename],
+                                                       codebook)
         bag_of_words[imagename] = list(word_hist)
     return bag_of_words
 
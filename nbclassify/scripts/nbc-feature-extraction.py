@@ -1,10 +1,16 @@
 """
-Feature extractor with the use of the SURF-algorithm.
+Feature extractor with the use of the SURF- or ORB-algorithm.
 
 Features are extracted from all the images in a 
 given path. All processed image filenames are saved
 in a .txt file. A dictionary with all descriptors per 
-image are saved in a .file file.
+image are saved in a .file file. ORB descriptors are
+binary and much faster to compute than SURF descriptors.
+
+With --shards, the descriptors are instead written to a
+directory of descriptor shards as soon as each image is
+processed. Such an extraction can be interrupted and
+resumed, and the shards do not need to fit in memory.
 
 See the --help option for information about the 
 possible arguments to be parsed.
@@ -12,21 +18,25 @@ possible arguments to be parsed.
 
 import argparse
 import datetime
+from multiprocessing.pool import ThreadPool
 import os
 import sys
 
 from cPickle import dump, HIGHEST_PROTOCOL
 import numpy as np
+import yaml
 
 import cv2
 
+from nbclassify.store import ShardedArrayStore
+
 
 def main():
     # Create argument parser.
     parser = argparse.ArgumentParser(
         description="Image feature extractor.\nFeatures are extracted "
                     "from images in the (subdirectories of the) given path "
-                    "with the SURF algorithm of OpenCV.\n"
+                    "with the SURF or ORB algorithm of OpenCV.\n"
                     "A dictionary with all features per image is saved to a "
                     "binary '.file' file. A list of all processed images "
                     "is saved to a '.txt' file."
@@ -70,6 +80,35 @@ def main():
              "roi_frac are given with valid values, only roi_frac will be "
              "used."
     )
+    parser.add_argument(
+        "--algorithm",
+        choices=["surf", "orb"],
+        default="surf",
+        help="The algorithm for detecting keypoints and computing their "
+             "descriptors. Defaults to 'surf' if omitted."
+    )
+    parser.add_argument(
+        "--shards",
+        metavar="PATH",
+        help="Directory to write the descriptors to in shards, instead of "
+             "writing a dictionary file. If the directory already contains "
+             "descriptors, the extraction is resumed and images that were "
+             "already processed are skipped."
+    )
+    parser.add_argument(
+        "--shard-size",
+        metavar="N",
+        type=int,
+        default=100000,
+        help="The number of descriptors per shard. Defaults to 100000."
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        metavar="N",
+        type=int,
+        default=1,
+        help="The number of images to process in parallel. Defaults to 1."
+    )
     parser.add_argument(
         "--time",
         metavar="BOOL",
@@ -97,7 +136,11 @@ def main():
         newtime = print_duration(starttime, starttime)
 
     # Extract features from images.
-    descr_dict, file_list = feature_extraction(args, what_roi)
+    if args.shards:
+        descr_dict = open_shards(args, what_roi)
+    else:
+        descr_dict = {}
+    file_list = feature_extraction(args, what_roi, descr_dict)
     
     # Display time and duration if wanted.
     if args.time:
@@ -105,7 +148,8 @@ def main():
 
     # Write descriptors and filenames to files.
     print("Writing to files...")
-    write_dictionary(args, descr_dict)
+    if not args.shards:
+        write_dictionary(args, descr_dict)
     write_list(args, file_list)
     
     # Display time and duration if wanted.
@@ -204,43 +248,109 @@ def split_roi(roistring, decimal):
     return roi
 
 
-def feature_extraction(args, what_roi):
+def open_shards(args, what_roi):
     """
-    The function takes the result of the argument parser.
-    For every image in the given path the image is read and the 
-    filename is added to a list of processed images. If necessary
-    the image is cropped. The image is turned to grayscale and
-    truncated to fade the background. The SURF-algorithm is
-    used to extract features and the descriptors of the processed
-    filename are added to a dictionary.
-    When all images are processed, the dictionary with descriptors
-    and the list with processed image filenames are returned.
+    The function takes the result of an argument parser
+    and a string to specify what type of roi is wanted.
+    The directory with descriptor shards is opened, or
+    created if it doesn't exist. The extraction settings
+    are saved in the directory, and an existing directory
+    can only be resumed with the same settings.
+    The store with the shards is returned.
+    """
+    settings = {
+        'algorithm': args.algorithm,
+        'roi': {"Fractions": args.roi_frac,
+                "Pixels": args.roi_pix}.get(what_roi)
+    }
+    settings_path = os.path.join(args.shards, "extraction.yml")
+    if os.path.isfile(settings_path):
+        with open(settings_path, 'r') as f:
+            if yaml.safe_load(f) != settings:
+                raise ValueError("The descriptors in %s were extracted with "
+                                 "other settings." % args.shards)
+    else:
+        if not os.path.isdir(args.shards):
+            os.makedirs(args.shards)
+        with open(settings_path, 'w') as f:
+            yaml.safe_dump(settings, f, default_flow_style=False)
+
+    dtype = np.uint8 if args.algorithm == "orb" else np.float32
+    store = ShardedArrayStore(args.shards, dtype, args.shard_size)
+    if len(store):
+        print("Resuming: %d images were already processed." % len(store))
+    return store
+
+
+def extract_descriptors(args, what_roi, filepath):
+    """
+    The function takes the result of an argument parser,
+    a string to specify what type of roi is wanted and
+    the path of an image.
+    The image is read and, if necessary, cropped. The image
+    is turned to grayscale and truncated to fade the
+    background. The SURF- or ORB-algorithm is used to
+    extract features and the descriptors are returned.
+    If the file is not an image, None is returned.
+    """
+    img = cv2.imread(filepath, cv2.IMREAD_COLOR)
+    if type(img) != np.ndarray:
+        return None
+
+    img = apply_roi(args, what_roi, img)
+    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    ret, thresh = cv2.threshold(img_gray, 170, 255, cv2.THRESH_TRUNC)
+    if args.algorithm == "orb":
+        return orb_keypoint_detection(thresh)
+    des = surf_keypoint_detection(thresh)
+    if des is None:
+        des = np.empty((0, 128), dtype=np.float32)
+    return des
+
+
+def feature_extraction(args, what_roi, descr_dict):
+    """
+    The function takes the result of the argument parser,
+    a string to specify what type of roi is wanted and
+    a dictionary or descriptor store to add the
+    descriptors to.
+    For every image in the given path that is not already
+    in the dictionary the descriptors are extracted, with
+    args.jobs images in parallel, and added to the
+    dictionary under the filename of the image. Each
+    image is added as soon as it is processed, so that a
+    descriptor store is written incrementally.
+    When all images are processed, the list with processed
+    image filenames is returned.
     """
     print("Start feature extraction...")
-    descr_dict = {}
     file_list = []
+    todo = []
     for root, dirs, files in os.walk(args.imdir):
-        for n, filename in enumerate(files):
-            if n == 0:
-                print("\nCurrent directory: %s" % root)
-            filepath = os.path.join(root, filename)
-            img = cv2.imread(filepath, cv2.IMREAD_COLOR)
-
-            if type(img) != np.ndarray:
-                sys.stderr.write("--> %d File %s is not an img: will be skipped.\n" % (n, filename))
-                continue
-            else:
-                print("%d Image %s is being processed..." % (n, filename))
+        for filename in sorted(files):
+            if filename in descr_dict:
                 file_list.append(filename)
-
-            img = apply_roi(args, what_roi, img)
-            img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            ret, thresh = cv2.threshold(img_gray, 170, 255, cv2.THRESH_TRUNC)
-            des = surf_keypoint_detection(thresh)
+            else:
+                todo.append((filename, os.path.join(root, filename)))
+
+    pool = ThreadPool(max(args.jobs, 1))
+    try:
+        results = pool.imap(
+            lambda task: extract_descriptors(args, what_roi, task[1]), todo)
+        for n, des in enumerate(results):
+            filename, filepath = todo[n]
+            if des is None:
+                sys.stderr.write("--> %d File %s is not an img: will be "
+                                 "skipped.\n" % (n, filepath))
+                continue
+            print("%d Image %s has been processed..." % (n, filepath))
             descr_dict[filename] = des
+            file_list.append(filename)
+    finally:
+        pool.terminate()
 
     print("\nAll images have been processed.")
-    return descr_dict, file_list
+    return file_list
 
 
 def apply_roi(args, what_roi, img):
@@ -277,6 +387,25 @@ def surf_keypoint_detection(img):
     return des
 
 
+def orb_keypoint_detection(img):
+    """
+    The function takes an image in grayscale of
+    type nd.nparray.
+    Features are extracted from the image by the
+    ORB-algorithm and keypoints and binary descriptors
+    are calculated. The descriptors are returned as
+    a nparray of bytes, with 32 bytes per descriptor.
+    """
+    if hasattr(cv2, "ORB_create"):
+        orb = cv2.ORB_create(500)
+    else:
+        orb = cv2.ORB(500)
+    kp, des = orb.detectAndCompute(img, None)
+    if des is None:
+        des = np.empty((0, 32), dtype=np.uint8)
+    return des
+
+
 def write_dictionary(args, dictio):
     """
     The function takes the result of an argument parser 
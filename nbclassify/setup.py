@@ -42,6 +42,7 @@ setup(
         'nbclassify': ['config.yml', 'config_aivolver.yml'],
     },
     scripts=[
+        'scripts/nbc-benchmark',
         'scripts/nbc-classify',
         'scripts/nbc-harvest-images',
         'scripts/nbc-trainer'
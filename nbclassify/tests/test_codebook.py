@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the codebook module."""
+
+import cPickle as pickle
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath('..'))
+sys.path.insert(0, os.path.abspath('.'))
+
+from . import *
+from nbclassify.codebook import (CodebookIndex, CodebookRegistry,
+    get_codebook_path, get_index_path, get_meta_path,
+    hamming_distances, hamming_kmajority, hamming_vq, kmeans_minibatch,
+    squared_distances)
+from nbclassify.functions import (Struct, get_bow_feature,
+    get_bowcode_from_orb_features, get_bowcode_from_surf_features)
+
+class TestCodebook(unittest.TestCase):
+
+    """Unit tests for creating and using codebooks."""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_hamming_distances(self):
+        """Test the Hamming distances against counting the bits."""
+        a = self.rng.randint(0, 256, size=(20, 32)).astype(np.uint8)
+        b = self.rng.randint(0, 256, size=(7, 32)).astype(np.uint8)
+        dist = hamming_distances(a, b)
+        self.assertEqual(dist.shape, (20, 7))
+        for i in range(len(a)):
+            for j in range(len(b)):
+                expected = sum(bin(x).count('1') for x in a[i] ^ b[j])
+                self.assertEqual(dist[i,j], expected)
+
+    def test_hamming_vq(self):
+        """Test that descriptors are assigned to the nearest code."""
+        codebook = self.rng.randint(0, 256, size=(5, 32)).astype(np.uint8)
+        descriptors = self.rng.randint(0, 256, size=(50, 32)).astype(np.uint8)
+        codes, dist = hamming_vq(descriptors, codebook, chunk_size=8)
+        expected = hamming_distances(descriptors, codebook)
+        np.testing.assert_array_equal(codes, expected.argmin(axis=1))
+        np.testing.assert_array_equal(dist, expected.min(axis=1))
+
+    def test_hamming_kmajority(self):
+        """Test that k-majority finds well separated clusters."""
+        centers = self.rng.randint(0, 256, size=(4, 32)).astype(np.uint8)
+
+        # Flip a few random bits of each center.
+        bits = np.unpackbits(np.repeat(centers, 50, axis=0), axis=1)
+        flips = self.rng.rand(*bits.shape) < 0.05
+        descriptors = np.packbits(bits ^ flips, axis=1)
+
+        codebook = hamming_kmajority(descriptors, 4, seed=1)
+        self.assertEqual(codebook.shape, (4, 32))
+        self.assertEqual(codebook.dtype, np.uint8)
+        codes, dist = hamming_vq(centers, codebook)
+        self.assertEqual(len(set(codes)), 4)
+        self.assertTrue((dist < 10).all())
+
+        self.assertRaises(ValueError, hamming_kmajority, descriptors[:3], 4)
+
+    def test_kmeans_minibatch(self):
+        """Test that mini-batch k-means finds well separated clusters."""
+        centers = self.rng.rand(20, 16) * 10
+        descriptors = np.repeat(centers, 100, axis=0) + \
+            self.rng.randn(2000, 16) * 0.1
+
+        codebook = kmeans_minibatch(descriptors, 20, batch_size=200, seed=1)
+        self.assertEqual(codebook.shape, (20, 16))
+        self.assertEqual(codebook.dtype, np.float32)
+        dist = squared_distances(centers, codebook)
+        self.assertEqual(len(set(dist.argmin(axis=1))), 20)
+        self.assertTrue((dist.min(axis=1) < 0.1).all())
+
+        # Only the selected rows are clustered.
+        rows = np.arange(500)
+        codebook = kmeans_minibatch(descriptors, 5, seed=1, rows=rows)
+        dist = squared_distances(centers[:5], codebook)
+        self.assertTrue((dist.min(axis=1) < 0.1).all())
+
+        self.assertRaises(ValueError, kmeans_minibatch, descriptors, 20,
+            rows=rows[:10])
+
+    def test_kmeans_minibatch_resume(self):
+        """Test that an interrupted run resumes from its checkpoint."""
+        descriptors = self.rng.rand(1000, 8)
+        kwargs = dict(batch_size=50, iters=30, seed=2, tol=0)
+        expected = kmeans_minibatch(descriptors, 10, **kwargs)
+
+        class Interrupt(Exception):
+            pass
+
+        class Descriptors(object):
+            """Descriptors of which reading fails after `n` reads."""
+            def __init__(self, n, data=descriptors):
+                self.n = n
+                self.data = data
+                self.read = []
+            def __len__(self):
+                return len(self.data)
+            def __getitem__(self, index):
+                self.n -= 1
+                if self.n < 0:
+                    raise Interrupt()
+                self.read.extend(index)
+                return self.data[index]
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(temp_dir, 'checkpoint.npz')
+            self.assertRaises(Interrupt, kmeans_minibatch, Descriptors(16),
+                10, checkpoint=checkpoint, **kwargs)
+            self.assertTrue(os.path.isfile(checkpoint))
+
+            codebook = kmeans_minibatch(descriptors, 10,
+                checkpoint=checkpoint, **kwargs)
+            np.testing.assert_array_equal(codebook, expected)
+            self.assertFalse(os.path.isfile(checkpoint))
+
+            # Not resumed for other descriptors with the same shape.
+            other = self.rng.rand(1000, 8)
+            self.assertRaises(Interrupt, kmeans_minibatch, Descriptors(16),
+                10, checkpoint=checkpoint, fingerprint='a', **kwargs)
+            codebook = kmeans_minibatch(other, 10, checkpoint=checkpoint,
+                fingerprint='b', **kwargs)
+            np.testing.assert_array_equal(codebook,
+                kmeans_minibatch(other, 10, **kwargs))
+
+            # Not resumed for other rows.
+            self.assertRaises(Interrupt, kmeans_minibatch, Descriptors(16),
+                10, checkpoint=checkpoint, rows=np.arange(500), **kwargs)
+            codebook = kmeans_minibatch(descriptors, 10,
+                checkpoint=checkpoint, rows=np.arange(500, 1000), **kwargs)
+            np.testing.assert_array_equal(codebook,
+                kmeans_minibatch(descriptors, 10, rows=np.arange(500, 1000),
+                **kwargs))
+
+            # Resumed with the same sample if no seed is set.
+            kwargs.update(seed=None, max_samples=300)
+            self.assertRaises(Interrupt, kmeans_minibatch, Descriptors(16),
+                10, checkpoint=checkpoint, **kwargs)
+            sample = np.load(checkpoint)['sample']
+            self.assertEqual(len(sample), 300)
+            resumed = Descriptors(1000)
+            kmeans_minibatch(resumed, 10, checkpoint=checkpoint, **kwargs)
+            self.assertTrue(len(resumed.read) > 0)
+            self.assertTrue(np.in1d(resumed.read, sample).all())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_codebook_index(self):
+        """Test that the index encodes as the reference functions."""
+        codebook = self.rng.rand(30, 16).astype(np.float32)
+        descriptors = self.rng.rand(200, 16).astype(np.float32)
+        counts = [50, 0, 120, 30]
+        offsets = np.cumsum([0] + counts)
+        expected = [get_bowcode_from_surf_features(
+            descriptors[offsets[i]:offsets[i+1]], codebook) \
+            for i in range(len(counts)) if counts[i] > 0]
+
+        for method in CodebookIndex.METHODS:
+            index = CodebookIndex(codebook, method)
+            codes = index.encode(descriptors, counts, chunk_size=64)
+            self.assertEqual(codes.shape, (4, 30))
+            self.assertTrue((codes[1] == 0).all())
+            np.testing.assert_array_almost_equal(codes[[0, 2, 3]], expected)
+
+        # Encode the descriptors in a different order.
+        rows = np.arange(200)[::-1]
+        codes = index.encode(descriptors, [200], rows)
+        np.testing.assert_array_almost_equal(codes[0],
+            get_bowcode_from_surf_features(descriptors, codebook))
+
+        # Binary descriptors are searched by Hamming distance.
+        codebook = self.rng.randint(0, 256, size=(10, 32)).astype(np.uint8)
+        descriptors = self.rng.randint(0, 256, size=(40, 32)).astype(np.uint8)
+        codes = CodebookIndex(codebook, 'kdtree').encode(descriptors, [40])
+        np.testing.assert_array_almost_equal(codes[0],
+            get_bowcode_from_orb_features(descriptors, codebook))
+
+        self.assertRaises(ValueError, CodebookIndex, codebook, 'flann')
+
+    def test_codebook_index_file(self):
+        """Test that a saved index is only used for its codebook."""
+        codebook = self.rng.rand(10, 4).astype(np.float32)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            codebook_file = os.path.join(temp_dir, 'train_codebook.file')
+            with open(codebook_file, 'wb') as fh:
+                pickle.dump(codebook, fh, pickle.HIGHEST_PROTOCOL)
+            index_path = get_index_path(codebook_file)
+            self.assertEqual(index_path,
+                os.path.join(temp_dir, 'train_codebook.index'))
+            CodebookIndex(codebook, 'kdtree', 0.5).save(index_path)
+
+            index = CodebookIndex.from_codebook_file(codebook_file,
+                'kdtree', 0.5)
+            self.assertIsNotNone(index._tree)
+            np.testing.assert_array_equal(index.codebook, codebook)
+
+            index = CodebookIndex.from_codebook_file(codebook_file)
+            self.assertEqual(index.method, 'exact')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_codebook_registry(self):
+        """Test registering and copying codebooks."""
+        codebook = self.rng.rand(10, 4).astype(np.float32)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            registry = CodebookRegistry(os.path.join(temp_dir, 'codebooks'))
+            self.assertNotIn('abc', registry)
+            self.assertIsNone(registry.get('abc'))
+
+            registry.add('abc', codebook, {'clusters': 10})
+            self.assertIn('abc', registry)
+            np.testing.assert_array_equal(registry.get('abc'), codebook)
+            self.assertEqual(registry.get_meta('abc'),
+                {'key': 'abc', 'clusters': 10})
+
+            codebook_file = get_codebook_path(os.path.join(temp_dir,
+                'genus.tsv'))
+            registry.copy('abc', codebook_file)
+            index = CodebookIndex.from_codebook_file(codebook_file)
+            np.testing.assert_array_equal(index.codebook, codebook)
+            with open(get_meta_path(codebook_file)) as fh:
+                self.assertIn('key: abc', fh.read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_bow_feature(self):
+        """Test selecting the feature for the BagOfWords model."""
+        features = Struct({'color_bgr_means': {'bins': 20}})
+        self.assertIsNone(get_bow_feature(features))
+        features = Struct({'orb': {'bow_clusters': 50}})
+        self.assertEqual(get_bow_feature(features), 'orb')
+        features = Struct({'surf': {'bow_clusters': 50}})
+        self.assertEqual(get_bow_feature(features), 'surf')
+
+if __name__ == '__main__':
+    unittest.main()
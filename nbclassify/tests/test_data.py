@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the train data module."""
+
+from copy import deepcopy
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.abspath('..'))
+sys.path.insert(0, os.path.abspath('.'))
+
+from . import *
+from nbclassify.data import (ExtractionContext, PhenotypeCache, Phenotyper,
+    TrainData, get_feature_layout, get_layout_path, get_phenotype_dtype,
+    normalize_array, read_layout, write_layout)
+from nbclassify.exceptions import ConfigurationError
+from nbclassify.functions import Struct
+from nbclassify.store import RaggedArrayStore
+
+class TestExtractionContext(unittest.TestCase):
+
+    """Unit tests for the extraction context."""
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.img = (rng.rand(50, 60, 3) * 255).astype(np.uint8)
+        self.bin_mask = np.zeros((50, 60), dtype=np.uint8)
+        cv2.circle(self.bin_mask, (30, 25), 10, 255, -1)
+
+    def test_contour(self):
+        """Test that contours are computed once per approximation method."""
+        context = ExtractionContext(self.img, self.bin_mask)
+        simple = context.get_contour(cv2.CHAIN_APPROX_SIMPLE)
+        none = context.get_contour(cv2.CHAIN_APPROX_NONE)
+        self.assertIs(context.get_contour(cv2.CHAIN_APPROX_SIMPLE), simple)
+        self.assertGreater(len(none), len(simple))
+
+        context = ExtractionContext(self.img)
+        self.assertRaises(ValueError, context.get_contour)
+
+    def test_images(self):
+        """Test the masked image and the color conversions."""
+        context = ExtractionContext(self.img, self.bin_mask)
+
+        masked = context.get_masked_image()
+        self.assertFalse(masked[self.bin_mask == 0].any())
+        self.assertIs(context.get_image('bgr', masked=True), masked)
+        self.assertIs(context.get_image('bgr'), self.img)
+
+        hsv = context.get_image('hsv')
+        np.testing.assert_array_equal(hsv,
+            cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV))
+        self.assertIs(context.get_image('HSV'), hsv)
+        np.testing.assert_array_equal(context.get_image('luv', masked=True),
+            cv2.cvtColor(masked, cv2.COLOR_BGR2LUV))
+        self.assertRaises(ValueError, context.get_image, 'xyz')
+
+class TestPhenotypeLayout(unittest.TestCase):
+
+    """Unit tests for the layout and data type of phenotypes."""
+
+    def test_feature_layout(self):
+        """Test the offsets and columns of the features."""
+        features = Struct({
+            'shape_outline': {'k': 3},
+            'color_histograms': {'bgr': [2, 2, 2]},
+            'color_bgr_means': {'bins': 2}
+        })
+        layout = get_feature_layout(features)
+        self.assertEqual([(name, start, stop) for name, start, stop, c in \
+            layout], [('color_bgr_means', 0, 12), ('color_histograms', 12, 18),
+            ('shape_outline', 18, 24)])
+        for name, start, stop, columns in layout:
+            self.assertEqual(len(columns), stop - start)
+        self.assertEqual(layout[2][3][:2], ['OUTLINE:1.X', 'OUTLINE:1.Y'])
+
+    def test_phenotype_dtype(self):
+        """Test the configurable data type of phenotypes."""
+        self.assertEqual(get_phenotype_dtype(Struct({})), np.float32)
+        config = Struct({'data': {'dtype': 'float64'}})
+        self.assertEqual(get_phenotype_dtype(config), np.float64)
+        config = Struct({'data': {'dtype': 'int32'}})
+        self.assertRaises(ConfigurationError, get_phenotype_dtype, config)
+
+    def test_train_data_dtype(self):
+        """Test that training data is stored with the given data type."""
+        data = TrainData(3, 2, np.float32)
+        data.append([0.5, 1, 2], [1, -1], label='a')
+        data.append(np.arange(3), [-1, 1], label='b')
+        data.finalize()
+        self.assertEqual(data.get_input().dtype, np.float32)
+        self.assertEqual(data.get_input().shape, (2, 3))
+        self.assertEqual(data.get_output().dtype, np.float32)
+
+    def test_train_data_files(self):
+        """Test writing and reading training data in both file formats."""
+        data = TrainData(3, 2, np.float32)
+        data.append([0.5, 1, 2], [1, -1], label=12)
+        data.append([0.25, -3, 4], [-1, 1], label=13)
+        data.finalize()
+        header = ["ID", "a", "b", "c", "OUT:1", "OUT:2"]
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for name in ("train.tsv", "train.npz"):
+                path = os.path.join(temp_dir, name)
+                data.write_to_file(path, header)
+
+                loaded = TrainData(dtype=np.float32)
+                loaded.read_from_file(path, "OUT:")
+                self.assertEqual(loaded.num_input, 3)
+                self.assertEqual(loaded.num_output, 2)
+                self.assertEqual(list(loaded.labels), ['12', '13'])
+                self.assertTrue(np.array_equal(loaded.get_input(),
+                    data.get_input()))
+                self.assertTrue(np.array_equal(loaded.get_output(),
+                    data.get_output()))
+                self.assertEqual(len(list(loaded)), 2)
+
+            self.assertRaises(ValueError, data.write_to_file,
+                os.path.join(temp_dir, "train.npz"), header[:-1])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_train_data_layout(self):
+        """Test that layouts differ if the inputs or classes differ."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = get_layout_path(os.path.join(temp_dir, "train.tsv"))
+            self.assertEqual(read_layout(path), None)
+
+            write_layout(path, ["a", "b"], ["Cypripedium", "Paphiopedilum"])
+            layout = read_layout(path)
+            self.assertEqual(layout['classes'],
+                ["Cypripedium", "Paphiopedilum"])
+
+            for columns, classes in [(["a", "c"], layout['classes']),
+                    (["a", "b"], ["Cypripedium", "Phragmipedium"]),
+                    (["a", "b"], ["Paphiopedilum", "Cypripedium"])]:
+                write_layout(path, columns, classes)
+                self.assertNotEqual(read_layout(path), layout)
+
+            write_layout(path, ["a", "b"], ["Cypripedium", "Paphiopedilum"])
+            self.assertEqual(read_layout(path), layout)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_train_data_iteration(self):
+        """Test appending beyond the initial size and nested iteration."""
+        data = TrainData(2, 1, size=2)
+        for i in range(20):
+            data.append([i, -i], [i % 2], label=i)
+        data.finalize()
+        self.assertEqual(data.get_input().shape, (20, 2))
+        self.assertRaises(ValueError, data.append, [0, 0], [0])
+
+        pairs = [(a, b) for a, _, _ in data for b, _, _ in data]
+        self.assertEqual(len(set(pairs)), 400)
+        for i, (label, input_, output) in enumerate(data):
+            self.assertEqual(label, i)
+            self.assertEqual(list(input_), [i, -i])
+            self.assertEqual(output[0], i % 2)
+
+    def test_train_data_subset(self):
+        """Test that subsets share the data until they are modified."""
+        data = TrainData(2, 1)
+        for i in range(10):
+            data.append([i, 2 * i], [i % 2], label=i)
+        data.finalize()
+
+        contiguous = data.subset(['3', 4, 5])
+        self.assertEqual(contiguous.labels, [3, 4, 5])
+        self.assertTrue(np.shares_memory(contiguous.get_input(),
+            data.get_input()))
+
+        scattered = data.subset([8, 1, 5])
+        self.assertEqual(scattered.labels, [1, 5, 8])
+        self.assertEqual(list(scattered.get_input()[:,0]), [1, 5, 8])
+        self.assertEqual([input_[1] for _, input_, _ in scattered],
+            [2, 10, 16])
+
+        nested = scattered.subset([5, 8])
+        self.assertEqual(list(nested.get_input()[:,0]), [5, 8])
+
+        contiguous.normalize_input_columns(0, 1)
+        self.assertEqual(list(contiguous.get_input()[:,0]), [0, 0.5, 1])
+        self.assertEqual(list(data.get_input()[3:6,0]), [3, 4, 5])
+
+    def test_normalize_array(self):
+        """Test that normalization matches cv2.normalize."""
+        rng = np.random.RandomState(0)
+        data = rng.uniform(-5, 5, size=(30, 8)).astype(np.float32)
+        data[:,3] = 2
+        for norm_type in (cv2.NORM_MINMAX, cv2.NORM_INF, cv2.NORM_L1,
+                cv2.NORM_L2):
+            columns = normalize_array(data, 1, -1, norm_type, axis=0)
+            rows = normalize_array(data, 1, -1, norm_type, axis=1)
+            self.assertEqual(columns.dtype, np.float32)
+            for col in range(data.shape[1]):
+                expected = cv2.normalize(data[:,col], None, 1, -1, norm_type)
+                self.assertTrue(np.allclose(columns[:,col], expected.ravel(),
+                    atol=1e-6))
+            for i, row in enumerate(data):
+                expected = cv2.normalize(row, None, 1, -1, norm_type)
+                self.assertTrue(np.allclose(rows[i], expected.ravel(),
+                    atol=1e-6))
+
+class TestPhenotypeCache(unittest.TestCase):
+
+    """Unit tests for reading descriptors from the phenotype cache."""
+
+    def test_get_descriptors(self):
+        """Test that stores and legacy caches return the same descriptors."""
+        des = {'a': np.ones((2, 4), np.float32), 'b': None,
+            'c': np.zeros((3, 4), np.float32)}
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = RaggedArrayStore(os.path.join(temp_dir, 'surf'))
+            for key, value in sorted(des.items()):
+                store[key] = value if value is not None else \
+                    np.empty((0, 4), np.float32)
+
+            for cache in (store, des):
+                phenotypes = PhenotypeCache()
+                phenotypes._cache = {'surf': cache}
+
+                matrix, rows, counts = phenotypes.get_descriptors('surf',
+                    ['c', 'b', 'a'])
+                self.assertEqual(counts, [3, 0, 2])
+                rows = np.arange(len(matrix)) if rows is None else rows
+                np.testing.assert_array_equal(matrix[rows],
+                    np.concatenate([des['c'], des['a']]))
+
+                for keys in (['b'], []):
+                    matrix, rows, counts = phenotypes.get_descriptors('surf',
+                        keys)
+                    self.assertEqual(counts, [0] * len(keys))
+                    rows = np.arange(len(matrix)) if rows is None else rows
+                    self.assertEqual(matrix[rows].shape, (0, 4))
+        finally:
+            shutil.rmtree(temp_dir)
+
+class TestPhenotyperBatch(unittest.TestCase):
+
+    """Unit tests for extracting features from a batch of images."""
+
+    def setUp(self):
+        self.paths = sorted(glob.glob(os.path.join(IMAGE_DIR, '*', '*', '*',
+            '*.jpg')))[:4]
+        self.config = Struct({
+            'preprocess': {
+                'maximum_perimeter': 400,
+                'segmentation': {'threshold': {}}
+            },
+            'features': {'shape_outline': {'k': 5}}
+        })
+
+    def test_make_batch(self):
+        """Test that threads yield the same phenotypes in the same order."""
+        phenotyper = Phenotyper()
+        phenotyper.set_config(self.config)
+        paths = self.paths + ['does_not_exist.jpg']
+
+        serial = list(phenotyper.make_batch(paths))
+        threaded = list(phenotyper.make_batch(paths, workers=3))
+        self.assertEqual([p for p, x in threaded], paths)
+        for (path, a), (path, b) in zip(serial[:-1], threaded[:-1]):
+            np.testing.assert_array_equal(a, b)
+            self.assertEqual(len(a), 10)
+        self.assertIsInstance(threaded[-1][1], IOError)
+
+    def test_make_batch_configs(self):
+        """Test extracting features for several configurations."""
+        config2 = Struct({
+            'preprocess': deepcopy(self.config.preprocess).as_dict(),
+            'features': {'shape_outline': {'k': 8}}
+        })
+        phenotyper = Phenotyper()
+        results = list(phenotyper.make_batch(self.paths, workers=2,
+            configs=[[self.config, config2]] * len(self.paths)))
+        for path, phenotypes in results:
+            self.assertEqual([len(x) for x in phenotypes], [10, 16])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the functions module."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.abspath('..'))
+sys.path.insert(0, os.path.abspath('.'))
+
+from . import *
+from nbclassify.functions import (Struct, classification_hierarchy_filters,
+    filter_photos, get_feature_cache_key, get_image_size, stable_hash)
+
+class TestStableHash(unittest.TestCase):
+
+    """Unit tests for the stable hash functions."""
+
+    def test_stable_hash(self):
+        """Test that equal configurations get the same hash."""
+        a = Struct({'bins': 5, 'color_space': 'hsv', 'args': [1, 2]})
+        b = Struct({'args': (1, 2), 'color_space': 'hsv', 'bins': 5})
+        self.assertEqual(stable_hash(a), stable_hash(b))
+        self.assertEqual(len(stable_hash(a)), 40)
+        self.assertEqual(stable_hash(Struct({'a': 1, 'b': [1, 2]})),
+            '97a70e228b1931a87d399236f81008ea376d85d3')
+
+    def test_stable_hash_types(self):
+        """Test that values of different types get different hashes."""
+        self.assertNotEqual(stable_hash({'a': 1}), stable_hash({'a': 1.0}))
+        self.assertNotEqual(stable_hash({'a': 1}), stable_hash({'a': '1'}))
+        self.assertNotEqual(stable_hash([1, 2]), stable_hash([2, 1]))
+
+    def test_feature_cache_key(self):
+        """Test the cache key for a feature."""
+        config = Struct({'preprocess': {'maximum_dimension': 500}})
+        surf = Struct({'hessian_threshold': 400, 'bow_clusters': 50})
+        surf2 = Struct({'hessian_threshold': 400, 'bow_clusters': 100,
+            'codebook': {'batch_size': 500, 'seed': 1}})
+
+        # Settings that are not used for extraction do not change the key.
+        self.assertEqual(get_feature_cache_key('surf', surf, config),
+            get_feature_cache_key('surf', surf2, config))
+
+        # The name of the feature is part of the key.
+        self.assertNotEqual(get_feature_cache_key('surf', surf, config),
+            get_feature_cache_key('orb', surf, config))
+
+class TestFilterPhotos(unittest.TestCase):
+
+    """Unit tests for selecting the photos for classification filters."""
+
+    def test_filter_photos(self):
+        """Test the photos and classes for each filter of a hierarchy."""
+        photos = [
+            (1, 'Selenipedium', None, 'palmifolium'),
+            (2, 'Phragmipedium', 'Micropetalum', 'besseae'),
+            (3, 'Phragmipedium', 'Micropetalum', 'andreettae'),
+            (4, 'Phragmipedium', 'Lorifolia', 'brasiliense')
+        ]
+        hr = {
+            'Selenipedium': {None: ['palmifolium']},
+            'Phragmipedium': {
+                'Micropetalum': ['andreettae', 'besseae'],
+                'Lorifolia': ['brasiliense']
+            }
+        }
+        levels = ('genus', 'section', 'species')
+
+        expected = {
+            ('genus', ()): [(1, 'Selenipedium'), (2, 'Phragmipedium'),
+                (3, 'Phragmipedium'), (4, 'Phragmipedium')],
+            ('species', (('genus', 'Selenipedium'), ('section', None))):
+                [(1, 'palmifolium')],
+            ('section', (('genus', 'Phragmipedium'),)): [
+                (2, 'Micropetalum'), (3, 'Micropetalum'), (4, 'Lorifolia')],
+            ('species', (('genus', 'Phragmipedium'),
+                ('section', 'Micropetalum'))): [(2, 'besseae'),
+                (3, 'andreettae')],
+            ('species', (('genus', 'Phragmipedium'),
+                ('section', 'Lorifolia'))): [(4, 'brasiliense')]
+        }
+
+        filters = list(classification_hierarchy_filters(levels, hr))
+        self.assertEqual(len(filters), len(expected))
+        for filter_ in filters:
+            key = (filter_['class'], tuple(sorted(filter_['where'].items())))
+            self.assertEqual(filter_photos(photos, filter_), expected[key])
+
+class TestImageSize(unittest.TestCase):
+
+    """Unit tests for reading the image size from image headers."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_image_size(self):
+        """Test reading the size of JPEG and PNG images."""
+        img = np.zeros((120, 170, 3), dtype=np.uint8)
+        for ext in ('.jpg', '.png'):
+            path = os.path.join(self.temp_dir, 'image' + ext)
+            cv2.imwrite(path, img)
+            self.assertEqual(get_image_size(path), (170, 120))
+
+        path = os.path.join(self.temp_dir, 'image.txt')
+        with open(path, 'w') as fh:
+            fh.write("Not an image")
+        self.assertIsNone(get_image_size(path))
+
+if __name__ == '__main__':
+    unittest.main()
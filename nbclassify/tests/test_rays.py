@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the rays module."""
+
+import os
+import sys
+import unittest
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.abspath('..'))
+sys.path.insert(0, os.path.abspath('.'))
+
+from . import *
+from nbclassify.rays import (line_pixels, pad_points, ray_histograms,
+    ray_mean_sd)
+
+class TestRays(unittest.TestCase):
+
+    """Unit tests for the vectorized ray sampling routines."""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.shape = (60, 80)
+        self.starts = self.rng.randint(0, 60, size=(200, 2))
+        self.ends = self.rng.randint(0, 60, size=(200, 2))
+
+    def test_line_pixels(self):
+        """Test that the pixels are those drawn by cv2.line."""
+        index, xs, ys = line_pixels(self.starts, self.ends, self.shape)
+        for i, (p1, p2) in enumerate(zip(self.starts, self.ends)):
+            expected = np.zeros(self.shape, dtype=np.uint8)
+            cv2.line(expected, tuple(p1), tuple(p2), 255, 1)
+            mask = np.zeros(self.shape, dtype=np.uint8)
+            mask[ys[index == i], xs[index == i]] = 255
+            self.assertTrue(np.array_equal(mask, expected))
+
+    def test_ray_histograms(self):
+        """Test that the histograms are those computed by cv2.calcHist."""
+        img = self.rng.randint(0, 256, size=self.shape + (3,)).astype(np.uint8)
+        bins = [5, 7, 10]
+        n = len(self.starts)
+        index, xs, ys = line_pixels(self.starts, self.ends, self.shape)
+
+        for ranges in [((0, 256),) * 3, ((0, 180), (0, 256), (10, 200))]:
+            hists = ray_histograms(img, index, xs, ys, n, bins, ranges)
+            for i, (p1, p2) in enumerate(zip(self.starts, self.ends)):
+                mask = np.zeros(self.shape, dtype=np.uint8)
+                cv2.line(mask, tuple(p1), tuple(p2), 255, 1)
+                for ch in range(3):
+                    expected = cv2.calcHist([img], [ch], mask, [bins[ch]],
+                        list(ranges[ch]))
+                    self.assertTrue(np.array_equal(hists[ch][i],
+                        expected.ravel()))
+
+    def test_ray_mean_sd(self):
+        """Test the distance statistics for rays with any number of points."""
+        center = (30, 40)
+        point_lists = [[], [(30, 50)], [(33, 44), (30, 30), (10, 40)],
+            [(x, 2 * x) for x in range(10)]]
+        points, mask = pad_points(point_lists)
+        self.assertEqual(points.shape, (4, 10, 2))
+        self.assertEqual(list(mask.sum(axis=1)), [0, 1, 3, 10])
+
+        means, sds = ray_mean_sd(center, points, mask)
+        for i, point_list in enumerate(point_lists):
+            distances = [np.hypot(x - center[0], y - center[1]) \
+                for x, y in point_list]
+            if len(distances) == 0:
+                self.assertEqual(means[i], 0)
+            else:
+                self.assertAlmostEqual(means[i], np.mean(distances), 4)
+            if len(distances) < 2:
+                self.assertEqual(sds[i], 0)
+            else:
+                self.assertAlmostEqual(sds[i], np.std(distances, ddof=1), 4)
+
+if __name__ == '__main__':
+    unittest.main()
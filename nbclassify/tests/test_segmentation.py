@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the segmentation module."""
+
+import os
+import sys
+import unittest
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.abspath('..'))
+sys.path.insert(0, os.path.abspath('.'))
+
+from . import *
+from nbclassify.exceptions import ConfigurationError
+from nbclassify.segmentation import (BACKENDS, grabcut, grabcut_pyramid,
+    mask_agreement, segment)
+
+def get_test_image():
+    """Return an image with an ellipse on a noisy background."""
+    rng = np.random.RandomState(0)
+    img = (rng.rand(300, 400, 3) * 60 + 40).astype(np.uint8)
+    cv2.ellipse(img, (200, 150), (110, 75), 20, 0, 360, (30, 160, 220), -1)
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+def get_bin_mask(mask):
+    """Return the binary foreground mask for a GrabCut mask."""
+    return (mask == cv2.GC_FGD) | (mask == cv2.GC_PR_FGD)
+
+class TestSegmentation(unittest.TestCase):
+
+    """Unit tests for the segmentation routines."""
+
+    def test_mask_agreement(self):
+        """Test the agreement between binary masks."""
+        a = np.zeros((10, 10), dtype=np.uint8)
+        b = a.copy()
+        self.assertEqual(mask_agreement(a, b), 1.0)
+
+        a[0:4] = 255
+        b[2:6] = 255
+        self.assertAlmostEqual(mask_agreement(a, b), 1 / 3.0)
+
+    def test_grabcut_pyramid(self):
+        """Test that multi-resolution GrabCut agrees with GrabCut."""
+        img = get_test_image()
+        full = grabcut(img, 5, None, 5)
+        for levels in (1, 2):
+            mask = grabcut_pyramid(img, 5, None, 5, levels=levels)
+            self.assertEqual(mask.shape, full.shape)
+            self.assertGreater(mask_agreement(get_bin_mask(full),
+                get_bin_mask(mask)), 0.95)
+
+    def test_backends(self):
+        """Test that all backends return a binary mask of the foreground."""
+        img = get_test_image()
+        reference = np.zeros(img.shape[:2], dtype=np.uint8)
+        cv2.ellipse(reference, (200, 150), (110, 75), 20, 0, 360, 255, -1)
+
+        for method in sorted(BACKENDS):
+            mask = segment(img, method)
+            self.assertEqual(mask.shape, img.shape[:2])
+            self.assertEqual(mask.dtype, np.uint8)
+            self.assertTrue(set(np.unique(mask)) <= set([0, 255]))
+            self.assertGreater(mask_agreement(reference, mask), 0.9, method)
+
+    def test_backend_roi(self):
+        """Test that pixels outside the ROI are background."""
+        img = get_test_image()
+        for method in sorted(BACKENDS):
+            mask = segment(img, method, (50, 40, 300, 220))
+            self.assertFalse(mask[:40].any())
+            self.assertFalse(mask[:,:50].any())
+
+    def test_segment_errors(self):
+        """Test that unknown methods and options are rejected."""
+        img = get_test_image()
+        self.assertRaises(ConfigurationError, segment, img, 'foo')
+        self.assertRaises(ConfigurationError, segment, img, 'threshold',
+            iters=5)
+
+if __name__ == '__main__':
+    unittest.main()
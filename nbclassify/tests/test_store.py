@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the feature storage module."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath('..'))
+sys.path.insert(0, os.path.abspath('.'))
+
+from . import *
+from nbclassify.store import (ArrayStore, RaggedArrayStore,
+    ShardedArrayStore, open_store)
+
+class TestArrayStore(unittest.TestCase):
+
+    """Unit tests for the array store."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'features.store')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_read_write(self):
+        """Test writing phenotypes to and reading them from a store."""
+        store = ArrayStore(self.path)
+        store['a'] = [1.0, 2.0, 3.0]
+        store['b'] = np.array([4.0, 5.0, 6.0])
+        store.close()
+
+        store = ArrayStore(self.path)
+        self.assertTrue(ArrayStore.exists(self.path))
+        self.assertEqual(len(store), 2)
+        self.assertIn('a', store)
+        self.assertEqual(store.get_matrix().dtype, np.float32)
+        np.testing.assert_array_equal(store['b'], [4.0, 5.0, 6.0])
+
+    def test_overwrite(self):
+        """Test that setting an existing key refers to the new row."""
+        store = ArrayStore(self.path)
+        store['a'] = [1.0, 2.0]
+        store['a'] = [3.0, 4.0]
+
+        store = ArrayStore(self.path)
+        self.assertEqual(len(store), 1)
+        np.testing.assert_array_equal(store['a'], [3.0, 4.0])
+
+    def test_incomplete_row(self):
+        """Test that incompletely written rows are ignored."""
+        store = ArrayStore(self.path)
+        store['a'] = [1.0, 2.0]
+        with open(os.path.join(self.path, 'index.txt'), 'a') as fh:
+            fh.write("b\n")
+
+        store = ArrayStore(self.path)
+        self.assertNotIn('b', store)
+        self.assertRaises(ValueError, store.__setitem__, 'c', [1.0])
+
+    def test_resume_after_incomplete_row(self):
+        """Test adding rows to a store with incompletely written rows."""
+        data_path = os.path.join(self.path, 'data.bin')
+        index_path = os.path.join(self.path, 'index.txt')
+        store = ArrayStore(self.path)
+        store['a'] = [1.0, 2.0]
+        size = os.path.getsize(index_path)
+
+        # A data row without a key, a key without a data row, and a key that
+        # was not completely written.
+        for data, index in [("\0" * 8, ""), ("", "x\n"), ("\0" * 8, "x")]:
+            with open(data_path, 'ab') as fh:
+                fh.write(data)
+            with open(index_path, 'ab') as fh:
+                fh.write(index)
+
+            store = ArrayStore(self.path)
+            self.assertEqual(store.keys(), ['a'])
+            self.assertEqual(os.path.getsize(index_path), size + len(index))
+            store['b'] = [9.0, 9.0]
+            store['c'] = [3.0, 4.0]
+
+            store = ArrayStore(self.path)
+            self.assertEqual(sorted(store.keys()), ['a', 'b', 'c'])
+            np.testing.assert_array_equal(store['a'], [1.0, 2.0])
+            np.testing.assert_array_equal(store['b'], [9.0, 9.0])
+            np.testing.assert_array_equal(store['c'], [3.0, 4.0])
+            self.assertEqual(store.get_matrix().shape, (3, 2))
+            self.assertEqual(os.path.getsize(data_path), 3 * 2 * 4)
+
+            store.compact(['a'])
+            size = os.path.getsize(index_path)
+
+    def test_compact(self):
+        """Test removing unreferenced rows from a store."""
+        store = ArrayStore(self.path)
+        store['a'] = [1.0, 2.0]
+        store['b'] = [3.0, 4.0]
+        store['a'] = [5.0, 6.0]
+        store['c'] = [7.0, 8.0]
+        self.assertEqual(store.stale_rows(), 1)
+
+        self.assertEqual(store.compact(['a', 'c']), 2)
+        self.assertEqual(store.stale_rows(), 0)
+        self.assertEqual(store.get_matrix().shape, (2, 2))
+
+        store = ArrayStore(self.path)
+        self.assertEqual(sorted(store.keys()), ['a', 'c'])
+        np.testing.assert_array_equal(store['a'], [5.0, 6.0])
+        np.testing.assert_array_equal(store['c'], [7.0, 8.0])
+
+class TestRaggedArrayStore(unittest.TestCase):
+
+    """Unit tests for the ragged array store."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'features.store')
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_read_write(self):
+        """Test writing descriptors to and reading them from a store."""
+        des = dict((k, self.rng.rand(n, 4)) for k, n in
+            [('a', 3), ('b', 0), ('c', 5)])
+        store = RaggedArrayStore(self.path, np.float16)
+        for key in sorted(des):
+            store[key] = des[key]
+        store.close()
+
+        store = open_store(self.path)
+        self.assertTrue(isinstance(store, RaggedArrayStore))
+        self.assertTrue(isinstance(open_store(self.path + '.new'),
+            ArrayStore))
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.get_matrix().shape, (8, 4))
+        self.assertEqual(store.get_matrix().dtype, np.float16)
+        self.assertEqual(store.span('c'), (3, 8))
+        self.assertEqual(store['b'].shape, (0, 4))
+        for key in des:
+            np.testing.assert_array_almost_equal(store[key], des[key], 2)
+
+    def test_get_rows(self):
+        """Test getting the rows for several keys as one matrix."""
+        store = RaggedArrayStore(self.path)
+        store['a'] = [[1, 2], [3, 4]]
+        store['b'] = [[5, 6]]
+        store['c'] = [[7, 8], [9, 10]]
+
+        rows = store.get_rows(['a', 'b', 'c'])
+        self.assertTrue(isinstance(rows, np.memmap))
+        np.testing.assert_array_equal(rows, np.arange(1, 11).reshape(5, 2))
+
+        rows = store.get_rows(['c', 'a'])
+        self.assertFalse(isinstance(rows, np.memmap))
+        np.testing.assert_array_equal(rows, [[7, 8], [9, 10], [1, 2], [3, 4]])
+
+    def test_incomplete_rows(self):
+        """Test that incompletely written entries are ignored."""
+        store = RaggedArrayStore(self.path)
+        store['a'] = [[1.0, 2.0]]
+        store['b'] = [[3.0, 4.0], [5.0, 6.0]]
+        with open(os.path.join(self.path, 'data.bin'), 'r+b') as fh:
+            fh.truncate(3 * 2 * 4 - 1)
+
+        store = RaggedArrayStore(self.path)
+        self.assertIn('a', store)
+        self.assertNotIn('b', store)
+        self.assertRaises(ValueError, store.__setitem__, 'c', [[1.0] * 3])
+
+    def test_resume_after_incomplete_rows(self):
+        """Test adding entries to a store with incompletely written rows."""
+        data_path = os.path.join(self.path, 'data.bin')
+        index_path = os.path.join(self.path, 'index.txt')
+        store = RaggedArrayStore(self.path)
+        store['a'] = [[1.0, 2.0]]
+        store['b'] = [[3.0, 4.0], [5.0, 6.0]]
+
+        # Only part of the rows of `b` were written.
+        with open(data_path, 'r+b') as fh:
+            fh.truncate(2 * 2 * 4 + 3)
+
+        store = RaggedArrayStore(self.path)
+        self.assertEqual(store.keys(), ['a'])
+        store['c'] = [[7.0, 8.0], [9.0, 10.0]]
+        store['b'] = [[3.0, 4.0], [5.0, 6.0]]
+
+        # The rows of `d` were written, but its index line was not.
+        with open(data_path, 'ab') as fh:
+            fh.write("\0" * 8)
+        with open(index_path, 'ab') as fh:
+            fh.write("d")
+
+        store = RaggedArrayStore(self.path)
+        self.assertEqual(sorted(store.keys()), ['a', 'b', 'c'])
+        store['e'] = [[11.0, 12.0]]
+
+        store = RaggedArrayStore(self.path)
+        self.assertEqual(sorted(store.keys()), ['a', 'b', 'c', 'e'])
+        self.assertEqual(store.get_matrix().shape, (6, 2))
+        self.assertEqual(os.path.getsize(data_path), 6 * 2 * 4)
+        np.testing.assert_array_equal(store['a'], [[1.0, 2.0]])
+        np.testing.assert_array_equal(store['b'], [[3.0, 4.0], [5.0, 6.0]])
+        np.testing.assert_array_equal(store['c'], [[7.0, 8.0], [9.0, 10.0]])
+        np.testing.assert_array_equal(store['e'], [[11.0, 12.0]])
+
+    def test_compact(self):
+        """Test removing unreferenced entries from a store."""
+        store = RaggedArrayStore(self.path)
+        store['a'] = [[1.0, 2.0]]
+        store['b'] = [[3.0, 4.0], [5.0, 6.0]]
+        store['a'] = [[7.0, 8.0], [9.0, 10.0]]
+        self.assertEqual(store.stale_rows(), 1)
+
+        self.assertEqual(store.compact(), 1)
+        store = RaggedArrayStore(self.path)
+        self.assertEqual(store.get_matrix().shape, (4, 2))
+        np.testing.assert_array_equal(store['a'], [[7.0, 8.0], [9.0, 10.0]])
+        np.testing.assert_array_equal(store['b'], [[3.0, 4.0], [5.0, 6.0]])
+
+class TestShardedArrayStore(unittest.TestCase):
+
+    """Unit tests for the sharded array store."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'shards')
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_read_write(self):
+        """Test that descriptors are spread over shards."""
+        des = [('k%d' % i, self.rng.rand(n, 4)) for i, n in
+            enumerate([3, 0, 5, 2, 4, 1])]
+        store = ShardedArrayStore(self.path, shard_size=4)
+        for key, value in des:
+            store[key] = value
+        store.close()
+
+        store = open_store(self.path)
+        self.assertTrue(isinstance(store, ShardedArrayStore))
+        self.assertEqual(len(store.shards()), 3)
+        self.assertEqual(len(store), 6)
+        self.assertEqual(store.count('k2'), 5)
+
+        matrix = store.get_matrix()
+        self.assertEqual(matrix.shape, (15, 4))
+        np.testing.assert_array_almost_equal(matrix[:],
+            np.concatenate([v for k, v in des]))
+
+        keys = ['k4', 'k0', 'k1']
+        rows = store.row_indices(keys)
+        np.testing.assert_array_almost_equal(matrix[rows],
+            np.concatenate([des[4][1], des[0][1]]))
+        for key, value in des:
+            np.testing.assert_array_almost_equal(store[key], value)
+
+        # A store is resumed with its own settings.
+        store = ShardedArrayStore(self.path, np.float16, shard_size=100)
+        self.assertEqual(store.dtype, np.float32)
+        self.assertEqual(store.shard_size, 4)
+        store['k6'] = self.rng.rand(1, 4)
+        self.assertEqual(len(store.shards()), 3)
+        self.assertEqual(store.count('k6'), 1)
+
+    def test_resume(self):
+        """Test resuming an interrupted process that writes a store."""
+        des = [('k%d' % i, self.rng.rand(n, 4)) for i, n in
+            enumerate([3, 2, 4, 1, 3, 3, 5])]
+        store = ShardedArrayStore(self.path, shard_size=4)
+        for key, value in des[:3]:
+            store[key] = value
+
+        # The process was killed while writing the rows of `k3`.
+        shard_path = store.shards()[-1].path
+        with open(os.path.join(shard_path, 'index.txt'), 'ab') as fh:
+            fh.write("k3 1\n")
+        with open(os.path.join(shard_path, 'data.bin'), 'ab') as fh:
+            fh.write("\0" * 5)
+
+        store = ShardedArrayStore(self.path)
+        self.assertEqual(sorted(store.keys()), ['k0', 'k1', 'k2'])
+        for key, value in des[3:5]:
+            if key not in store:
+                store[key] = value
+
+        # The process was killed while creating a new shard.
+        os.makedirs(os.path.join(self.path, 'shard-%05d' % 3))
+        with open(os.path.join(self.path, 'shard-%05d' % 3,
+                'meta.yml.tmp'), 'w') as fh:
+            fh.write("dtype: float")
+
+        store = ShardedArrayStore(self.path)
+        self.assertEqual(len(store), 5)
+        for key, value in des:
+            if key not in store:
+                store[key] = value
+
+        store = ShardedArrayStore(self.path)
+        self.assertEqual(len(store.shards()), 4)
+        self.assertEqual(store.get_matrix().shape, (21, 4))
+        for key, value in des:
+            np.testing.assert_array_almost_equal(store[key], value)
+        np.testing.assert_array_almost_equal(store.get_matrix()[:],
+            np.concatenate([v for k, v in des]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,9 @@ and results are not checked here.
 """
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 import numpy as np
@@ -19,10 +21,12 @@ sys.path.insert(0, os.path.abspath('.'))
 from . import *
 from nbclassify import conf, open_config
 from nbclassify.classify import ImageClassifier
-from nbclassify.data import PhenotypeCache, MakeTrainData, BatchMakeTrainData
-from nbclassify.functions import (delete_temp_dir, get_classification,
-    get_codewords)
-from nbclassify.training import MakeAnn, TestAnn, BatchMakeAnn
+from nbclassify.data import (PhenotypeCache, MakeTrainData,
+    BatchMakeTrainData, TrainData, get_layout_path, write_layout)
+from nbclassify.functions import (Struct, classification_hierarchy_filters,
+    delete_temp_dir, get_classification, get_codewords)
+from nbclassify.training import (MakeAnn, TestAnn, BatchMakeAnn, TrainANN,
+    get_validation_mask)
 from nbclassify.validate import Validator
 import nbclassify.db as db
 
@@ -107,7 +111,8 @@ class TestTrainer(unittest.TestCase):
 
         with db.session_scope(META_FILE) as (session, metadata):
             cache = PhenotypeCache()
-            cache.make(IMAGE_DIR, TEMP_DIR, self.config, update=False)
+            cache.make(IMAGE_DIR, TEMP_DIR, self.config, update=False,
+                workers=2)
 
             train_data = MakeTrainData(self.config, TEMP_DIR)
             train_data.export(self.train_file, filter_)
@@ -145,6 +150,17 @@ class TestTrainer(unittest.TestCase):
             tester.test(self.ann_file, self.train_file)
             tester.export_results(self.test_result, filter_, 0.001)
 
+    def test_trainer_af(self):
+        """Test the `cache-status` and `cache-gc` subcommands."""
+        with db.session_scope(META_FILE) as (session, metadata):
+            cache = PhenotypeCache()
+            cache.gc(TEMP_DIR, [self.config])
+
+            for status in cache.status(TEMP_DIR, self.config):
+                self.assertTrue(status['exists'])
+                self.assertEqual(status['missing'], 0)
+                self.assertEqual(status['orphans'], 0)
+
     def test_trainer_ba(self):
         """Test the `data-batch` subcommands."""
         with db.session_scope(META_FILE) as (session, metadata):
@@ -160,6 +176,27 @@ class TestTrainer(unittest.TestCase):
             ann_maker = BatchMakeAnn(self.config)
             ann_maker.batch_train(self.train_dir, self.ann_dir)
 
+            # Train the networks again, in parallel.
+            reports = ann_maker.batch_train(self.train_dir, self.ann_dir,
+                jobs=2)
+
+            # A network is trained for each node with more than one class.
+            levels = [l.name for l in ann_maker.class_hr]
+            n_nodes = 0
+            for filter_ in classification_hierarchy_filters(levels,
+                    ann_maker.taxon_hr):
+                classes = db.get_classes_from_filter(session, metadata,
+                    filter_)
+                if len(classes) > 1:
+                    n_nodes += 1
+
+        self.assertEqual(len(reports), n_nodes)
+        self.assertEqual(len(set(r['ann_file'] for r in reports)), n_nodes)
+        for report in reports:
+            self.assertTrue(report['seconds'] >= 0)
+            self.assertTrue(report['mse'] is not None)
+            self.assertTrue(os.path.isfile(report['ann_file']))
+
     def test_trainer_bc(self):
         """Test the `test-ann-batch` subcommands."""
         with db.session_scope(META_FILE) as (session, metadata):
@@ -215,5 +252,128 @@ class TestTrainer(unittest.TestCase):
         """
         validate(self.config, k=3)
 
+class TestTrainANN(unittest.TestCase):
+
+    """Unit tests for training with early stopping."""
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+
+        # Noisy samples of the XOR function.
+        inputs = np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]] * 10, float)
+        inputs += rng.normal(0, 0.1, inputs.shape)
+        outputs = np.where(np.prod(inputs, axis=1) < 0, 1, -1)
+        self.data = TrainData.from_arrays(inputs,
+            np.column_stack([outputs, -outputs]))
+
+    def test_validation_mask(self):
+        """Test that a fraction of each class is held out."""
+        codewords = get_codewords(['a', 'b', 'c'])
+        classes = ['a'] * 10 + ['b'] * 5 + ['c']
+        output = np.array([codewords[c] for c in classes])
+
+        mask = get_validation_mask(output, 0.2, seed=1)
+        self.assertEqual(mask.dtype, bool)
+        self.assertEqual(mask[:10].sum(), 2)
+        self.assertEqual(mask[10:15].sum(), 1)
+        self.assertEqual(mask[15:].sum(), 0)
+
+        # The same seed holds out the same samples.
+        self.assertTrue(np.array_equal(mask,
+            get_validation_mask(output, 0.2, seed=1)))
+
+        # At least one sample of each class is used for training.
+        mask = get_validation_mask(output, 0.99)
+        self.assertEqual(mask[:10].sum(), 9)
+        self.assertEqual(mask[10:15].sum(), 4)
+        self.assertEqual(mask[15:].sum(), 0)
+        self.assertFalse(get_validation_mask(output, 0).any())
+
+    def test_early_stopping(self):
+        """Test that training stops early and keeps the best network."""
+        trainer = TrainANN()
+        trainer.epochs = 100000
+        trainer.iterations_between_reports = 0
+        trainer.desired_error = 0
+        trainer.hidden_neurons = 4
+        trainer.activation_function_hidden = 'SIGMOID_SYMMETRIC'
+        trainer.activation_function_output = 'SIGMOID_SYMMETRIC'
+        trainer.validation_split = 0.25
+        trainer.validation_interval = 5
+        trainer.patience = 50
+        trainer.min_improvement = 0.0001
+
+        trainer.train(self.data)
+        self.assertTrue(trainer.stopped_epoch < trainer.epochs)
+        self.assertTrue(trainer.stopped_epoch - trainer.best_epoch >= 50)
+
+        # The validation error of the network is that of the best network.
+        train, validation = trainer.split_train_data(0.25)
+        trainer.ann.reset_MSE()
+        self.assertAlmostEqual(trainer.ann.test_data(validation),
+            trainer.best_error, 6)
+
+    def test_epochs(self):
+        """Test that at least one epoch must be trained."""
+        trainer = TrainANN()
+        trainer.epochs = 0
+        trainer.patience = 10
+        self.assertRaises(ValueError, trainer.train, self.data)
+
+class TestWarmStart(unittest.TestCase):
+
+    """Unit tests for continuing the training of existing networks."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.train_file = os.path.join(self.temp_dir, 'train.tsv')
+        self.ann_file = os.path.join(self.temp_dir, 'train.ann')
+        self.layout_file = get_layout_path(self.train_file)
+        self.ann_config = Struct({'epochs': 100, 'hidden_neurons': 3})
+
+        data = TrainData.from_arrays([[-1, -1], [-1, 1], [1, -1], [1, 1]],
+            [[1, -1], [-1, 1], [-1, 1], [1, -1]], [1, 2, 3, 4])
+        data.write_to_file(self.train_file, ["ID", "a", "b", "OUT:1", "OUT:2"])
+        write_layout(self.layout_file, ["a", "b"], ["equal", "unequal"])
+
+        self.maker = MakeAnn(open_config(CONF_FILE))
+        self.maker.train(self.train_file, self.ann_file, self.ann_config)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_ann(self, trainer):
+        return self.maker.get_warm_start_ann(self.train_file, self.ann_file,
+            trainer)
+
+    def test_warm_start(self):
+        """Test when an existing network is trained further."""
+        trainer = self.maker.get_trainer(self.ann_config)
+        self.assertTrue(self.get_ann(trainer) is None)
+
+        self.maker.set_warm_start(True)
+        ann = self.get_ann(trainer)
+        self.assertTrue(ann is not None)
+        self.assertEqual(ann.get_num_input(), 2)
+        self.assertEqual(ann.get_num_output(), 2)
+        self.maker.train(self.train_file, self.ann_file, self.ann_config)
+        self.assertTrue(self.get_ann(trainer) is not None)
+
+        # The topology of the network has changed.
+        trainer.hidden_neurons = 4
+        self.assertTrue(self.get_ann(trainer) is None)
+        trainer.hidden_neurons = 3
+        trainer.train_type = 'cascade'
+        self.assertTrue(self.get_ann(trainer) is None)
+        trainer.train_type = 'ordinary'
+
+        # The classes have changed.
+        write_layout(self.layout_file, ["a", "b"], ["equal", "other"])
+        self.assertTrue(self.get_ann(trainer) is None)
+
+        # The layout of the training data is unknown.
+        os.remove(self.layout_file)
+        self.assertTrue(self.get_ann(trainer) is None)
+
 if __name__ == '__main__':
     unittest.main()